@@ -1,10 +1,11 @@
 #!/usr/bin/env python3
 import argparse
-from astropy.time import Time
 import os
-import pandas as pd
 from create_config import vex2dic, getExperimentName, sched2df
 
+AGG_COLUMNS = ['experiment', 'station', 'source', 'nscans', 'length_sec', 'missing_sec',
+               't_firstMJD', 't_lastMJD', 'intervals']
+
 def options():
     parser = argparse.ArgumentParser()
     general = parser.add_argument_group('General info about the data.')
@@ -53,15 +54,86 @@ class RunError(Error):
         self.message = message
 
 
+# function which can take overlap into account between scans
+# taken from Mark Snelders
+def merge(times):
+    """ Function which reduces the overlap between a list of tuples
+    Example [(1, 3), (2, 4), (7, 8)] ---> [(1, 4), (7, 8)]
+    Use: unique_times = list(merge(times)) """
+    saved = list(times[0])
+    for st, en in sorted([sorted(t) for t in times]):
+        if st <= saved[1]:
+            saved[1] = max(saved[1], en)
+        else:
+            yield tuple(saved)
+            saved[0] = st
+            saved[1] = en
+    yield tuple(saved)
+
+
+def aggregate(df):
+    '''
+    Returns the time-on-source aggregates of the scans in df with one row per
+    experiment, station and source: the number of scans, the total scan length
+    and missing seconds, the first start and last end (MJD) and the list of
+    merged (start, end) intervals. Scans followed by a gap of more than two
+    hours in the schedule of their station are taken to be dummy scans and
+    only counted in nscans.
+    '''
+    keys = ['experiment', 'station', 'source']
+    df = df.sort_values(by='t_startMJD').reset_index(drop=True)
+    if 'experiment' not in df:
+        df = df.assign(experiment='')
+    next_start = df.groupby(['experiment', 'station']).t_startMJD.shift(-1)
+    df = df.assign(t_endMJD=df.t_startMJD + df.length_sec / 86400.,
+                   dummy=(next_start - df.t_startMJD) * 24. >= 2.)
+    kept = df[~df.dummy]
+    agg = df.groupby(keys, sort=False).size().rename('nscans').to_frame()
+    agg = agg.join(kept.groupby(keys, sort=False).agg(length_sec=('length_sec', 'sum'),
+                                                      missing_sec=('missing_sec', 'sum'),
+                                                      t_firstMJD=('t_startMJD', 'min'),
+                                                      t_lastMJD=('t_endMJD', 'max')))
+    agg[['length_sec', 'missing_sec']] = agg[['length_sec', 'missing_sec']].fillna(0)
+    starts = kept.t_startMJD.values.tolist()
+    ends = kept.t_endMJD.values.tolist()
+    intervals = {key: list(merge([(starts[i], ends[i]) for i in rows]))
+                 for key, rows in kept.groupby(keys, sort=False).indices.items()}
+    agg['intervals'] = [intervals.get(key, []) for key in agg.index]
+    return agg.reset_index()[AGG_COLUMNS]
+
+
+def load_aggregates(db_file):
+    '''
+    Returns the aggregates of db_file, which addVex2db keeps up to date in
+    <db_file>.agg. They are rebuilt from all scans if they are missing or
+    older than db_file.
+    '''
+    import pandas as pd
+    agg_file = f'{db_file}.agg'
+    if os.path.exists(agg_file) and (os.path.getmtime(agg_file) >= os.path.getmtime(db_file)):
+        return pd.read_pickle(agg_file)
+    print(f'Aggregates of {db_file} missing or outdated, rebuilding them.')
+    agg = aggregate(pd.read_pickle(db_file))
+    try:
+        agg.to_pickle(agg_file)
+    except OSError:
+        pass
+    return agg
+
+
 def main(args):
+    import pandas as pd
     vexfile = os.path.abspath(args.vexfile)
     vex = vex2dic(vexfile)
     df_file = os.path.abspath(args.db_file)
+    agg_file = f'{df_file}.agg'
     if not os.path.exists(df_file):
         df = sched2df(vex, add2db=True)
         df.to_pickle(df_file)
+        aggregate(df).to_pickle(agg_file)
     else:
         df = pd.read_pickle(df_file)
+        agg = load_aggregates(df_file)
         # first check if experiment is already in the dataframe
         exp = getExperimentName(vex)
         if exp in df.experiment.unique():
@@ -69,11 +141,15 @@ def main(args):
                 print(f'Will replace all entries for experiment {exp} with entries from '\
                       f'supplied {vexfile}.')
                 df = df.loc[(df.experiment != exp)]
+                agg = agg.loc[(agg.experiment != exp)]
             else:
                 raise InputError(f'Experiment {exp} already in the database. Use flag --replace '\
                                  'to replace the existing entry.')
-        df = pd.concat([df, sched2df(vex, add2db=True)])
+        new = sched2df(vex, add2db=True)
+        df = pd.concat([df, new])
         df.to_pickle(df_file)
+        # only the new experiment is aggregated, the rest is kept as is
+        pd.concat([agg, aggregate(new)], ignore_index=True).to_pickle(agg_file)
     return
 
 
@@ -40,34 +40,61 @@ run_process_vdif() {
     sideband=$8
     nchan=$9
     nsec=${10}
-    start=${11}
+    local start=${11} # must not overwrite the global start offset, it differs when resuming
     station=${12}
     njobs=${13}
     skip=${14}
-    workdir=${15}
+    if_dirs=( ${15} ) # scratch directory of each IF, first entry is IF1
     pol=${16}
     nthreads=${17}
     tscrunch=${18}
     fifodir=${19}
     nbit=${20}
     keepBP=${21}
+    cpu_sets=( ${22} ) # <cpus>:<NUMA node> of each IF as given by cpu_placement.py, may be empty
+    coherent=${23}
+    coherent_dm=${24}  # may be empty, then process_vdif looks up the DM of the source
     bandstep=`echo $bw+$bw | bc`
 
     keepBP_flag=''
     if [[ $keepBP -gt 0 ]]; then
 	keepBP_flag='--keepBP'
     fi
+    coherent_flag=''
+    if [[ $coherent -gt 0 ]]; then
+        coherent_flag='--coherent'
+        if ! [ -z ${coherent_dm} ]; then
+            coherent_flag="--coherent --dm ${coherent_dm}"
+        fi
+    fi
     for i in ${ifs};do
-        process_vdif ${source} ${workdir}/${experiment}_${st}_no0${scanname}_IF${i}.vdif  \
+        cpu_flag=''
+        cpu_set=${cpu_sets[$((i-1))]}
+        if ! [ -z ${cpu_set} ]; then
+            cpu_flag="--cpus ${cpu_set%:*} --mem_node ${cpu_set##*:}"
+        fi
+        process_vdif ${source} ${if_dirs[$((i-1))]}/${experiment}_${st}_no0${scanname}_IF${i}.vdif  \
                      -f $freqEdge -b ${bw} -${sideband} --nchan $nchan --nsec $nsec --start $start \
                      --force -t ${station} --pol ${pol} --nthreads ${nthreads} --tscrunch ${tscrunch} \
-		     --fil_out_dir ${fifodir} --nbit=${nbit} ${keepBP_flag} & sleep 0.1
+		     --fil_out_dir ${fifodir} --nbit=${nbit} ${keepBP_flag} ${cpu_flag} ${coherent_flag} & sleep 0.1
         freqEdge=`echo $freqEdge+$bandstep | bc`
     done
 }
 
 check_progs() {
-    progs='process_vdif spif2file cmd2flexbuff setfifo bc vdif_print_headers splice digifil'
+    # the tools every run needs, and those of the optional stages that are switched on
+    progs='process_vdif spif2file cmd2flexbuff pipe_buffer.py checkpoint.py scratch_placement.py bc vdif_print_headers splice digifil'
+    [[ ${pinCPUs} -ne 0 ]] && progs="${progs} cpu_placement.py"
+    [[ ${streamVDIF} -ne 0 ]] && progs="${progs} vdif_stream.py"
+    [[ ${scanGaps} -ne 0 ]] && progs="${progs} vdif_scan.py"
+    # quicklook.py folds with quickfold.py and needs it to start
+    [[ ${quickLook} -ne 0 ]] && progs="${progs} quicklook.py quickfold.py"
+    [[ ${submit2fetch} -ne 0 ]] && progs="${progs} fetch_publisher.py"
+    [[ ${submit2fetch} -ne 0 ]] && [[ ${autoFlag} -ne 0 ]] && progs="${progs} rfi_flag.py"
+    [[ ${archiveFil} -ne 0 ]] && progs="${progs} fil_archive.py"
+    if [[ ${keepVDIF} -eq 0 ]] && ( [[ ${ringScans} -gt 0 ]] || [[ `echo "${ringGB} > 0" | bc` -eq 1 ]] ); then
+        progs="${progs} vdif_ring.py"
+    fi
     for prog in $progs; do
 	which $prog
 	if [[ $? -eq 1 ]];then
@@ -118,7 +145,211 @@ compare_size() {
 submit_fetch() {
     # argument $1 points at the filterbank file
     # argument $2 points at the flag file -- can be empty.
-     /home/franz/.conda/envs/fetch/bin/python /home/franz/software/src/greenburst/pika_send.py -q "stage01_queue" -m "${1} ${2}"
+    # handed to the long-lived fetch_publisher.py service; spooled until it runs if it does not
+    fetch_publisher.py send "${1} ${2}"
+}
+
+make_flag_file() {
+    # argument $1 points at the filterbank file
+    # argument $2 points at the flag file -- computed from $1 if it does not exist yet
+    if [[ ${autoFlag} -ne 0 ]] && [[ -n "${2}" ]] && [[ ! -f ${2} ]]; then
+        msg "Flag file ${2} does not exist, computing it from ${1}"
+        rfi_flag.py ${1} -o ${2}
+    fi
+    return 0
+}
+
+fwait() {
+    # helper to limit the number of folds running at the same time
+    while [ $(ps -ef | grep "dspsr -E" | grep -v /bin/sh | grep -v grep | wc -l) -ge $1 ]; do
+        sleep 10
+    done
+}
+
+fold_scan() {
+    # folds a spliced filterbank with the ephemeris in ${parfile} and creates diagnostic plots.
+    # Plots are written straight to per-scan files (instead of pgplot.ps in the CWD) such that
+    # several folds can run at the same time.
+    local filfile=$1
+    fwait ${max_folds}
+    cmd="dspsr -E ${parfile} -L 10 -A -k ${station} -d1 ${outdir}/${filfile} -O ${outdir}/${filfile} -t ${fold_nthreads}"
+    msg "running ${cmd}"
+    ${cmd}
+    cmd="psrplot -pF -D ${outdir}/${filfile}.ps/CPS -c x:unit=s ${outdir}/${filfile}.ar -j dedisperse,tscrunch,pscrunch,\"fscrunch 128\""
+    msg "running ${cmd}"
+    eval "${cmd}"
+    if [[ ${pol} -eq 4 ]];then
+        # in case we have full pol data, we create a plot with pol 0, pol 1, Stokes I, and Full Stokes
+        cmd="psrplot -N 2x2 -D ${outdir}/${filfile}_fullPol.ps/CPS ${outdir}/${filfile}.ar -j tscrunch,dedisperse,\"fscrunch 128\" \\
+            -p freq+ -c ':0:pol=0' \\
+            -p freq+ -c ':1:pol=1' \\
+            -p freq+ -c ':2:x:unit=ms' -j :2:pscrunch \\
+            -p Scyl -j :3:fscrunch"
+        msg "running ${cmd}"
+        eval "${cmd}"
+    fi
+}
+
+checkpoint_record() {
+    # argument $1 is the stage (split, fil, fetch, fold) of scan $2, further arguments are its output files
+    local stage=$1
+    local scanname=$2
+    shift 2
+    checkpoint.py record ${statedir}/${experiment}_${st}_no0${scanname}.${stage} "$@" ${checksum_flag}
+}
+
+checkpoint_done() {
+    # returns 0 if stage $1 of scan $2 was finished in this or a previous run and its outputs are intact
+    checkpoint.py verify ${statedir}/${experiment}_${st}_no0${2}.${1} > /dev/null
+}
+
+splice_out() {
+    # splices the fifos given after the sidecar $1 to stdout. If quickLook is set the quick-look
+    # statistics are tapped off the stream on the way and written to $1, with a summary in the log.
+    # Pulsar scans are then folded on the way as well if quickFold is set (<scan>.fold.npz).
+    local sidecar=$1
+    shift
+    local fold_args=''
+    if [[ ${fold} -ne 0 ]] && [[ ${quickFold} -ne 0 ]]; then
+        fold_args="--par ${parfile} --site ${station}"
+    fi
+    if [[ ${quickLook} -ne 0 ]]; then
+        splice "$@" | quicklook.py tap --out ${sidecar} ${fold_args}
+        local status=( ${PIPESTATUS[@]} )
+        # the statistics are extra, a failing tap only fails the scan if the data did not get through,
+        # in which case splice sees a broken pipe
+        if [[ ${status[1]} -ne 0 ]]; then
+            msg "quicklook.py exited with ${status[1]}, ${sidecar} may be missing."
+        fi
+        return ${status[0]}
+    fi
+    splice "$@"
+}
+
+finish_scan() {
+    # runs in the background for each scan: splices the IFs into the final filterbank,
+    # cleans up and hands the filterbank to the next stages (flagging, FETCH, folding).
+    # If splice_list is empty the filterbank is done already and only the later stages are run.
+    # If header_size is set the filterbank is resumed, i.e. the output of splice is appended
+    # to the existing file without its header.
+    local filfile=$1
+    local scanname=$2
+    local splice_list=$3
+    local header_size=${4:-0}
+    local sidecar=${outdir}/${filfile%.fil}.quicklook.npz
+    if [[ -n "${splice_list}" ]]; then
+        if [[ ${header_size} -gt 0 ]]; then
+            # the statistics then only cover the resumed part of the scan
+            splice_out ${sidecar} ${splice_list} | tail -c +$((header_size+1)) >> ${outdir}/${filfile}
+            [[ ${PIPESTATUS[0]} -eq 0 ]] || return 1
+        else
+            splice_out ${sidecar} ${splice_list} > ${outdir}/${filfile} || return 1
+        fi
+        for filfifo in ${splice_list};do rm -rf $filfifo; done && msg "Fifos removed"
+        checkpoint_record fil ${scanname} ${outdir}/${filfile}
+        msg "Output ${outdir}/${filfile}"
+        if [[ $keepVDIF -eq 0 ]] && ( [[ ${ringScans} -gt 0 ]] || [[ `echo "${ringGB} > 0" | bc` -eq 1 ]] ); then
+            # retain the split files for candidates to be cut from, evicting the least recently used scans
+            vdif_ring.py add ${ringIndex} `ls ${workdirs[@]/%//${experiment}_${st}_no0${scanname}_IF*.vdif} 2> /dev/null` \
+                         --freq_lsb ${freqLSB_0} --bw ${bw} --max_scans ${ringScans} --max_gb ${ringGB}
+        elif [[ $keepVDIF -eq 0 ]]; then
+            for workdir in ${workdirs[@]}; do
+                rm -rf ${workdir}/${experiment}_${st}_no0${scanname}_IF*.vdif
+            done
+        fi
+    fi
+    if [[ $submit2fetch -ne 0 ]] && ! checkpoint_done fetch ${scanname}; then
+        make_flag_file ${outdir}/${filfile} ${flagFile} && \
+            submit_fetch ${outdir}/${filfile} ${flagFile} && \
+            msg "Submitted ${outdir}/${filfile} ${flagFile} to fetch" && \
+            checkpoint_record fetch ${scanname}
+    fi
+    if [[ ${fold} -ne 0 ]] && [[ ${dspsrFold} -ne 0 ]] && ! checkpoint_done fold ${scanname}; then
+        fold_scan ${filfile} && checkpoint_record fold ${scanname} ${outdir}/${filfile}.ar
+    fi
+    if [[ ${archiveFil} -ne 0 ]] && ! checkpoint_done archive ${scanname}; then
+        # FETCH reads the filterbank whenever it gets to it, so it is kept if it was submitted
+        local remove_flag='--remove'
+        if [[ $submit2fetch -ne 0 ]]; then
+            remove_flag=''
+        fi
+        fil_archive.py pack ${outdir}/${filfile} --block_sec ${archive_block_sec} ${remove_flag} && \
+            checkpoint_record archive ${scanname} ${outdir}/${filfile%.fil}.filz
+    fi
+}
+
+stream_scan() {
+    # streams a scan from the FlexBuff through jive5ab straight into digifil without touching scratch:
+    # jive5ab writes each IF into a fifo in ${streamdir} and vdif_stream.py relays it through a bounded
+    # buffer to the fifo the IF's digifil reads from. Splitting and channelisation thus overlap.
+    # jive5ab applies the offset into the recording, i.e. digifil always starts at 0.
+    # The byte range $6 of the scan in the recording is only used if nothing is skipped on top of it.
+    local scan=$1
+    local scanname=$2
+    local skip=`echo "$3+${start}" | bc`
+    local length=$4
+    local filfile=$5
+    local byterange=$6
+    if [[ `echo "${start} != 0" | bc` -eq 1 ]]; then
+        byterange='-'
+    fi
+    local splice_list=''
+    local vdif_list=''
+    local stream_dirs=''
+    local fifo_dirs=''
+    local header_size=0
+    if [ -f ${outdir}/${filfile} ]; then
+        # resume a filterbank left over from an interrupted run by letting jive5ab skip what is done
+        read done_sec header_size <<< `checkpoint.py resume ${outdir}/${filfile}`
+        if [[ ${header_size} -gt 0 ]]; then
+            msg "Resuming ${outdir}/${filfile} after ${done_sec}s."
+            skip=`echo "${skip}+${done_sec}" | bc`
+            length=`echo "${length}-${done_sec}" | bc`
+            byterange='-'
+        fi
+        if [[ `echo "${length} <= 0" | bc` -eq 1 ]]; then
+            checkpoint_record fil ${scanname} ${outdir}/${filfile}
+            finish_scan ${filfile} ${scanname} "" &
+            return 0
+        fi
+    fi
+    for i in `seq 1 ${nif}`;do
+        vdifnme=${fifodir}/${experiment}_${st}_no0${scanname}_IF${i}.vdif
+        rm -f ${vdifnme} ${streamdir}/`basename ${vdifnme}`
+        mkfifo ${vdifnme} ${streamdir}/`basename ${vdifnme}`
+        vdif_list=${vdif_list}${vdifnme}' '
+        stream_dirs=${stream_dirs}${streamdir}','
+        fifo_dirs=${fifo_dirs}${fifodir}' '
+        filfifo=${fifodir}/`basename ${vdifnme}`_pol${pol}.fil
+        mkfifo ${filfifo}
+        splice_list=${filfifo}' '${splice_list}
+    done
+    vdif_stream.py ${vdif_list} --indir ${streamdir} --buffer_mb ${stream_buffer_mb} --cleanup &
+    finish_scan ${filfile} ${scanname} "${splice_list}" ${header_size} &
+    pipe_buffer.py ${splice_list} --bw ${bw} --nchan ${nchan} --nbit ${nbit} --pol ${pol} \
+                   --tscrunch ${tscrunch} --buffer_sec ${fifo_buffer_sec} --pid $! &
+    pwait `echo ${njobs_parallel}-${nif}-1 | bc`
+    cpu_sets=''
+    if [[ ${pinCPUs} -gt 0 ]]; then
+        cpu_sets=`cpu_placement.py ${fifo_dirs} --nthreads ${digifil_nthreads}`
+    fi
+    run_process_vdif $scanname "$ifs_odd" "$target" $experiment $st $freqLSB_0 $bw l $nchan $length 0 \
+                     $station $njobs_parallel $skip "${fifo_dirs}" \
+                     $pol $digifil_nthreads $tscrunch ${fifodir} $nbit $keepBP "${cpu_sets}" \
+                     $coherentDD "${coherentDM}"
+    run_process_vdif $scanname "$ifs_even" "$target" $experiment $st $freqUSB_0 $bw u $nchan $length 0 \
+                     $station $njobs_parallel $skip "${fifo_dirs}" \
+                     $pol $digifil_nthreads $tscrunch ${fifodir} $nbit $keepBP "${cpu_sets}" \
+                     $coherentDD "${coherentDM}"
+    msg "Streaming scan ${scanname}."
+    spif2file ${experiment} ${st} ${scan} ${nif} ${mode} ${skip} ${length} ${scanname} \
+              ${flipIF} ${vbsdir} ${stream_dirs%,} - ${online_process} ${byterange}
+    if [[ $? -eq 1 ]];then
+        exit 1
+    fi
+    if ! [ ${online_process} -eq 0 ]; then
+        fusermount -u ${vbsdir}
+    fi
 }
 
 # Prints out the date and time.
@@ -184,28 +415,22 @@ trim() {
 
 check_scratch_space() {
     # function to see if we have enough space on the designated space for the split vdif files
-    workdir_odd_base=$1
-    workdir_even_base=$2
-    fs_odd=$(cut -f 2 -d '/' <<< ${workdir_odd_base})
-    fs_even=$(cut -f 2 -d '/' <<< ${workdir_even_base})
-    min_space_required=${3:-100} # in GB
-    # check how much space is left and remove leading/trailing whitespace
-    space_odd=$(trim $(df -h | grep ${fs_odd} | cut -f 3 -d 'G'))
-    space_even=$(trim $(df -h | grep ${fs_even} | cut -f 3 -d 'G'))
-    while [[ ${space_odd} -lt ${min_space_required} ]] || [[ ${space_even} -lt ${min_space_required} ]];do
-        sleep 20
-        space_odd=$(trim $(df -h | grep ${fs_odd} | cut -f 3 -d 'G'))
-        space_even=$(trim $(df -h | grep ${fs_even} | cut -f 3 -d 'G'))
+    # takes any number of scratch directories, waits till all of them have ${min_space_required} GB left
+    min_space_required=100 # in GB
+    for workdir in "$@"; do
+        while [[ $(df -BG --output=avail ${workdir} | tail -1 | tr -dc '0-9') -lt ${min_space_required} ]];do
+            sleep 20
+        done
     done
 }
 
-check_progs
 check_vars
 
 # Intiate some default variables
 
 workdir_odd_base=/scratch0/${USER}/   #  vdif files expected to be here
 workdir_even_base=/scratch1/${USER}/
+scratch_dirs=()   # List of scratch directories the IFs are spread over. Defaults to ( ${workdir_odd_base} ${workdir_even_base} ).
 outdir_base=/data1/${USER}/           # Final downsampled filterbank file goes here.
 fifodir_base=/tmp/${USER}/
 vbsdir_base=${HOME}/vbs_data/    # baseband data is mounted here.
@@ -224,10 +449,29 @@ nbit=8            # Bit depth of fitlerbanks. Can be 2, 8, 16, -32. -32 is float
 isMark5b=0        # By default the raw data is assumed to be VDIF data. Will instead assume Mark5B recordings if not set to 0.
 keepVDIF=0        # By default split VDIF files are deleted to save space on disk. These files will be kept if not 0.
 flagFile=''       # Optionally, a flag file can be passed.
+autoFlag=0        # If set, a non-existing flagFile will be computed from the first filterbank.
 keepBP=0          # If set the bandpass is not removed, i.e. -I0 is added to the digifil command.
+coherentDD=0      # If set, digifil coherently dedisperses to coherentDM, or to the DM of the source as known to dm_utils.
+coherentDM=''     # DM for coherentDD, create_config.py --coherent writes the one from the catalogue.
 split_vdif_only=0 # Filterbanks will not be created if this is set to nonzero.
 online_process=0  # Each scan will get its own directory if this is set to nonzero (this is used for the online pipeline).
 nbits=2           # bit depth of raw data
+fold_nthreads=8   # Number of threads per dspsr when folding pulsar scans.
+fold_ncpus=16     # Total number of cores the folds of all scans may use at the same time.
+streamVDIF=0      # If set (and keepVDIF=0), scans are streamed from jive5ab straight into digifil without writing split VDIF files to scratch.
+stream_buffer_mb=256 # Size of the in-memory buffer per IF when streaming.
+fifo_buffer_sec=0.5 # The fifos between digifil and splice are sized to hold this many seconds of data (capped by /proc/sys/fs/pipe-max-size).
+pinCPUs=0         # If set, the digifil of each IF is bound to its own CPUs on the NUMA node closest to its scratch device.
+fullChecksum=0    # If set, the checkpoints of each stage are validated with a checksum over whole files instead of sampled blocks.
+scanGaps=0        # If set, the frame headers of each recording are scanned and dead spans at the edges of each scan are skipped.
+ringScans=0       # If set (and keepVDIF=0), the split VDIF files of this many scans are kept on scratch to cut candidates from.
+ringGB=0          # If set (and keepVDIF=0), the split VDIF files of the last scans are kept on scratch up to this many GB.
+archiveFil=0      # If set, each filterbank is compressed into a .filz archive (fil_archive.py) once all other stages are done.
+archive_block_sec=1.0 # Duration of the independently compressed blocks of the archives, i.e. the granularity of random access.
+byteranges=()     # Byte range (start:stop, - if unknown) of each scan in its recording, create_config.py --gapmaps writes them from the frame headers. spif2file then splits exactly these bytes.
+quickLook=0       # If set, quick-look statistics (bandpass, rms, kurtosis, zero-DM series, dynamic spectrum) are computed from the splice output into <filterbank>.quicklook.npz.
+quickFold=0       # If set (and quickLook is set), pulsar scans are folded from the splice output into <filterbank>.fold.npz (profile, S/N).
+dspsrFold=1       # If set, pulsar scans are also folded with dspsr from the filterbank, with diagnostic plots.
 
 # Load other variables from config file, parameters above will be overwritten if they are in the config file
 source ${1}
@@ -235,16 +479,26 @@ if [[ $? -eq 1 ]];then
     helpmsg
     exit 1
 fi
+# only now we know which of the optional stages will run
+check_progs
 
 # Run parse_vex.py with input from ${1}.
 # parse_vex.py takes config files and appends necessary info.
 # Then we source that new input file.
 # In case of multiple frequency setups for same source and station, then run several times from here.
 
-workdir_odd=${workdir_odd_base}/${experiment}    #  vdif files expected to be here.
-workdir_even=${workdir_even_base}/${experiment}
+if [[ ${#scratch_dirs[@]} -eq 0 ]]; then
+    scratch_dirs=( ${workdir_odd_base} ${workdir_even_base} )
+fi
+workdirs=()                                      # vdif files expected to be here.
+for scratch_dir in ${scratch_dirs[@]}; do
+    workdirs+=( ${scratch_dir}/${experiment} )
+done
 outdir=${outdir_base}/${experiment}              # Final downsampled filterbank file goes here.
 fifodir=${fifodir_base}/fifos/
+streamdir=${fifodir}/stream/                     # jive5ab writes to fifos here if streamVDIF is set.
+statedir=${outdir}/checkpoints                   # Records of the finished stages of each scan, used to resume runs.
+ringIndex=${scratch_dirs[0]}/vdif_ring.json       # Index of the split VDIF files retained on scratch (ringScans, ringGB).
 vbsdir=${vbsdir_base}/${experiment}              # Baseband data is mounted here.
 
 # Nothing to change below this line
@@ -267,12 +521,11 @@ let max_odd=${nif}-1
 ifs_odd=`seq 1 2 ${max_odd}`
 ifs_even=`seq 2 2 ${nif}`
 
-if ! [ -d ${workdir_odd} ];then
-    mkdir -p ${workdir_odd}
-fi
-if ! [ -d ${workdir_even} ];then
-    mkdir -p ${workdir_even}
-fi
+for workdir in ${workdirs[@]}; do
+    if ! [ -d ${workdir} ];then
+        mkdir -p ${workdir}
+    fi
+done
 if ! [ -d ${outdir} ];then
     mkdir -p ${outdir}
 fi
@@ -282,6 +535,16 @@ fi
 if ! [ -d ${fifodir} ];then
     mkdir -p ${fifodir}
 fi
+if ! [ -d ${streamdir} ];then
+    mkdir -p ${streamdir}
+fi
+if ! [ -d ${statedir} ];then
+    mkdir -p ${statedir}
+fi
+checksum_flag=''
+if [[ ${fullChecksum} -ne 0 ]]; then
+    checksum_flag='--full'
+fi
 
 n_baseband_files=`ls -l ${vbsdir} | wc -l`
 if [ ${n_baseband_files} -eq 1 ];then
@@ -319,43 +582,96 @@ fi
 
 msg "will use ${mode}"
 
+if [[ ${streamVDIF} -ne 0 ]] && ( [[ ${keepVDIF} -ne 0 ]] || [[ ${split_vdif_only} -ne 0 ]] ); then
+    msg "Split VDIF files are to be kept, will not stream."
+    streamVDIF=0
+fi
+# digifil reads through DSPSR, which may seek in its input; only stream if it handles fifos
+if [[ ${streamVDIF} -ne 0 ]] && ! vdif_stream.py --probe --workdir ${fifodir}; then
+    msg "digifil cannot read from fifos, will split to scratch instead of streaming."
+    streamVDIF=0
+fi
+
+# in case we look at a pulsar, each scan is folded as soon as it is spliced.
+# ${target} might contain Ra and Dec, the name of the source is the first word.
+psr=${target%% *}
+fold=0
+parfile=${outdir}/${psr}.psrcat.par
+max_folds=`echo "${fold_ncpus}/${fold_nthreads}" | bc`
+if [[ ${max_folds} -lt 1 ]]; then
+    max_folds=1
+fi
+# psrcat will not throw an error on BSGR because it starts with B...
+if [[ ${psr} != 'BSGR' ]] && [[ ${split_vdif_only} -eq 0 ]]; then
+    # the ephemeris is fetched once and shared by all scans
+    if [ -s ${parfile} ] || psrcat -e ${psr} > ${parfile}; then
+        fold=1
+        msg "${psr} is a known pulsar, scans will be folded with ${parfile}"
+    fi
+fi
+
 scancounter=-1
 for scan in "${scans[@]}";do
     let scancounter=${scancounter}+1
     skip=${skips[${scancounter}]}
     length=${lengths[${scancounter}]}
     scanname=${scannames[${scancounter}]}
+    byterange=${byteranges[${scancounter}]:--}
     # make sure scan and scanname is a 3-digit-number with leading zeros
     scan=`printf "%03g" ${scan}`
     scanname=`printf "%03g" ${scanname}`
+    filfile=${experiment}_${st}_no0${scanname}_IFall_vdif_pol${pol}.fil
+    if [[ ${split_vdif_only} -eq 0 ]] && ( checkpoint_done fil ${scanname} || checkpoint_done archive ${scanname} ); then
+        msg "${outdir}/${filfile} is complete already, skipping scan ${scanname}."
+        finish_scan ${filfile} ${scanname} "" &
+        continue
+    fi
+    if [[ ${scanGaps} -ne 0 ]] && [[ ${byterange} == '-' ]]; then
+        # trim skip and length to the valid data according to the frame headers of the recording,
+        # unless create_config located the scan by the frame headers already
+        trimmed=`vdif_scan.py ${vbsdir}/${experiment}_${st}_no0${scan} --mode ${mode} \
+                 --cachedir ${workdirs[0]}/gapmaps --trim ${skip} ${length}`
+        if [[ $? -ne 0 ]]; then
+            msg "No valid data for scan ${scanname}, skipping it."
+            continue
+        fi
+        skip=`cut -d ' ' -f1 <<< ${trimmed}`
+        length=`cut -d ' ' -f2 <<< ${trimmed}`
+        msg "Valid data for scan ${scanname}: skip=${skip}s, length=${length}s"
+    fi
+    if [[ ${streamVDIF} -ne 0 ]]; then
+        stream_scan ${scan} ${scanname} ${skip} ${length} ${filfile} ${byterange}
+        sleep 5
+        continue
+    fi
     vdif_files=""
     splice_list=''
-    check_scratch_space ${workdir_odd} ${workdir_even}
-    for i in `seq 1 2 ${nif}`;do
-        # odd IFs first
-        vdifnme=${workdir_odd}/${experiment}_${st}_no0${scanname}_IF${i}.vdif
+    check_scratch_space ${workdirs[@]}
+    if checkpoint_done split ${scanname}; then
+        msg "Re-using the split files of scan ${scanname}."
+    else
+        # leftovers of an interrupted run cannot be trusted
+        for workdir in ${workdirs[@]}; do
+            rm -f ${workdir}/${experiment}_${st}_no0${scanname}_IF*.vdif
+        done
+    fi
+    # spread the IFs over the scratch directories according to their bandwidth and free space;
+    # IFs that were split already stay where they are.
+    bytes_per_if=`echo "${datarate}*1000000/8*${length}/${nif}" | bc`
+    if_dirs=( `scratch_placement.py ${workdirs[@]} --nif ${nif} --bytes_per_if ${bytes_per_if} \
+               --basename ${experiment}_${st}_no0${scanname}` )
+    if [[ $? -ne 0 ]]; then
+        exit 1
+    fi
+    msg "IFs 1-${nif} of scan ${scanname} go to ${if_dirs[*]}"
+    for i in `seq 1 ${nif}`;do
+        vdifnme=${if_dirs[$((i-1))]}/${experiment}_${st}_no0${scanname}_IF${i}.vdif
         vdif_files=${vdif_files}${vdifnme}" "
         if [ ! -f ${vdifnme} ];then
             msg "Splitting the raw data."
+            # spif2file gets the directory of each IF as a comma-separated list
             spif2file ${experiment} ${st} ${scan} ${nif} ${mode} ${skip} ${length} ${scanname} \
-	    	${flipIF} ${vbsdir} ${workdir_odd} ${workdir_even} ${online_process}
-    	if [[ $? -eq 1 ]];then
-    	    exit 1
-    	fi
-            msg "splitting is done, waiting 5s for the disks to catch up"
-            sleep 5
-        fi
-        filfifo=${fifodir}/`basename ${vdifnme}`_pol${pol}.fil
-        mkfifo ${filfifo}
-        splice_list=${filfifo}' '${splice_list}
-        # then even IFs
-        let n=$i+1
-        vdifnme=${workdir_even}/${experiment}_${st}_no0${scanname}_IF${n}.vdif
-        vdif_files=${vdif_files}${vdifnme}" "
-        if [ ! -f ${vdifnme} ];then
-            msg "Splitting the raw data for even IFs."
-            spif2file ${experiment} ${st} ${scan} ${nif} ${mode} ${skip} ${length} ${scanname} \
-		      ${flipIF} ${vbsdir} ${workdir_odd} ${workdir_even} ${online_process}
+	    	${flipIF} ${vbsdir} `tr ' ' ',' <<< "${if_dirs[*]}"` - ${online_process} ${byterange}
     	if [[ $? -eq 1 ]];then
     	    exit 1
     	fi
@@ -381,15 +697,17 @@ for scan in "${scans[@]}";do
     if [[ $? -eq 1 ]];then
         exit 1
     fi
+    if ! checkpoint_done split ${scanname}; then
+        checkpoint_record split ${scanname} ${vdif_files}
+    fi
     if [[ ${split_vdif_only} -eq 1 ]];then
         continue
     fi
     file_size=`ls -l ${vdifnme} | cut -d ' ' -f 5`
 
-    filfile=${experiment}_${st}_no0${scanname}_IFall_vdif_pol${pol}.fil
-
     if [[ ${file_size} -eq 0 ]]; then
 	touch ${outdir}/${filfile}
+	checkpoint_record fil ${scanname} ${outdir}/${filfile}
 	continue
     fi
     frame_size_split=`get_frame_size ${vdifnme}`
@@ -401,93 +719,51 @@ for scan in "${scans[@]}";do
     frames_per_second_per_band=`echo ${frames_per_second}/${nif} | bc | cut -d '.' -f1`
     nsec=`echo "${file_size}/${frame_size_split}/${frames_per_second_per_band}" | bc`
 
+    # a filterbank left over from an interrupted run is truncated to complete
+    # blocks and only the remainder of the scan is channelised and appended
+    scan_start=${start}
+    header_size=0
+    if [ -f ${outdir}/${filfile} ]; then
+        read done_sec header_size <<< `checkpoint.py resume ${outdir}/${filfile}`
+        if [[ ${header_size} -gt 0 ]]; then
+            msg "Resuming ${outdir}/${filfile} after ${done_sec}s."
+            scan_start=`echo "${start}+${done_sec}" | bc`
+            nsec=`echo "${nsec}-${done_sec}" | bc`
+        fi
+        if [[ `echo "${nsec} <= 0" | bc` -eq 1 ]]; then
+            # the previous run got to the end but did not record it
+            for filfifo in ${splice_list};do rm -rf $filfifo; done
+            checkpoint_record fil ${scanname} ${outdir}/${filfile}
+            finish_scan ${filfile} ${scanname} "" &
+            continue
+        fi
+    fi
+
     max_busy_slots=`echo ${njobs_splice}-${nif}-1 | bc`
     pwait $max_busy_slots
 
-    run_process_vdif $scanname "$ifs_odd" "$target" $experiment $st $freqLSB_0 $bw l $nchan $nsec $start \
-                     $station $njobs_splice $skip $workdir_odd $pol $digifil_nthreads $tscrunch ${fifodir} \
-		     $nbit $keepBP
+    finish_scan ${filfile} ${scanname} "${splice_list}" ${header_size} &
+    # size the fifo buffers according to the data rate before digifil starts writing,
+    # and report which IF holds up splice once the scan is done
+    pipe_buffer.py ${splice_list} --bw ${bw} --nchan ${nchan} --nbit ${nbit} --pol ${pol} \
+                   --tscrunch ${tscrunch} --buffer_sec ${fifo_buffer_sec} --pid $! &
+    sleep 0.5
+
+    # bind each IF's digifil to CPUs and memory of the NUMA node its scratch device is attached to,
+    # on cores the digifils of earlier scans that still run are not bound to
+    cpu_sets=''
+    if [[ ${pinCPUs} -gt 0 ]]; then
+        cpu_sets=`cpu_placement.py ${if_dirs[@]} --nthreads ${digifil_nthreads}`
+    fi
+    run_process_vdif $scanname "$ifs_odd" "$target" $experiment $st $freqLSB_0 $bw l $nchan $nsec $scan_start \
+                     $station $njobs_splice $skip "${if_dirs[*]}" $pol $digifil_nthreads $tscrunch ${fifodir} \
+		     $nbit $keepBP "${cpu_sets}" $coherentDD "${coherentDM}"
     # even IFs (i.e. USB)
 
-    run_process_vdif $scanname "$ifs_even" "$target" $experiment $st $freqUSB_0 $bw u $nchan $nsec $start \
-                     $station $njobs_splice $skip $workdir_even $pol $digifil_nthreads $tscrunch ${fifodir} \
-		     $nbit $keepBP
-
-    # increase the fifo buffer size to speed things up, but wait till splice is running first
-    sleep 2 && for filfifo in ${splice_list}; do \
-        setfifo ${filfifo} 1048576; \
-        sleep 0.2;done && msg "Changed fifo sizes successfuly." &
-    if [[ $submit2fetch -ne 0 ]]; then
-	if [[ $keepVDIF -eq 0 ]]; then
-	    splice ${splice_list} > ${outdir}/${filfile} && \
-		rm -rf ${workdir_even}/${experiment}_${st}_no0${scanname}_IF*.vdif \
-		   ${workdir_odd}/${experiment}_${st}_no0${scanname}_IF*.vdif && \
-		submit_fetch ${outdir}/${filfile} ${flagFile} && \
-		msg "Submitted ${outdir}/${filfile} ${flagFile} to fetch" && \
-		for filfifo in ${splice_list};do rm -rf $filfifo; done && \
-		msg "Fifos removed" &
-	else
-	    splice ${splice_list} > ${outdir}/${filfile} && \
-		submit_fetch ${outdir}/${filfile} ${flagFile} && \
-		msg "Submitted ${outdir}/${filfile} ${flagFile} to fetch" && \
-		for filfifo in ${splice_list};do rm -rf $filfifo; done && \
-		msg "Fifos removed" &
-	fi
-    else
-	if [[ $keepVDIF -eq 0 ]]; then
-	    splice ${splice_list} > ${outdir}/${filfile} && \
-		rm -rf ${workdir_even}/${experiment}_${st}_no0${scanname}_IF*.vdif \
-		   ${workdir_odd}/${experiment}_${st}_no0${scanname}_IF*.vdif && \
-		for filfifo in ${splice_list};do rm -rf $filfifo; done && \
-		msg "Fifos removed" &
-	else
-	    splice ${splice_list} > ${outdir}/${filfile} && \
-		for filfifo in ${splice_list};do rm -rf $filfifo; done && \
-		msg "Fifos removed" &
-	fi
-    fi
+    run_process_vdif $scanname "$ifs_even" "$target" $experiment $st $freqUSB_0 $bw u $nchan $nsec $scan_start \
+                     $station $njobs_splice $skip "${if_dirs[*]}" $pol $digifil_nthreads $tscrunch ${fifodir} \
+		     $nbit $keepBP "${cpu_sets}" $coherentDD "${coherentDM}"
     sleep 5
     #pwait $njobs_splice
 done # end scans
 wait < <(jobs -p)
-
-# in the current setup ${target} might contain Ra and Dec; remove that first and also remove
-# all whitespaces
-target=`echo ${target} | cut -d '-' -f1 | sed 's/ *$//'`
-
-# psrcat below will not throw an error on BSGR because it starts with B...
-# hence we exit here in case we are dealing with BSGR.
-if [[ ${target} == 'BSGR' ]];then
-    exit 0
-fi
-
-# in case we look at a pulsar fold it and create a plot
-psrcat -e ${target} > ${target}.psrcat.par
-if [ $? -eq 0 ];then
-    counter=-1
-    for scan in "${scans[@]}";do
-	let counter=${counter}+1
-	scanname=${scannames[${counter}]}
-	scan=`printf "%03g" ${scan}`
-	scanname=`printf "%03g" ${scanname}`
-        filfile=${experiment}_${st}_no0${scanname}_IFall_vdif_pol${pol}.fil
-        cmd="dspsr -E ${target}.psrcat.par -L 10 -A -k ${station} -d1 ${outdir}/${filfile} -O ${outdir}/${filfile} -t 8"
-	echo "running ${cmd}"
-	${cmd}
-	cmd="psrplot -pF -D /CPS -c x:unit=s ${outdir}/${filfile}.ar -j dedisperse,tscrunch,pscrunch,\"fscrunch 128\""
-	echo "running ${cmd}"
-	eval "${cmd}"
-        mv pgplot.ps ${outdir}/${filfile}.ps
-	if [[ ${pol} -eq 4 ]];then
-	    # in case we have full pol data, we create a plot with pol 0, pol 1, Stokes I, and Full Stokes
-	    cmd="psrplot -N 2x2 -D /CPS ${outdir}/${filfile}.ar -j tscrunch,dedisperse,\"fscrunch 128\" \\
-		    -p freq+ -c ':0:pol=0' \\
-		    -p freq+ -c ':1:pol=1' \\
-		    -p freq+ -c ':2:x:unit=ms' -j :2:pscrunch \\
-		    -p Scyl -j :3:fscrunch"
-	    echo "running ${cmd}"
-	    eval "${cmd}"
-	    mv pgplot.ps ${outdir}/${filfile}_fullPol.ps
-	fi
-    done
-fi
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+'''
+State records that make base2fil runs resumable. For each scan and stage
+(split, fil, fetch, fold) a small JSON record lists the output files of that
+stage with their size and checksum. A stage counts as done only if its record
+exists and all files still match it, such that a rerun of the same config
+skips finished scans, re-uses complete split files and redoes everything else.
+
+The checksum is computed over the file size and a fixed number of blocks
+spread over the file (always including the first and the last one), which
+catches truncated or partially rewritten files without reading tens of GB.
+Use --full for a checksum over the whole file.
+
+Partially written filterbanks can be resumed: they are truncated to the last
+complete time block and the number of seconds in there is printed, such that
+only the rest of the scan needs to be channelised and appended.
+'''
+import argparse
+import hashlib
+import json
+import os
+import struct
+import sys
+import time
+import filterbank
+
+SAMPLE_BLOCK = 2**20
+NSAMPLE_BLOCKS = 16
+
+
+def options():
+    parser = argparse.ArgumentParser(
+        description='Records, verifies and resumes the stages of base2fil for a scan.')
+    general = parser.add_argument_group('General info about the data.')
+    general.add_argument('action', type=str, choices=['record', 'verify', 'resume'],
+                         help='record: write the record for a finished stage. '+
+                         'verify: exit with 0 if the stage is done and its outputs are intact, 1 otherwise. '+
+                         'resume: truncate a partial filterbank to complete blocks and print '+
+                         'the number of seconds therein and the header size.')
+    general.add_argument('record', type=str,
+                         help='The state record (record, verify) or filterbank (resume).')
+    general.add_argument('files', type=str, nargs='*',
+                         help='Output files of the stage (record only).')
+    general.add_argument('--full', action='store_true',
+                         help='If set the checksum is computed over the whole file.')
+    general.add_argument('--block_sec', type=float, default=1.0,
+                         help='Length of the time blocks a partial filterbank is truncated '+
+                         'to (resume only). Default=%(default)s.')
+    return parser.parse_args()
+
+
+def checksum(filename, full=False):
+    '''
+    Returns the hex digest of filename. Unless full is set only NSAMPLE_BLOCKS
+    blocks of SAMPLE_BLOCK bytes evenly spread over the file are hashed.
+    '''
+    size = os.path.getsize(filename)
+    digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+    with open(filename, 'rb') as f:
+        if full or (size <= NSAMPLE_BLOCKS * SAMPLE_BLOCK):
+            for block in iter(lambda: f.read(16 * SAMPLE_BLOCK), b''):
+                digest.update(block)
+        else:
+            step = (size - SAMPLE_BLOCK) // (NSAMPLE_BLOCKS - 1)
+            for i in range(NSAMPLE_BLOCKS):
+                f.seek(i * step)
+                digest.update(f.read(SAMPLE_BLOCK))
+    return digest.hexdigest()
+
+
+def record(recordfile, files, full=False):
+    '''
+    Writes the state record recordfile for the given output files. The
+    record is written to a temporary name first, a crash never leaves a
+    partial record behind.
+    '''
+    state = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+             'full': full,
+             'files': [{'name': os.path.abspath(f),
+                        'size': os.path.getsize(f),
+                        'checksum': checksum(f, full)} for f in files]}
+    os.makedirs(os.path.dirname(os.path.abspath(recordfile)), exist_ok=True)
+    tmpfile = f'{recordfile}.{os.getpid()}.tmp'
+    with open(tmpfile, 'w') as f:
+        json.dump(state, f, indent=1)
+    os.replace(tmpfile, recordfile)
+    return state
+
+
+def verify(recordfile):
+    '''
+    Returns True if recordfile exists and all files listed therein still
+    have the recorded size and checksum.
+    '''
+    try:
+        with open(recordfile) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return False
+    for entry in state['files']:
+        if not os.path.isfile(entry['name']):
+            print(f'{entry["name"]} is missing.')
+            return False
+        if not os.path.getsize(entry['name']) == entry['size']:
+            print(f'{entry["name"]} has changed in size.')
+            return False
+        if not checksum(entry['name'], state['full']) == entry['checksum']:
+            print(f'{entry["name"]} has changed.')
+            return False
+    return True
+
+
+def resume(filename, block_sec=1.0):
+    '''
+    Truncates the partial filterbank filename to the last complete block of
+    block_sec seconds. Returns the number of seconds left in the file and the
+    size of the header, i.e. the number of bytes to strip off the output of a
+    resumed run before appending it. A file without a complete header or
+    block is removed and (0, 0) returned.
+    '''
+    try:
+        header, header_size = filterbank.read_header(filename)
+    except (OSError, struct.error, filterbank.Error):
+        if os.path.exists(filename):
+            os.remove(filename)
+        return 0.0, 0
+    nsamples = filterbank.get_nsamples(header, header_size, filename)
+    block = max(int(round(block_sec / header['tsamp'])), 1)
+    nsamples = (nsamples // block) * block
+    if nsamples == 0:
+        os.remove(filename)
+        return 0.0, 0
+    os.truncate(filename, header_size + nsamples * filterbank.get_bytes_per_spectrum(header))
+    return nsamples * header['tsamp'], header_size
+
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+    pass
+
+
+class InputError(Error):
+    """Exception raised for errors in the input.
+
+    Attributes:
+        message -- explanation of the error
+    """
+
+    def __init__(self, message):
+        self.message = message
+
+
+if __name__ == "__main__":
+    args = options()
+    if args.action == 'record':
+        record(args.record, args.files, args.full)
+    elif args.action == 'verify':
+        sys.exit(0 if verify(args.record) else 1)
+    else:
+        seconds, header_size = resume(args.record, args.block_sec)
+        print(f'{seconds:.9f} {header_size}')
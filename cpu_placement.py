@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+'''
+Decides on which CPUs and NUMA node the digifil of each IF runs. The CPUs of
+each NUMA node are read from sysfs, and each IF is put on the node that its
+scratch directory's block device is attached to (as far as that can be
+determined, e.g. for NVMe or SAS devices and RAIDs thereof) for as long as that
+node has free cores; the others are spread such that all nodes are equally
+loaded. Within a node, IFs get separate physical cores before hyperthread
+siblings are used. CPUs that digifils of earlier, still running scans are
+bound to count as taken, such that overlapping scans do not share cores.
+Helper threads (relays, readers) move off those CPUs with avoid_pinned().
+
+Prints one <cpulist>:<node> per IF, e.g. 0-3:0, which process_vdif takes as
+--cpus and --mem_node. The placement and the reasoning go to stderr.
+'''
+import argparse
+import glob
+import os
+import sys
+
+SYSFS = '/sys'
+PROC = '/proc'
+PINNED_PROGRAMS = ['digifil', 'dspsr']
+
+
+def options():
+    parser = argparse.ArgumentParser(
+        description='Assigns CPUs and a NUMA node to the digifil of each IF according '+
+        'to the topology of the machine and the location of the scratch devices.')
+    general = parser.add_argument_group('General info about the data.')
+    general.add_argument('dirs', type=str, nargs='+',
+                         help='Scratch directory of each IF, the first one is IF1.')
+    general.add_argument('--nthreads', type=int, default=1,
+                         help='Number of CPUs per IF, i.e. digifil threads. Default=%(default)s.')
+    general.add_argument('--ignore_running', action='store_true',
+                         help='If set the CPUs running digifils are bound to are considered free.')
+    return parser.parse_args()
+
+
+def parse_cpulist(cpulist):
+    '''
+    Returns the list of CPUs in a list like 0-3,8,10-11.
+    '''
+    cpus = []
+    for part in cpulist.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-')
+            cpus += list(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def format_cpulist(cpus):
+    '''
+    Returns the shortest list like 0-3,8 for the given CPUs.
+    '''
+    cpus = sorted(set(cpus))
+    parts = []
+    i = 0
+    while i < len(cpus):
+        j = i
+        while (j + 1 < len(cpus)) and (cpus[j + 1] == cpus[j] + 1):
+            j += 1
+        parts.append(f'{cpus[i]}' if i == j else f'{cpus[i]}-{cpus[j]}')
+        i = j + 1
+    return ','.join(parts)
+
+
+def _read(path, default=None):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return default
+
+
+def topology(sysfs=SYSFS):
+    '''
+    Returns a dictionary that maps each NUMA node to the CPUs of that node
+    this process may run on, ordered such that each physical core comes up
+    once before hyperthread siblings follow.
+    '''
+    allowed = os.sched_getaffinity(0)
+    nodes = {}
+    for nodedir in glob.glob(f'{sysfs}/devices/system/node/node[0-9]*'):
+        cpus = [c for c in parse_cpulist(_read(f'{nodedir}/cpulist', '')) if c in allowed]
+        if cpus:
+            nodes[int(os.path.basename(nodedir)[4:])] = cpus
+    if not nodes:
+        nodes = {0: sorted(allowed)}
+    for node, cpus in nodes.items():
+        rank = {}
+        for cpu in cpus:
+            siblings = parse_cpulist(_read(f'{sysfs}/devices/system/cpu/cpu{cpu}/topology/'+
+                                           'thread_siblings_list', str(cpu)))
+            rank[cpu] = (siblings.index(cpu) if cpu in siblings else 0, cpu)
+        nodes[node] = sorted(cpus, key=lambda c: rank[c])
+    return nodes
+
+
+def _block_device_node(devdir, sysfs=SYSFS, depth=0):
+    '''
+    Returns the NUMA node of the block device in sysfs directory devdir, or
+    of the majority of the devices it is built from (RAID, LVM), or None.
+    '''
+    slaves = glob.glob(f'{devdir}/slaves/*')
+    if slaves and depth < 8:
+        found = [_block_device_node(os.path.realpath(s), sysfs, depth + 1) for s in slaves]
+        found = [n for n in found if n is not None]
+        return max(set(found), key=found.count) if found else None
+    path = devdir
+    while path.startswith(f'{sysfs}/devices') and (path != f'{sysfs}/devices'):
+        node = _read(f'{path}/numa_node')
+        if node is not None:
+            return int(node) if int(node) >= 0 else None
+        path = os.path.dirname(path)
+    return None
+
+
+def directory_node(directory, sysfs=SYSFS):
+    '''
+    Returns the NUMA node the block device that holds directory is attached
+    to, or None if unknown (e.g. single node machines, network file systems).
+    '''
+    dev = os.stat(directory).st_dev
+    devdir = os.path.realpath(f'{sysfs}/dev/block/{os.major(dev)}:{os.minor(dev)}')
+    if not os.path.exists(devdir):
+        return None
+    # for a partition the whole disk carries the slaves
+    if os.path.exists(f'{devdir}/partition'):
+        return _block_device_node(os.path.dirname(devdir), sysfs)
+    return _block_device_node(devdir, sysfs)
+
+
+def running_cpus(programs=PINNED_PROGRAMS, proc=PROC):
+    '''
+    Returns a dictionary that maps CPUs to the number of running programs
+    (by process name) bound to them. Processes that may run on every CPU
+    this process may run on are not bound and left out.
+    '''
+    allowed = os.sched_getaffinity(os.getpid())
+    running = {}
+    for piddir in glob.glob(f'{proc}/[0-9]*'):
+        if not _read(f'{piddir}/comm') in programs:
+            continue
+        status = _read(f'{piddir}/status', '')
+        cpulist = [line.split(':', 1)[1] for line in status.split('\n')
+                   if line.startswith('Cpus_allowed_list:')]
+        if not cpulist:
+            continue
+        cpus = set(parse_cpulist(cpulist[0]))
+        if allowed <= cpus:
+            continue
+        for cpu in cpus:
+            running[cpu] = running.get(cpu, 0) + 1
+    return running
+
+
+def avoid_pinned(programs=PINNED_PROGRAMS, proc=PROC):
+    '''
+    Restricts the calling thread to the CPUs no running digifil is bound to,
+    as long as that leaves any. Meant for threads that mostly move data, they
+    would otherwise take turns with digifil on its cores. Returns the CPUs
+    the thread may run on.
+    '''
+    allowed = os.sched_getaffinity(0)
+    if not hasattr(os, 'sched_setaffinity'):
+        return allowed
+    spare = allowed - set(running_cpus(programs, proc))
+    if spare and not spare == allowed:
+        try:
+            # on Linux this applies to the calling thread only
+            os.sched_setaffinity(0, spare)
+            return spare
+        except OSError:
+            pass
+    return allowed
+
+
+def place(preferred, nodes, nthreads=1, running=None):
+    '''
+    Returns a list of (cpus, node) for each IF. preferred holds the node
+    local to each IF's data or None, nodes maps the nodes to their CPUs as
+    returned by topology(), running the CPUs already taken as returned by
+    running_cpus().
+    '''
+    taken = dict(running or {})
+    load = {node: sum(taken.get(cpu, 0) for cpu in nodes[node]) for node in nodes}
+    assignment = [None] * len(preferred)
+    # first the IFs whose data are local to a node, as long as it has free CPUs
+    for i, node in enumerate(preferred):
+        if (node in nodes) and (load[node] + nthreads <= len(nodes[node])):
+            assignment[i] = node
+            load[node] += nthreads
+    # then everything else on the node with the smallest fraction of CPUs in use
+    for i in range(len(preferred)):
+        if assignment[i] is None:
+            node = min(nodes, key=lambda n: ((load[n] + nthreads) / len(nodes[n]), n))
+            assignment[i] = node
+            load[node] += nthreads
+    placement = []
+    for node in assignment:
+        cpus = []
+        for k in range(nthreads):
+            # the least taken CPU, in topology order; with more threads than CPUs they share
+            cpu = min(nodes[node], key=lambda c: taken.get(c, 0))
+            taken[cpu] = taken.get(cpu, 0) + 1
+            cpus.append(cpu)
+        placement.append((cpus, node))
+    return placement
+
+
+if __name__ == "__main__":
+    args = options()
+    nodes = topology()
+    preferred = [directory_node(d) for d in args.dirs]
+    running = {} if args.ignore_running else running_cpus()
+    placement = place(preferred, nodes, args.nthreads, running)
+    print(f'{len(nodes)} NUMA node(s): ' +
+          ', '.join(f'node {n}: {format_cpulist(c)}' for n, c in sorted(nodes.items())), file=sys.stderr)
+    if running:
+        print(f'Taken by running digifils: {format_cpulist(running)}', file=sys.stderr)
+    for i, ((cpus, node), local) in enumerate(zip(placement, preferred)):
+        origin = 'data local' if local == node else ('data on node '+str(local) if local is not None
+                                                     else 'data location unknown')
+        print(f'IF{i+1}: cpus {format_cpulist(cpus)} on node {node} ({origin})', file=sys.stderr)
+        print(f'{format_cpulist(cpus)}:{node}')
@@ -1,9 +1,12 @@
 #!/usr/bin/env python3
 import argparse #Makes it easy to write user-friendly command-line interfaces.
-from astropy.time import Time
+from concurrent.futures import ProcessPoolExecutor
+import glob
+import json
 import os
-import pandas as pd #Helps cleaning, transforming, manipulating and analyzing data.
-                    #Works very efficient with small data (usually from 100MB up to 1GB).
+import re
+import query_server
+from vlbi_time import yday2mjd
 
 
 def options():
@@ -15,14 +18,16 @@ def options():
                          'from the SCHED section in the vexfile. The dataframe ' \
                          'will be created (and looked for) in the directory where ' \
                          'where the vexfile lives. It will be named <vexfile>.df.')
-    general.add_argument('-s', '--source', type=str, required=True,
-                         help='REQUIRED. Source for which data are to be analysed.')
-    general.add_argument('-t', '--telescope', type=str, required=True,
+    general.add_argument('-s', '--source', type=str, required=True, nargs='+',
+                         help='REQUIRED. Source(s) for which data are to be analysed. \'all\' '\
+                         'will create configs for all sources in the schedule.')
+    general.add_argument('-t', '--telescope', type=str, required=True, nargs='+',
                          choices=['o8', 'o6', 'sr', 'wb', 'ef', 'tr', 't6', \
                                   'ir', 'ib', 'mc', 'nt', 'ur', 'bd', 'sv', 'onsala85', 'onsala60', 'srt',\
                                   'wsrt', 'effelsberg', 'torun', 'tianma', 'irbene', 'irbene16',\
-                                  'medicina', 'noto', 'urumqi', 'badary', 'svetloe'],
-                         help='REQUIRED. Station name or 2-letter code of dish to be searched.')
+                                  'medicina', 'noto', 'urumqi', 'badary', 'svetloe', 'all'],
+                         help='REQUIRED. Station name(s) or 2-letter code(s) of dish(es) to be '\
+                         'searched. \'all\' will create configs for all stations in the schedule.')
     general.add_argument('-S', '--scans', nargs='+', default=None, type=str,
                          help='Optional list of scans to be searched. By default will ' \
                          'return all scans. Scan numbers with or without leading zeros. Can be'\
@@ -37,7 +42,16 @@ def options():
                          'created in current working directory and will be named ' \
                          '<experiment>_<station>_<source>.conf[_<mode>], where ' \
                          '_<mode> will only be appended in case there a multiple '\
-                         'frequency setups.')
+                         'frequency setups. Ignored if there is more than one source or station.')
+    general.add_argument('--outdir', type=str, default=None,
+                         help='Directory for the config files if there is more than one source '\
+                         'or station. Default is the current working directory.')
+    general.add_argument('--manifest', type=str, default=None,
+                         help='If set will write a JSON list of all configs created (with experiment, '\
+                         'source, station, mode, number of IFs and scans) to this file. '\
+                         'scan_queue.py submit takes it as input.')
+    general.add_argument('--ncpus', type=int, default=1,
+                         help='Number of configs to create in parallel. Default=%(default)s.')
     general.add_argument('-T', '--template', type=str, default=None,
                          help='Template config file that contains parameters beyond '\
                          'those taken care of here. Existing parameters that this '\
@@ -53,7 +67,15 @@ def options():
                          'filterbanks have been created. By default those are removed.')
     general.add_argument('-F', '--flag', type=str, default=None,
                          help='Path to a flag file to be used by Heimdall and Fetch in the'\
-                         'searches. Defaults are set in greenburst.')
+                         'searches. Defaults are set in greenburst. With several stations each '\
+                         'gets its own, named <station>.<name> (a station code in front of name '\
+                         'is replaced).')
+    general.add_argument('--autoflag', action='store_true',
+                         help='If set and the flag file does not exist yet, base2fil will '\
+                         'compute it from the first filterbank with rfi_flag.py.')
+    general.add_argument('--coherent', type=float, nargs='?', const=0.0, default=None,
+                         help='If set digifil coherently dedisperses to this DM. Without a value '\
+                         'the DM of the source is taken from dm_utils (FRBs and psrcat).')
     general.add_argument('--nbit', default=None, type=int, choices=[2, 8, 16, -32],
                          help='Sets the number of bits of the output filterbanks. ' +
                          'Choices are [2, 8, 16, -32], where -32 is 32bit floating point. '+
@@ -71,12 +93,17 @@ def options():
     general.add_argument('--evlbi', action='store_true',
                          help='Use if the recordings are evlbi. In that case the minimum gaps between scans ' +
                          'for a separate recording to start is computed differently compared to standard disk recording.')
+    general.add_argument('--gapmaps', type=str, default=None,
+                         help='Directory with gap maps (<recording>.gapmap.json) as created by '\
+                         'vdif_scan.py. If set, scans are located in the recordings by the time '\
+                         'stamps in the frame headers: skips and lengths are exact to a frame, the '\
+                         'byte ranges go into the config and scans without any valid data are dropped.')
     general.add_argument('--debug', action='store_true',
                          help='If set will raise errors to explain what went wrong instead '\
                          'of just saying that something did not work.')
-    general.add_argument('--mode', type=str, default=None,
+    general.add_argument('--mode', type=str, default=None, nargs='+',
                          help='For some experiments we have several setups for the same dish -- different modes. If set '+
-                         'this will generate the config for this mode only. Otherwise it will generate the same for all modes.')
+                         'this will generate the config for these modes only. Otherwise it will generate the same for all modes.')
     general.add_argument('--split_only', action='store_true',
                          help='If set will only split the baseband data into subbands and skip the filterbank stage.')
     general.add_argument('--online', action='store_true',
@@ -188,6 +215,8 @@ def sched2df(vexdic, add2db=False):
     Takes a dictionary with key 'SCHED' that contains all lines from the 'SCHED' section.
     Returns a pandas dataframe with all the scans and their info.
     '''
+    # pandas is imported where needed only, it takes longer to load than most runs take
+    import pandas as pd
     lines = vexdic['SCHED']
     columns = ['scanNo', 't_startMJD', 'gap2previous_sec', 'length_sec',
                'missing_sec', 'fmode', 'source', 'station']
@@ -216,7 +245,7 @@ def sched2df(vexdic, add2db=False):
                                                .replace('h',':')\
                                                .replace('m',':')\
                                                .replace('s','')
-                    start = Time(start, format='yday', scale='utc').mjd
+                    start = yday2mjd(start)
                     if first_scan:
                         gap2previous = 0
                     else:
@@ -251,11 +280,18 @@ def sched2df(vexdic, add2db=False):
     return scans
 
 
-def getScanList(df, source, station, mode, scans=None, evlbi=False):
+def getScanList(df, source, station, mode, scans=None, evlbi=False, gapmaps=None):
     '''
     For source, station and mode in vexfile,
-    returns three lists: scanNo's, number of seconds to skip
-    at the beginning of the scan, and number of secodns to process.
+    returns five lists: scanNo's, number of seconds to skip
+    at the beginning of the scan, number of secodns to process, the scan names
+    and the byte ranges ('start:stop', or '-' if not known) in the recordings.
+    If gapmaps (a dictionary of gap maps keyed by the scan number of the
+    recording, see loadGapMaps) is given, each scan is located by the time
+    stamps in the frame headers (see headerWindow): skips and lengths are exact
+    to a frame and the byte range is known. Scans in recordings without a gap
+    map are located by the gaps in the schedule and trimmed to the valid data
+    if their recording has a gap map. Scans without valid data are dropped.
     '''
     station = fixStationName(station).capitalize()
     ddf = df[(df.source == source) &
@@ -317,7 +353,91 @@ def getScanList(df, source, station, mode, scans=None, evlbi=False):
     scanNames = [f'{scan:03d}' for scan in list(ddf.scanNo.values)]
     if not len(start_scans) == len(skip_secs) == len(scan_lengths) == len(scanNames):
         raise RunError('Not the same number of scans, seconds to skip and scan lengths.')
-    return start_scans, skip_secs, scan_lengths, scanNames
+    byteranges = ['-'] * len(scanNames)
+    if gapmaps:
+        import vdif_scan
+        keep = []
+        for i, start_scan in enumerate(start_scans):
+            located = headerWindow(df, scanNos[i], station, gapmaps)
+            if located is not None:
+                recording, window = located
+                if window is None:
+                    print(f'No valid data for scan {scanNames[i]} in recording {recording:03d}, dropping it.')
+                    continue
+                start_scans[i] = f'{recording:03d}'
+                skip_secs[i], scan_lengths[i], byteranges[i] = window
+                keep.append(i)
+                continue
+            gapmap = gapmaps.get(int(start_scan))
+            if gapmap is None:
+                keep.append(i)
+                continue
+            trimmed = vdif_scan.trim(gapmap, skip_secs[i], scan_lengths[i])
+            if trimmed is None:
+                print(f'No valid data for scan {scanNames[i]} in recording {start_scan}, dropping it.')
+                continue
+            skip_secs[i], scan_lengths[i] = trimmed
+            keep.append(i)
+        start_scans = [start_scans[i] for i in keep]
+        skip_secs = [skip_secs[i] for i in keep]
+        scan_lengths = [scan_lengths[i] for i in keep]
+        scanNames = [scanNames[i] for i in keep]
+        byteranges = [byteranges[i] for i in keep]
+        if not scanNames:
+            raise InputError(f'No valid data found for station: {station}, mode: {mode}, source: {source}.')
+    return start_scans, skip_secs, scan_lengths, scanNames, byteranges
+
+
+def headerWindow(df, scanNo, station, gapmaps):
+    '''
+    Locates scan scanNo of station in the recordings with gap maps by the
+    time stamps of their frame headers, instead of by the gaps in the
+    schedule. The data of the scan run from its scheduled start plus the
+    missing seconds to its scheduled stop. Returns None if no recording
+    covers the scan, otherwise the scan number of the recording and either
+    None (no valid data) or the skip and length in seconds and the byte
+    range 'start:stop' of the whole frames of valid data.
+    '''
+    import vdif_scan
+    row = df[(df.scanNo == scanNo) & (df.station == station)]
+    t_start = row.t_startMJD.item() + row.missing_sec.item() / 86400.
+    t_stop = row.t_startMJD.item() + row.length_sec.item() / 86400.
+    best = None
+    for recording, gapmap in gapmaps.items():
+        start_mjd = vdif_scan.recording_start_mjd(gapmap, t_start)
+        if (start_mjd is None) or not gapmap['segments']:
+            continue
+        # scheduled times and the time origin of recordings are whole seconds
+        t0 = round((t_start - start_mjd) * 86400., 3)
+        t1 = round((t_stop - start_mjd) * 86400., 3)
+        overlap = min(t1, gapmap['segments'][-1][3]) - max(t0, gapmap['segments'][0][2])
+        if (overlap > 0) and ((best is None) or (overlap > best[0])):
+            best = (overlap, recording, gapmap, t0, t1)
+    if best is None:
+        return None
+    _, recording, gapmap, t0, t1 = best
+    frames = vdif_scan.frame_range(gapmap, t0, t1)
+    if frames is None:
+        return recording, None
+    first_frame, stop_frame, t_first, t_last = frames
+    return recording, (t_first, t_last - t_first,
+                       f'{first_frame * gapmap["frame_size"]}:{stop_frame * gapmap["frame_size"]}')
+
+
+def loadGapMaps(gapmap_dir, experiment, station):
+    '''
+    Loads all gap maps in gapmap_dir of the recordings of experiment and station.
+    Returns a dictionary keyed by the scan number of the recording.
+    '''
+    import vdif_scan
+    station = fixStationName(station)
+    gapmaps = {}
+    pattern = re.compile(f'{experiment.lower()}_{station}_no0*(\\d+){re.escape(vdif_scan.GAPMAP_SUFFIX)}$')
+    for gapmap_file in glob.glob(f'{gapmap_dir}/*{vdif_scan.GAPMAP_SUFFIX}'):
+        match = pattern.match(os.path.basename(gapmap_file))
+        if match:
+            gapmaps[int(match.group(1))] = vdif_scan.load_gapmap(gapmap_file)
+    return gapmaps
 
 class Error(Exception):
     """Base class for exceptions in this module."""
@@ -350,12 +470,15 @@ def writeConfig(outfile, experiment, source, station,
                 scans, skips, lengths, scanNames, recFmt,
                 template=None, search=False, njobs=20, flipIF=False,
                 keepVDIF=False, flagfile=None, nbit=None, keepBP=False,
-                pol=None, split_only=False, online=False, nbits=2):
+                pol=None, split_only=False, online=False, nbits=2, autoflag=False,
+                coherentDM=None, byteranges=None):
     conf = []
     scans = list2BashArray(scans)
     skips = list2BashArray(skips)
     lengths = list2BashArray(lengths)
     scanNames = list2BashArray(scanNames)
+    if byteranges is not None and all(r == '-' for r in byteranges):
+        byteranges = None
     station = fixStationName(station, short=False)
     conf.append(f'experiment={experiment.lower()}\n')
     conf.append(f'target=\"{source} --ra {ra} --dec={dec}\"\n')
@@ -364,6 +487,8 @@ def writeConfig(outfile, experiment, source, station,
     conf.append(f'skips={skips}\n')
     conf.append(f'lengths={lengths}\n')
     conf.append(f'scannames={scanNames}\n')
+    if not byteranges == None:
+        conf.append(f'byteranges={list2BashArray(byteranges)}\n')
     conf.append(f'freqLSB_0={fref-bw/2}\n')
     conf.append(f'bw={bw}\n')
     conf.append(f'nif={nIF}\n')
@@ -382,6 +507,8 @@ def writeConfig(outfile, experiment, source, station,
         conf.append(f'keepBP=1\n')
     if not flagfile == None:
         conf.append(f'flagFile={flagfile}\n')
+    if autoflag:
+        conf.append(f'autoFlag=1\n')
     if not nbit == None:
         conf.append(f'nbit={nbit}\n')
     if not pol == None:
@@ -392,6 +519,9 @@ def writeConfig(outfile, experiment, source, station,
         conf.append(f'online_process=1\n')
     if not nbits == 2:
         conf.append(f'nbits={nbits}\n')
+    if not coherentDM == None:
+        conf.append(f'coherentDD=1\n')
+        conf.append(f'coherentDM={coherentDM}\n')
     conf.append('\n')
     if not template == None:
         if not os.path.exists(template):
@@ -401,7 +531,7 @@ def writeConfig(outfile, experiment, source, station,
         f.close()
         params = ['experiment', 'target', 'scans', 'skips',
                   'lengths', 'freqLSB_0', 'bw', 'nif', 'njobs_parallel',
-                  'nchan', 'tscrunch', 'station', 'scannames', 'isMark5b']
+                  'nchan', 'tscrunch', 'station', 'scannames', 'isMark5b', 'byteranges']
         if search:
             params.append('submit2fetch')
         if flipIF:
@@ -416,10 +546,14 @@ def writeConfig(outfile, experiment, source, station,
             params.append('online_process')
         if not flagfile == None:
             params.append('flagFile')
+        if autoflag:
+            params.append('autoFlag')
         if not nbit == None:
             params.append('nbit')
         if not pol == None:
             params.append('pol')
+        if not coherentDM == None:
+            params += ['coherentDD', 'coherentDM']
         # we overwrite existing parameters
         delLines = [i for param in params for i,line in enumerate(templ) if param in line]
         templ = [line for i,line in enumerate(templ) if i not in delLines]
@@ -467,62 +601,99 @@ def fixStationName(station, short=True):
     else:
         return station if short else longnames[shortnames.index(station)]
 
-def main(args):
-    vexfile = os.path.abspath(args.vexfile)
-    vex = vex2dic(vexfile)
-    # per default we expect the dataframe to be in the same dir
-    # as the vexfile. If it's not there we create it such that
-    # we can re-use it again later.
-    sched_dir = os.path.dirname(vexfile)
-    vexfile_name = os.path.basename(vexfile)
-    df_file = f'{sched_dir}/{vexfile_name}.df'
-    if not os.path.exists(df_file):
-        df = sched2df(vex)
-        df.to_pickle(df_file)
-    else:
-        df = pd.read_pickle(df_file)
-    experiment = getExperimentName(vex)
-    print(f'Found experiment {experiment}.')
-    fmodes = list(df.fmode.unique())
-    print(f'There are {len(fmodes)} frequency modes: {fmodes}')
-    if not args.mode == None:
-        fmodes = [args.mode]
-        print(f'Will generate config only for mode {fmodes}')
-    source = args.source.replace('_D','').upper()
-    station = args.telescope
-    nchan = args.nchan
-    downsamp = args.downsamp
-    outfile = args.outfile
-    template = args.template
+def stationFlagFile(flagfile, station):
+    '''
+    Returns the flag file of station for flagfile: a station code in front
+    of the name (<station>.flag_..., as submit_job.py names them) is replaced
+    by station, otherwise station is put in front.
+    '''
+    directory, name = os.path.split(flagfile)
+    prefix, dot, rest = name.partition('.')
+    try:
+        fixStationName(prefix)
+        if dot:
+            name = rest
+    except InputError:
+        pass
+    return os.path.join(directory, f'{station}.{name}')
+
+def loadSchedule(vexfile):
+    '''
+    Parses vexfile and returns the dictionary of its sections, the schedule as
+    a dataframe and the name of the experiment. Per default we expect the
+    dataframe to be in the same dir as the vexfile. If it's not there we
+    create it such that we can re-use it again later. A running query_server
+    keeps all of it until vexfile changes.
+    '''
+    vexfile = os.path.abspath(vexfile)
+
+    def load():
+        vex = vex2dic(vexfile)
+        df_file = f'{vexfile}.df'
+        if not os.path.exists(df_file):
+            df = sched2df(vex)
+            df.to_pickle(df_file)
+        else:
+            import pandas as pd
+            df = pd.read_pickle(df_file)
+        return vex, df, getExperimentName(vex)
+    return query_server.cached(('schedule', vexfile), [vexfile], load)
+
+
+def expandMatrix(df, sources, stations):
+    '''
+    Returns the lists of sources and 2-letter station codes to create configs
+    for, where 'all' stands for everything in the schedule.
+    '''
+    if 'all' in [s.lower() for s in sources]:
+        sources = list(df.source.unique())
+    sources = [s.replace('_D','').upper() for s in sources]
+    if 'all' in stations:
+        stations = []
+        for station in df.station.unique():
+            try:
+                stations.append(fixStationName(station))
+            except InputError:
+                print(f'Station {station} not recognized, skipping it.')
+    return sources, stations
+
+
+def writeConfigs(vex, df, experiment, source, station, fmodes, outfile, args, flagfile=None):
+    '''
+    Writes the configs for source and station in each of fmodes. Unless
+    outfile is set, they are named <experiment>_<station>_<source>.conf,
+    with _<mode> appended in case there are several modes or a mode was asked
+    for. Returns a list with one dictionary per config written.
+    '''
     debug = args.debug
-    search = args.search
-    keepVDIF = args.keepVDIF
-    njobs = args.njobs
-    online = args.online
-    flagfile = args.flag
-    if not flagfile == None:
-        flagfile = os.path.abspath(args.flag)
-        if not os.path.exists(flagfile):
-            print(f'Flag file {flagfile} does not exist. Ignoring it.')
-            flagfile = None
+    written = []
     try:
         ra, dec = getSourceCoords(vex, source)
     except:
         if debug:
             ra, dec = getSourceCoords(vex, source)
         print(f'Could not get RA and Dec for {source}. Maybe not in observations? Check with obsinfo.py.')
-        quit()
+        return written
+    gapmaps = None
+    if not args.gapmaps == None:
+        gapmaps = loadGapMaps(args.gapmaps, experiment, station)
+        print(f'Loaded {len(gapmaps)} gap maps from {args.gapmaps}.')
+    coherentDM = None
+    if args.coherent is not None:
+        coherentDM = args.coherent
+        if coherentDM <= 0.0:
+            import dm_utils
+            coherentDM = dm_utils.get_dm(source)
+        if coherentDM is None:
+            print(f'No DM known for {source}, its data will be dedispersed incoherently.')
+        else:
+            print(f'{source} will be coherently dedispersed to DM {coherentDM}.')
+    add_mode = (len(fmodes) > 1) or ((args.mode is not None) and (outfile is None))
     if outfile is None:
-        outdir = os.getcwd()
+        outdir = os.getcwd() if args.outdir is None else os.path.abspath(args.outdir)
         outfile = f'{outdir}/{experiment}_{station}_{source}.conf'
-    first = True
-    for i, fmode in enumerate(fmodes):
-        if ((len(fmodes) > 1) or (args.mode is not None)) and (outfile is None):
-            if first:
-                outfile = f'{outfile}_{fmode}'
-                first = False
-            else:
-                outfile = outfile.replace(fmodes[i-1], fmode)
+    for fmode in fmodes:
+        modefile = f'{outfile}_{fmode}' if add_mode else outfile
         try:
             fref, bw, nIF, flipIF, recFmt, nbits = getFreq(vex, station, fmode)
         except:
@@ -531,37 +702,95 @@ def main(args):
             print(f'No setup for station {station} in mode {fmode}.')
             continue
         try:
-            scans, skips, lengths, scanNames = getScanList(df, source,
-                                                           station, fmode,
-                                                           scans=args.scans,
-                                                           evlbi=args.evlbi)
+            scans, skips, lengths, scanNames, byteranges = getScanList(df, source,
+                                                                       station, fmode,
+                                                                       scans=args.scans,
+                                                                       evlbi=args.evlbi,
+                                                                       gapmaps=gapmaps)
         except:
             if debug:
-                scans, skips, lengths, scanNames = getScanList(df, source,
-                                                               station, fmode,
-                                                               scans=args.scans,
-                                                               evlbi=args.evlbi)
+                scans, skips, lengths, scanNames, byteranges = getScanList(df, source,
+                                                                           station, fmode,
+                                                                           scans=args.scans,
+                                                                           evlbi=args.evlbi,
+                                                                           gapmaps=gapmaps)
             print(f'Found no data for {source} for {station} in {fmode}.')
             continue
         try:
-            writeConfig(outfile, experiment, source, station, ra, dec,
-                        fref, bw, nIF, nchan, downsamp, scans, skips, lengths,
-                        scanNames, recFmt, template, search, njobs, flipIF, keepVDIF,
-                        flagfile, args.nbit, args.keepBP, args.pol, args.split_only,
-                        online, nbits)
-            print(f'Successfully written {outfile}.')
+            writeConfig(modefile, experiment, source, station, ra, dec,
+                        fref, bw, nIF, args.nchan, args.downsamp, scans, skips, lengths,
+                        scanNames, recFmt, args.template, args.search, args.njobs, flipIF,
+                        args.keepVDIF, flagfile, args.nbit, args.keepBP, args.pol, args.split_only,
+                        args.online, nbits, args.autoflag, coherentDM, byteranges)
+            print(f'Successfully written {modefile}.')
+            written.append({'config': modefile, 'experiment': experiment.lower(),
+                            'source': source, 'station': station, 'mode': fmode,
+                            'nif': int(nIF), 'scans': [str(s) for s in scanNames]})
         except:
             if debug:
-                writeConfig(outfile, experiment, source, station, ra, dec,
-                            fref, bw, nIF, nchan, downsamp, scans, skips, lengths,
-                            scanNames, recFmt, template, search, njobs, flipIF, keepVDIF,
-                            flagfile, args.nbit, args.keepBP, args.pol, args.split_only,
-                            online, nbits)
+                writeConfig(modefile, experiment, source, station, ra, dec,
+                            fref, bw, nIF, args.nchan, args.downsamp, scans, skips, lengths,
+                            scanNames, recFmt, args.template, args.search, args.njobs, flipIF,
+                            args.keepVDIF, flagfile, args.nbit, args.keepBP, args.pol, args.split_only,
+                            args.online, nbits, args.autoflag, coherentDM, byteranges)
             print(f'Could not create config file for {source} observed with {station} in {fmode}.')
-        print(f'With this setup your frequency and time resolution will be {bw/nchan} MHz and {1/(bw*1e6)*nchan*downsamp*1e3} ms.')
-    return
+            continue
+        print(f'With this setup your frequency and time resolution will be {bw/args.nchan} MHz and '+
+              f'{1/(bw*1e6)*args.nchan*args.downsamp*1e3} ms.')
+    return written
 
 
+def main(args):
+    # the vex file and schedule are parsed once, no matter how many configs we create
+    vex, df, experiment = loadSchedule(args.vexfile)
+    print(f'Found experiment {experiment}.')
+    fmodes = list(df.fmode.unique())
+    print(f'There are {len(fmodes)} frequency modes: {fmodes}')
+    if not args.mode == None:
+        fmodes = args.mode
+        print(f'Will generate config only for mode {fmodes}')
+    sources, stations = expandMatrix(df, args.source, args.telescope)
+    # with several stations each gets its own flag file
+    flagfiles = {}
+    for station in stations:
+        flagfile = args.flag
+        if not flagfile == None:
+            flagfile = os.path.abspath(args.flag)
+            if len(stations) > 1:
+                flagfile = stationFlagFile(flagfile, station)
+            if not os.path.exists(flagfile):
+                if args.autoflag:
+                    print(f'Flag file {flagfile} does not exist yet. It will be computed from the data.')
+                else:
+                    print(f'Flag file {flagfile} does not exist. Ignoring it.')
+                    flagfile = None
+        flagfiles[station] = flagfile
+    outfile = args.outfile
+    if (len(sources) > 1) or (len(stations) > 1):
+        outfile = None
+        if not args.outdir == None:
+            os.makedirs(args.outdir, exist_ok=True)
+    written = []
+    if args.ncpus > 1:
+        with ProcessPoolExecutor(max_workers=args.ncpus) as pool:
+            jobs = [pool.submit(writeConfigs, vex, df, experiment, source, station, fmodes,
+                                outfile, args, flagfiles[station])
+                    for source in sources for station in stations]
+            for job in jobs:
+                written += job.result()
+    else:
+        for source in sources:
+            for station in stations:
+                written += writeConfigs(vex, df, experiment, source, station, fmodes,
+                                        outfile, args, flagfiles[station])
+    print(f'Created {len(written)} config files.')
+    if not args.manifest == None:
+        with open(args.manifest, 'w') as f:
+            json.dump(written, f, indent=1)
+        print(f'Manifest written to {args.manifest}.')
+    return
+
 if __name__ == "__main__":
-    args = options()
-    main(args)
+    if not query_server.forward('create_config'):
+        args = options()
+        main(args)
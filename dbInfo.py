@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 import argparse
-import pandas as pd
-import numpy as np
+import os
+import query_server
+from addVex2db import aggregate, load_aggregates, merge
 
 
 def options():
@@ -43,25 +44,9 @@ choices = ['o8', 'o6', 'sr', 'wb', 'ef', 'tr',
            'medicina', 'noto'],
 
 
-# function which can take overlap into account between scans
-# taken from Mark Snelders
-def merge(times):
-    """ Function which reduces the overlap between a list of tuples
-    Example [(1, 3), (2, 4), (7, 8)] ---> [(1, 4), (7, 8)]
-    Use: unique_times = list(merge(times)) """
-    saved = list(times[0])
-    for st, en in sorted([sorted(t) for t in times]):
-        if st <= saved[1]:
-            saved[1] = max(saved[1], en)
-        else:
-            yield tuple(saved)
-            saved[0] = st
-            saved[1] = en
-    yield tuple(saved)
-
-
 def main(args):
-    df = pd.read_pickle(args.dbfile)
+    import pandas as pd
+    dbfile = os.path.abspath(args.dbfile)
     stations = args.telescopes
     source = args.source
     exps = args.experiments
@@ -70,9 +55,36 @@ def main(args):
     freq_min = args.freq_min
     freq_max = args.freq_max
 
-    revert_stations_to_none = True
+    if mjd_min == mjd_max == freq_min == freq_max == None:
+        # everything else is answered from the aggregates addVex2db keeps per
+        # experiment, station and source
+        df = query_server.cached(('vexdb-agg', dbfile), [dbfile, f'{dbfile}.agg'],
+                                 lambda: load_aggregates(dbfile))
+    else:
+        # ad-hoc filters need the individual scans
+        df = query_server.cached(('vexdb', dbfile), [dbfile], lambda: pd.read_pickle(dbfile))
+        if mjd_min is not None:
+            df = df[(df.t_startMJD >= mjd_min)]
+            if df.empty:
+                print(f'No data after {mjd_min}.')
+                quit(1)
+        if mjd_max is not None:
+            df = df[(df.t_startMJD <= mjd_max)]
+            if df.empty:
+                print(f'No data before {mjd_max}.')
+                quit(1)
+        if freq_max is not None:
+            df = df[(df.RefFreq_MHz <= freq_max)]
+            if df.empty:
+                print(f'No data below {freq_max} MHz.')
+                quit(1)
+        if freq_min is not None:
+            df = df[(df.RefFreq_MHz >= freq_min)]
+            if df.empty:
+                print(f'No data above {freq_min} MHz.')
+                quit(1)
+        df = aggregate(df)
     if stations is not None:
-        revert_stations_to_none = False
         df = df[(df.station.isin(stations))]
         if df.empty:
             print(f'No data for stations {stations}.')
@@ -82,79 +94,44 @@ def main(args):
         if df.empty:
             print(f'No data for source {source}.')
             quit(1)
-            #return df.length_sec.sum() - df.missing_sec.sum()
-    if mjd_min is not None:
-        df = df[(df.t_startMJD >= mjd_min)]
-        if df.empty:
-            print(f'No data after {mjd_min}.')
-            quit(1)
-    if mjd_max is not None:
-        df = df[(df.t_startMJD <= mjd_max)]
-        if df.empty:
-            print(f'No data before {mjd_max}.')
-            quit(1)
-    if freq_max is not None:
-        df = df[(df.RefFreq_MHz <= freq_max)]
-        if df.empty:
-            print(f'No data below {freq_max} MHz.')
-            quit(1)
-    if freq_min is not None:
-        df = df[(df.RefFreq_MHz >= freq_min)]
-        if df.empty:
-            print(f'No data above {freq_min} MHz.')
-            quit(1)
     totalT = 0
     T_onSource = 0
     T_onSource_noOverlap = 0
     exp_list = []
     src_list = []
 
-    # we go through all experiments and scans, using the range between
-    # the lowest t_startMJD and the largest t_startMJD+length_sec(t_startMJD);
-    # we disgard any scans that are followed by a gap lasting longer than two hours
-    # since we assume those were just dummy scans
-    # TODO: what if there are several parts that are all more than two hours apart?
+    # we go through all experiments, using the range between the first start
+    # and the last end of their scans; scans that are followed by a gap lasting
+    # longer than two hours are not in the aggregates since we assume those
+    # were just dummy scans
+    per_exp = df.groupby('experiment', sort=False)
+    totals = per_exp.agg(nscans=('nscans', 'sum'), length_sec=('length_sec', 'sum'),
+                         missing_sec=('missing_sec', 'sum'), t_firstMJD=('t_firstMJD', 'min'),
+                         t_lastMJD=('t_lastMJD', 'max')).to_dict('index')
+    sources = per_exp.source.unique().to_dict()
+    rows = per_exp.indices
+    intervals = df.intervals.values
     if exps is None:
         # case e)
-        exps = df.experiment.unique()
+        exps = list(totals)
     for exp in exps:
-        ddf = df[(df.experiment == exp)].sort_values(by='t_startMJD')
-        if ddf.empty:
+        if exp not in totals:
             print(f'No data for experiment {exp}, skipping.')
             continue
-        if stations is None:
-            stations = ddf.station.unique()
-            revert_stations_to_none = True
-        ddf = ddf[(ddf.station.isin(stations))]
-        if ddf.empty:
-            print(f'Station(s) {stations} not in experiment {exp}. Skipping.')
-            continue
-        starts = np.array(ddf.t_startMJD)
-        if len(starts) <= 2:
-            print(f'Only {len(starts)} scans in experiment {exp}. Assuming these are dummy scans and skipping.')
-            if revert_stations_to_none is True:
-                stations = None
+        t = totals[exp]
+        if t['nscans'] <= 2:
+            print(f'Only {t["nscans"]} scans in experiment {exp}. Assuming these are dummy scans and skipping.')
             continue
-        sources_observed = ddf.source.unique()
-        # we compute the time diff between start times and disgard those
-        # that are followed by a gap lasting more than 2 hours
         exp_list.append(exp)
-        for src_observed in sources_observed:
-            src_list.append(src_observed)
-        mask = np.diff(starts, append=starts[-1])*24. < 2.
-        start_mjds = np.array(starts[mask])
-        end_mjds = np.array(start_mjds + ddf.length_sec[mask] / 86400)
-        totalT += (end_mjds[-1]-start_mjds[0])
-        T_onSource += ddf.length_sec[mask].sum() - ddf.missing_sec[mask].sum()
+        src_list += [str(source) for source in sources[exp]]
+        times = [interval for i in rows[exp] for interval in intervals[i]]
+        if not times:
+            continue
+        totalT += t['t_lastMJD'] - t['t_firstMJD']
+        T_onSource += t['length_sec'] - t['missing_sec']
         # now taking overlap out
-        times = [(x, y) for x, y in zip(start_mjds, end_mjds)]
-        times_red = list(merge(times))
-        for i in range(len(times_red)):
-            s, e = times_red[i][0], times_red[i][1]
+        for s, e in merge(times):
             T_onSource_noOverlap += (e-s)
-
-        if revert_stations_to_none is True:
-            stations = None
     if args.verbose:
         print(f'Found data in experiments {exp_list}')
         print(f'observed these unique sources: {set(src_list)}')
@@ -162,7 +139,7 @@ def main(args):
     print(f'I get {T_onSource / 3600:.2f}hrs on source in total.')
     print(f'I get {T_onSource_noOverlap * 24:.2f}hrs on source taking overlap out.')
 
-
 if __name__ == "__main__":
-    args = options()
-    main(args)
+    if not query_server.forward('dbInfo'):
+        args = options()
+        main(args)
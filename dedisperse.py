@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+'''
+Native incoherent dedispersion of SIGPROC filterbank files. Replaces
+PRESTO's prepdata/prepsubband for the cases used in this pipeline: a single
+DM or a range of DMs, optional zero-DM filtering and clipping. The work is
+split into blocks of DM trials and time that are processed in parallel.
+'''
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import filterbank
+
+DISPERSION_CONSTANT = 4.148808e3  # in MHz^2 pc^-1 cm^3 s
+
+
+def options():
+    parser = argparse.ArgumentParser(
+        description='Dedisperses a filterbank file at one or several DMs and writes '+
+        'PRESTO-style .dat/.inf time series.')
+    general = parser.add_argument_group('General info about the data.')
+    general.add_argument('filterbank', type=str,
+                         help='SIGPROC filterbank file to dedisperse.')
+    general.add_argument('--dm', type=float, required=True,
+                         help='(Lowest) dispersion measure to use.')
+    general.add_argument('--dm2', type=float, default=0.0,
+                         help='If set will go through the range of DMs defined by dm and '+
+                         'dm2 in steps of dmstep. Default is to do one DM only.')
+    general.add_argument('--dmstep', type=float, default=1.0,
+                         help='The stepsize in the DM search if both dm and dm2 are set. '+
+                         'Default=%(default)s.')
+    general.add_argument('-o', '--outbase', type=str, default=None,
+                         help='Base name of the output files. Default=<filterbank> without .fil.')
+    general.add_argument('--nozerodm', action='store_false',
+                         help='if set will not subtract the zero-DM time series.')
+    general.add_argument('--clip', type=float, default=5,
+                         help='S/N above which to clip data. Set to 0 to do no clipping. '+
+                         'Default=%(default)s.')
+    general.add_argument('--method', type=str, default='subband', choices=['subband', 'brute'],
+                         help='Dedispersion algorithm. Default=%(default)s.')
+    general.add_argument('--nsub', type=int, default=32,
+                         help='Number of subbands for the subband algorithm. Default=%(default)s.')
+    general.add_argument('--blocksize', type=int, default=65536,
+                         help='Number of output samples per time block. Default=%(default)s.')
+    general.add_argument('--ncpus', type=int, default=1,
+                         help='Number of worker processes. Default=%(default)s.')
+    return parser.parse_args()
+
+
+def dm_trials(dm1, dm2=0.0, dmstep=1.0):
+    '''
+    Returns the list of DMs that prepdata (dm2=0) or prepsubband
+    (dm2>0) would have been run on.
+    '''
+    if dm2 > 0.0:
+        if dm2 < dm1:
+            raise InputError('DM2 must be larger than DM1.')
+        numdms = int((dm2-dm1) // dmstep + 1)
+        return list(dm1 + dmstep * np.arange(numdms))
+    return [dm1]
+
+
+def delays(freqs, dm, tsamp, fref=None):
+    '''
+    Returns the dispersion delay in samples for each frequency in freqs (MHz)
+    relative to fref, by default the highest frequency.
+    '''
+    freqs = np.asarray(freqs, dtype=np.float64)
+    if fref is None:
+        fref = freqs.max()
+    delay_sec = DISPERSION_CONSTANT * dm * (freqs**-2 - fref**-2)
+    return np.round(delay_sec / tsamp).astype(np.int64)
+
+
+def clip_block(block, clip):
+    '''
+    Replaces all spectra in block whose zero-DM power deviates by more than
+    clip sigma from the median by the median spectrum. Works in place.
+    '''
+    zero_dm = block.mean(axis=1)
+    median = np.median(zero_dm)
+    sigma = 1.4826 * np.median(np.abs(zero_dm - median))
+    if sigma == 0:
+        return block
+    bad = np.abs(zero_dm - median) > clip * sigma
+    if bad.any():
+        block[bad] = np.median(block, axis=0)
+    return block
+
+
+def zerodm_block(block):
+    '''
+    Subtracts the zero-DM time series from each channel, keeping the
+    bandpass. Works in place.
+    '''
+    block -= block.mean(axis=1, keepdims=True) - block.mean()
+    return block
+
+
+def _shift_sum(data, shifts, nout):
+    '''
+    Sums the columns of data after shifting column i by shifts[i] samples.
+    '''
+    series = np.zeros(nout, dtype=np.float32)
+    for i, shift in enumerate(shifts):
+        series += data[shift:shift+nout, i]
+    return series
+
+
+def dm_groups(freqs, dms, tsamp, nsub):
+    '''
+    Splits dms into groups that can share the same first-stage subband
+    dedispersion without smearing by more than one sample within a subband.
+    Returns a list of lists of DMs.
+    '''
+    edges = np.array_split(np.argsort(freqs), nsub)
+    worst = max(abs(DISPERSION_CONSTANT * (freqs[e].min()**-2 - freqs[e].max()**-2))
+                for e in edges if len(e) > 0)
+    max_span = 2 * tsamp / worst if worst > 0 else np.inf
+    groups = [[dms[0]]]
+    for dm in dms[1:]:
+        if dm - groups[-1][0] <= max_span:
+            groups[-1].append(dm)
+        else:
+            groups.append([dm])
+    return groups
+
+
+def dedisperse_block(block, freqs, dms, tsamp, nout, method='subband', nsub=32):
+    '''
+    Dedisperses a block of shape (nsamples, nchans) that contains at least
+    nout + maximum delay samples. Returns an array of shape (len(dms), nout).
+    '''
+    out = np.zeros((len(dms), nout), dtype=np.float32)
+    if (method == 'brute') or (nsub >= len(freqs)):
+        for i, dm in enumerate(dms):
+            out[i] = _shift_sum(block, delays(freqs, dm, tsamp), nout)
+        return out
+    order = np.argsort(freqs)
+    subbands = [s for s in np.array_split(order, nsub) if len(s) > 0]
+    sub_freqs = np.array([freqs[s].max() for s in subbands])
+    # first stage: dedisperse within each subband at the central DM of the group
+    dm_nominal = 0.5 * (dms[0] + dms[-1])
+    max_sub_delay = delays(sub_freqs, dms[-1], tsamp, fref=freqs.max()).max()
+    nsub_out = nout + max_sub_delay
+    sub_shifts = [delays(freqs[chans], dm_nominal, tsamp, fref=sub_freqs[j])
+                  for j, chans in enumerate(subbands)]
+    # rounding of the two stages can require a sample or two more than we were given
+    missing = nsub_out + max(s.max() for s in sub_shifts) - block.shape[0]
+    if missing > 0:
+        block = np.concatenate([block, np.repeat(block[-1:], missing, axis=0)])
+    sub_data = np.zeros((nsub_out, len(subbands)), dtype=np.float32)
+    for j, chans in enumerate(subbands):
+        sub_data[:, j] = _shift_sum(block[:, chans], sub_shifts[j], nsub_out)
+    # second stage: shift the subbands against each other for each DM
+    for i, dm in enumerate(dms):
+        out[i] = _shift_sum(sub_data, delays(sub_freqs, dm, tsamp, fref=freqs.max()), nout)
+    return out
+
+
+def _process_block(filename, start, nout, maxdelay, dms, zerodm, clip, method, nsub):
+    '''
+    Worker function: reads a block from filename and dedisperses it.
+    '''
+    header, _ = filterbank.read_header(filename)
+    block = filterbank.total_intensity(filterbank.read_block(filename, start, nout+maxdelay))
+    if clip > 0:
+        clip_block(block, clip)
+    if zerodm:
+        zerodm_block(block)
+    return dedisperse_block(block, filterbank.get_freqs(header), dms,
+                            header['tsamp'], nout, method=method, nsub=nsub)
+
+
+def write_inf(outbase, header, dm, nsamples, filename):
+    '''
+    Writes a PRESTO-style .inf file to go with the time series outbase.dat.
+    '''
+    freqs = filterbank.get_freqs(header)
+    lines = [f' Data file name without suffix          =  {os.path.basename(outbase)}',
+             f' Telescope used                         =  {header.get("telescope_id", 0)}',
+             f' Instrument used                        =  digifil',
+             f' Object being observed                  =  {header.get("source_name", "Unknown")}',
+             f' Epoch of observation (MJD)             =  {header.get("tstart", 0.0):.15f}',
+             f' Barycentered?           (1=yes, 0=no)  =  0',
+             f' Number of bins in the time series      =  {nsamples}',
+             f' Width of each time series bin (sec)    =  {header["tsamp"]:.15g}',
+             f' Any breaks in the data? (1=yes, 0=no)  =  0',
+             f' Type of observation (EM band)          =  Radio',
+             f' Dispersion measure (cm-3 pc)           =  {dm}',
+             f' Central freq of low channel (Mhz)      =  {freqs.min()}',
+             f' Total bandwidth (Mhz)                  =  {abs(header["foff"]) * header["nchans"]}',
+             f' Number of channels                     =  {header["nchans"]}',
+             f' Channel bandwidth (Mhz)                =  {abs(header["foff"])}',
+             f' Data analyzed by                       =  dedisperse.py',
+             f' Any additional notes:',
+             f'    Input filterbank: {filename}']
+    with open(f'{outbase}.inf', 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def dedisperse(filename, dms, outbase=None, callback=None, zerodm=True, clip=5,
+               method='subband', nsub=32, blocksize=65536, ncpus=1):
+    '''
+    Dedisperses filename at all dms. The data are split into time blocks
+    of blocksize output samples and groups of DM trials that are processed
+    by ncpus worker processes. Finished time series are streamed in time
+    order to <outbase>_DM<dm>.dat (if outbase is set) and/or passed to
+    callback(dm, start_sample, series). Returns the list of .dat files.
+    '''
+    if (outbase is None) and (callback is None):
+        raise InputError('Need either an outbase or a callback to do something with the output.')
+    header, data = filterbank.open_data(filename)
+    freqs = filterbank.get_freqs(header)
+    tsamp = header['tsamp']
+    dms = sorted(dms)
+    maxdelay = int(delays(freqs, dms[-1], tsamp).max())
+    nsamples_out = data.shape[0] - maxdelay
+    if nsamples_out <= 0:
+        raise InputError(f'{filename} is shorter than the dispersion delay at DM {dms[-1]}.')
+    del data
+    groups = dm_groups(freqs, dms, tsamp, nsub) if method == 'subband' else [dms]
+    if ncpus > 1:
+        groups = [list(g) for group in groups
+                  for g in np.array_split(group, min(len(group), ncpus)) if len(g) > 0]
+    tasks = [(start, min(blocksize, nsamples_out - start), group)
+             for start in range(0, nsamples_out, blocksize) for group in groups]
+
+    datfiles = {}
+    if outbase is not None:
+        for dm in dms:
+            datfiles[dm] = open(f'{outbase}_DM{dm:.2f}.dat', 'wb')
+    try:
+        with ProcessPoolExecutor(max_workers=ncpus) as pool:
+            # keep only a limited number of blocks in flight to bound memory usage
+            pending = []
+            for start, nout, group in tasks:
+                pending.append((start, group, pool.submit(_process_block, filename, start, nout,
+                                                          maxdelay, group, zerodm, clip,
+                                                          method, nsub)))
+                if len(pending) >= 2 * ncpus:
+                    _flush(pending.pop(0), datfiles, callback)
+            while pending:
+                _flush(pending.pop(0), datfiles, callback)
+    finally:
+        for f in datfiles.values():
+            f.close()
+    if outbase is not None:
+        for dm in dms:
+            write_inf(f'{outbase}_DM{dm:.2f}', header, dm, nsamples_out, filename)
+    return [f.name for f in datfiles.values()]
+
+
+def _flush(task, datfiles, callback):
+    start, group, future = task
+    series = future.result()
+    for dm, s in zip(group, series):
+        if dm in datfiles:
+            datfiles[dm].write(s.tobytes())
+        if callback is not None:
+            callback(dm, start, s)
+
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+    pass
+
+
+class InputError(Error):
+    """Exception raised for errors in the input.
+
+    Attributes:
+        message -- explanation of the error
+    """
+
+    def __init__(self, message):
+        self.message = message
+
+
+if __name__ == "__main__":
+    args = options()
+    outbase = args.outbase if args.outbase is not None else args.filterbank.replace('.fil', '')
+    dms = dm_trials(args.dm, args.dm2, args.dmstep)
+    datfiles = dedisperse(args.filterbank, dms, outbase=outbase, zerodm=args.nozerodm,
+                          clip=args.clip, method=args.method, nsub=args.nsub,
+                          blocksize=args.blocksize, ncpus=args.ncpus)
+    print(f'Written {len(datfiles)} time series to {outbase}_DM*.dat')
@@ -1,13 +1,15 @@
 #!/usr/bin/env python3
 
 from subprocess import PIPE, Popen, check_output
+import os
 import sys
+import query_server
 
 isPulsar = False  # Is used to check if the source is a pulsar or not.
 
 # Until I figure out how to send a message around that contains several arguments
 # I hardcode the FRB DMs here and have a function for pulsars below
-def get_dm(src):
+def get_dm(src, use_server=True):
     global isPulsar
     FRB_DMs = {	'BSGR': 332.7,
                 'F19': 1202.0,
@@ -94,32 +96,47 @@ def get_dm(src):
     try:
         return FRB_DMs[src]
     except KeyError:
-        try:
-            cmd = "psrcat -c 'dm' -o short -nohead -nonumber {0}".format(src)
-            dm = check_output(cmd, shell=True)
+        if use_server:
+            answer = query_server.query({'tool': 'dm', 'source': src})
+            if answer is not None:
+                isPulsar = isPulsar or answer['pulsar']
+                return answer['dm']
+        # psrcat answers are kept (by a running query_server) till its catalogue changes
+        dm = query_server.cached(('psrcat', src), psrcat_catalogue(), lambda: get_psrcat_dm(src))
+        if dm is not None:
             isPulsar = True
-            return float(dm)
-        except:
-            return None
+        return dm
+    except:
+        return None
+
+
+def psrcat_catalogue():
+    '''
+    The catalogue psrcat reads: $PSRCAT_FILE, else psrcat.db in $PSRCAT_RUNDIR.
+    '''
+    if 'PSRCAT_FILE' in os.environ:
+        return [os.environ['PSRCAT_FILE']]
+    if 'PSRCAT_RUNDIR' in os.environ:
+        return [os.path.join(os.environ['PSRCAT_RUNDIR'], 'psrcat.db')]
+    return []
+
+
+def get_psrcat_dm(src):
+    try:
+        cmd = "psrcat -c 'dm' -o short -nohead -nonumber {0}".format(src)
+        dm = check_output(cmd, shell=True)
+        return float(dm)
     except:
         return None
 
 
 def get_src(fil_file):
-    cmd = f'header {fil_file}'
-    fil_header = check_output(cmd, shell=True).decode("utf-8").splitlines()
-    for line in fil_header:
-        if 'Source Name' in line:
-            src = line.split(':')[1].strip()
-            break
-    return src
+    import filterbank
+    header, _ = filterbank.read_header(fil_file)
+    return header['source_name']
 
 
 def get_nchan(fil_file):
-    cmd = f'header {fil_file}'
-    fil_header = check_output(cmd, shell=True).decode("utf-8").splitlines()
-    for line in fil_header:
-        if 'Number of channels' in line:
-            nchan = line.split(':')[1].strip()
-            break
-    return int(nchan)
+    import filterbank
+    header, _ = filterbank.read_header(fil_file)
+    return int(header['nchans'])
@@ -1,10 +1,10 @@
 #!/usr/bin/env python3
 
 import argparse
-from astropy.time import Time
 import os
 import subprocess
-import numpy as np
+import readahead
+from vlbi_time import yday2mjd
 
 
 def options():
@@ -30,6 +30,16 @@ def options():
                          help='Base path of where to mount the files via vbs_fs. The '+
                          'script will create a directory with the experiment name '+
                          'under that directory. Default=%(default)s')
+    general.add_argument('--gapmap', action='store_true',
+                         help='If set will scan the frame headers of the files that contain the '+
+                         'MJDs for gaps (vdif_scan.py) and use the result to locate the data.')
+    general.add_argument('--ring', type=str, default=None,
+                         help='Index of the split VDIF files retained by base2fil (vdif_ring.py). '+
+                         'If set the MJDs are cut from there first and only the remaining ones '+
+                         'are extracted from the FlexBuff.')
+    general.add_argument('--dm', type=float, default=0.0,
+                         help='DM of the candidates, for --ring. Windows then follow the dispersed '+
+                         'burst through each IF, nsec is added either side. Default=%(default)s.')
     return parser.parse_args()
 
 
@@ -38,6 +48,7 @@ def get_vdif_info(infiles):
     Takes a list (or single) of total file paths and returns a dictionary
     with the relevant info about all files.
     '''
+    import numpy as np
     if not isinstance(infiles, list):
         infiles = list(infiles)
     types = np.dtype([('file', 'U100'),
@@ -62,7 +73,7 @@ def get_vdif_info(infiles):
         legacy = int(legacy.split('=')[1].strip())
         header_size = 16 if legacy == 1 else 32
         info[i] = (infile,
-                   Time(t0, format='yday', scale='utc').mjd,
+                   yday2mjd(t0),
                    int(frame0.split('=')[1].strip()),
                    int(frame_size.split('=')[1].strip()),
                    int(os.path.getsize(infile)),
@@ -97,11 +108,12 @@ def mount_files(experiment, telescope, mount_dir='/tmp/', checkpath=True):
     return [f'{mountpath}/{f}' for f in os.listdir(mountpath)]
 
 
-def extract_chunk(info, mjds, outdir, nsec=1, datarate=128):
+def extract_chunk(info, mjds, outdir, nsec=1, datarate=128, gapmap=False):
     '''
     Given the mjds, will extract +- nsec of data around each mjd from the
-    file that should contain that mjd. This is using dd which will put the data
-    into outdir.
+    file that should contain that mjd and writes it to outdir. If gapmap is set the position of the data in the file is
+    taken from the gap map of the file (cached in outdir) such that missing
+    frames do not shift the extracted window, and dead spans are reported.
     '''
     datarate *= 1e6
     outdir = os.path.abspath(outdir)
@@ -118,7 +130,9 @@ def extract_chunk(info, mjds, outdir, nsec=1, datarate=128):
         header_size =  entry['header_size']
         frames_per_second = datarate/(frame_size - header_size)
         start = start + (entry['f0'] * 1./frames_per_second)/86400.
-        assert entry['file_size'] % frame_size == 0
+        if not entry['file_size'] % frame_size == 0:
+            print(f'WARNING: {infile} does not contain an integer number of frames, ignoring '+
+                  f'the last {entry["file_size"] % frame_size} bytes.')
         frames_in_file = entry['file_size'] // frame_size
         secs_in_file = (entry['file_size'] - frames_in_file * header_size) / datarate
         stop = start + secs_in_file/86400.
@@ -136,11 +150,23 @@ def extract_chunk(info, mjds, outdir, nsec=1, datarate=128):
                 if nsec <= 0:
                     raise ValueError(f'Chosen MJD {mjd} too close to the edge of the file.')
                 frames_to_skip = int((mjd - start - nsec/86400.) * 86400. * frames_per_second)
+                if gapmap:
+                    import vdif_scan
+                    gaps = vdif_scan.load_or_scan(infile, cachedir=outdir)
+                    t_mjd = (mjd - gaps['start_mjd']) * 86400.
+                    for kind, _, _, t_start, t_stop in vdif_scan.dead_spans(gaps, t_mjd - nsec, t_mjd + nsec):
+                        print(f'WARNING: {kind} data between {t_start:.3f}s and {t_stop:.3f}s '+
+                              f'of {infile} overlap with the requested range.')
+                    frame = vdif_scan.time_to_frame(gaps, t_mjd - nsec)
+                    if frame is not None:
+                        frames_to_skip = frame
                 frames_to_extract = int(2 * nsec * frames_per_second)
                 fname = infile.split('/')[-1]
-                cmd = f'dd if={infile} of={outdir}/{fname}_{mjd:.8f}_plus-minus_{nsec:.1f}_seconds bs={frame_size} skip={frames_to_skip} count={frames_to_extract}'
-                print(f'Running {cmd}')
-                output = subprocess.check_output(cmd, shell=True)
+                outfile = f'{outdir}/{fname}_{mjd:.8f}_plus-minus_{nsec:.1f}_seconds'
+                print(f'Extracting {frames_to_extract} frames as of frame {frames_to_skip} of {infile} to {outfile}')
+                # large prefetched reads instead of dd's frame-sized ones, those crawl over vbs_fs
+                readahead.copy_range(infile, outfile, int(frames_to_skip * frame_size),
+                                     int(frames_to_extract * frame_size))
                 # bring nsec back to orignal value in case it was modified
                 nsec = nsec_org
         # we don't need to search the mjds that we already found in the next outer loop again.
@@ -160,9 +186,18 @@ def cleanup(mountdir):
 
 if __name__ == "__main__":
     args = options()
-    file_list = mount_files(args.experiment, args.telescope, args.mountdir)
-    info = get_vdif_info(file_list)
-    missing = extract_chunk(info, args.mjds, outdir=args.outdir, nsec=args.nsec, datarate=args.datarate)
-    cleanup(f'{args.mountdir}/{args.experiment}')
+    mjds = args.mjds
+    if args.ring is not None:
+        import vdif_ring
+        mjds = [mjd for mjd in mjds
+                if not vdif_ring.cut(args.ring, mjd, args.dm, args.outdir, pad=args.nsec)]
+        print(f'{len(args.mjds)-len(mjds)} of {len(args.mjds)} MJDs cut from {args.ring}.')
+    missing = []
+    if mjds:
+        file_list = mount_files(args.experiment, args.telescope, args.mountdir)
+        info = get_vdif_info(file_list)
+        missing = extract_chunk(info, mjds, outdir=args.outdir, nsec=args.nsec, datarate=args.datarate,
+                                gapmap=args.gapmap)
+        cleanup(f'{args.mountdir}/{args.experiment}')
     if missing:
         print(f'\n Found no matching files for {missing}.\n')
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+'''
+Long-lived publisher that hands filterbanks to FETCH's RabbitMQ queue
+(stage01_queue). Submissions come in via a local Unix socket or by dropping a
+file into the spool directory. Every submission goes to the spool first and
+is only removed from it once the broker confirmed it, so nothing gets lost
+if the broker or the publisher go down. Spooled messages are published in
+batches over one connection that is kept open and re-established with
+back-off whenever it breaks.
+
+  fetch_publisher.py serve                 # run the service
+  fetch_publisher.py send "<fil> <flag>"   # submit a message
+
+For testing, serve --local uses an in-process stand-in broker instead of
+RabbitMQ. pika is only needed to talk to a real broker.
+'''
+import argparse
+import os
+import socket
+import socketserver
+import threading
+import time
+
+DEFAULT_DIR = os.path.expanduser('~/.fetch_publisher')
+
+
+def options():
+    parser = argparse.ArgumentParser(
+        description='Publishes filterbanks to FETCH\'s queue through a persistent, batching '+
+        'and spooling connection.')
+    general = parser.add_argument_group('General info about the data.')
+    general.add_argument('action', type=str, choices=['serve', 'send'],
+                         help='serve: run the publisher. send: submit a message.')
+    general.add_argument('message', type=str, nargs='?', default=None,
+                         help='Message to send, i.e. "<filterbank> <flag file>".')
+    general.add_argument('--socket', type=str, default=f'{DEFAULT_DIR}/publisher.sock',
+                         help='Unix socket the publisher listens on. Default=%(default)s.')
+    general.add_argument('--spooldir', type=str, default=f'{DEFAULT_DIR}/spool',
+                         help='Messages wait here till they are confirmed. Files dropped here '+
+                         'are published, too. Default=%(default)s.')
+    general.add_argument('--url', type=str, default='amqp://localhost',
+                         help='URL of the RabbitMQ broker. Default=%(default)s.')
+    general.add_argument('-q', '--queue', type=str, default='stage01_queue',
+                         help='Name of the queue. Default=%(default)s.')
+    general.add_argument('--batch_size', type=int, default=50,
+                         help='Maximum number of messages per batch. Default=%(default)s.')
+    general.add_argument('--batch_wait', type=float, default=1.0,
+                         help='Seconds to wait for more messages before publishing a batch '+
+                         'that is not full. Default=%(default)s.')
+    general.add_argument('--local', action='store_true',
+                         help='If set will publish to an in-process stand-in broker.')
+    return parser.parse_args()
+
+
+class AMQPBroker:
+    '''
+    Connection to a RabbitMQ broker with publisher confirms. The connection
+    is opened on first use and re-used until it breaks.
+    '''
+
+    def __init__(self, url):
+        self.url = url
+        self.connection = None
+        self.channel = None
+
+    def connect(self):
+        import pika
+        self.connection = pika.BlockingConnection(pika.URLParameters(self.url))
+        self.channel = self.connection.channel()
+        self.channel.confirm_delivery()
+
+    def publish(self, queue, messages):
+        '''
+        Publishes messages to queue. Returns once the broker confirmed all of
+        them, raises an exception otherwise.
+        '''
+        import pika
+        if (self.connection is None) or self.connection.is_closed:
+            self.connect()
+        self.channel.queue_declare(queue=queue, durable=True)
+        for message in messages:
+            # with confirms enabled this raises if the broker does not take the message
+            self.channel.basic_publish(exchange='', routing_key=queue, body=message,
+                                       properties=pika.BasicProperties(delivery_mode=2),
+                                       mandatory=True)
+
+    def close(self):
+        try:
+            if (self.connection is not None) and self.connection.is_open:
+                self.connection.close()
+        except Exception:
+            pass
+        self.connection = None
+
+
+class LocalBroker:
+    '''
+    In-process stand-in for RabbitMQ. Keeps all messages per queue. Setting
+    down makes it refuse connections, fail_next makes the next publishes fail.
+    '''
+
+    def __init__(self):
+        self.queues = {}
+        self.down = False
+        self.fail_next = 0
+        self.nconnections = 0
+        self.connected = False
+        self.lock = threading.Lock()
+
+    def publish(self, queue, messages):
+        with self.lock:
+            if self.down:
+                self.connected = False
+                raise ConnectionError('Stand-in broker is down.')
+            if not self.connected:
+                self.connected = True
+                self.nconnections += 1
+            if self.fail_next > 0:
+                self.fail_next -= 1
+                raise ConnectionError('Stand-in broker refused the batch.')
+            self.queues.setdefault(queue, []).extend(messages)
+
+    def close(self):
+        self.connected = False
+
+
+class Publisher:
+    '''
+    Publishes the messages in spooldir in batches until stopped.
+    '''
+
+    def __init__(self, spooldir, broker, queue='stage01_queue', batch_size=50, batch_wait=1.0,
+                 max_backoff=60):
+        self.spooldir = spooldir
+        self.broker = broker
+        self.queue = queue
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.max_backoff = max_backoff
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.nfailures = 0
+        os.makedirs(spooldir, exist_ok=True)
+
+    def pending(self):
+        '''
+        Returns the spooled message files, oldest first.
+        '''
+        return sorted(f'{self.spooldir}/{f}' for f in os.listdir(self.spooldir)
+                      if f.endswith('.msg'))
+
+    def publish_batch(self):
+        '''
+        Publishes up to batch_size spooled messages and removes them from the
+        spool once confirmed. Returns the number of messages published.
+        '''
+        batch = self.pending()[:self.batch_size]
+        if len(batch) == 0:
+            return 0
+        messages = []
+        for msgfile in batch:
+            with open(msgfile) as f:
+                messages.append(f.read().strip())
+        self.broker.publish(self.queue, messages)
+        for msgfile in batch:
+            os.remove(msgfile)
+        return len(batch)
+
+    def run(self):
+        while not self.stopped.is_set():
+            pending = self.pending()
+            if len(pending) == 0:
+                self.wakeup.wait(self.batch_wait)
+                self.wakeup.clear()
+                continue
+            if len(pending) < self.batch_size:
+                # give further messages a moment to arrive to publish them together
+                age = time.time() - os.path.getmtime(pending[0])
+                if age < self.batch_wait:
+                    time.sleep(self.batch_wait - age)
+            try:
+                n = self.publish_batch()
+                self.nfailures = 0
+                print(f'Published {n} messages to {self.queue}.', flush=True)
+            except Exception as e:
+                self.broker.close()
+                self.nfailures += 1
+                backoff = min(2**self.nfailures, self.max_backoff)
+                print(f'Publishing failed ({e}), {len(pending)} messages stay spooled, '+
+                      f'retrying in {backoff}s.', flush=True)
+                self.stopped.wait(backoff)
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+
+
+def spool(spooldir, message):
+    '''
+    Writes message to the spool. The file only appears under its final name
+    once it is complete, such that the publisher never sees partial messages.
+    '''
+    os.makedirs(spooldir, exist_ok=True)
+    name = f'{spooldir}/{time.time_ns():020d}-{os.getpid()}-{threading.get_ident()}'
+    with open(f'{name}.tmp', 'w') as f:
+        f.write(message + '\n')
+    os.replace(f'{name}.tmp', f'{name}.msg')
+    return f'{name}.msg'
+
+
+def serve(socket_path, publisher):
+    '''
+    Runs publisher and accepts messages, one per line, on socket_path. Each
+    message is acknowledged with OK once it is spooled.
+    '''
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                message = line.decode().strip()
+                if message:
+                    spool(publisher.spooldir, message)
+                    publisher.wakeup.set()
+                    self.wfile.write(b'OK\n')
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+    server = socketserver.ThreadingUnixStreamServer(socket_path, Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        publisher.run()
+    finally:
+        server.shutdown()
+        os.remove(socket_path)
+
+
+def send(message, socket_path, spooldir, timeout=10):
+    '''
+    Submits message to the publisher. If the publisher does not answer the
+    message is dropped into the spool directly and will be published once
+    the publisher runs. Returns True if the publisher took it.
+    '''
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.settimeout(timeout)
+            s.connect(socket_path)
+            s.sendall(message.encode() + b'\n')
+            if s.makefile().readline().strip() == 'OK':
+                return True
+    except OSError:
+        pass
+    spool(spooldir, message)
+    return False
+
+
+if __name__ == "__main__":
+    args = options()
+    if args.action == 'serve':
+        broker = LocalBroker() if args.local else AMQPBroker(args.url)
+        publisher = Publisher(args.spooldir, broker, args.queue, args.batch_size, args.batch_wait)
+        print(f'Publishing to {args.queue}, listening on {args.socket}.', flush=True)
+        serve(args.socket, publisher)
+    else:
+        if args.message is None:
+            raise SystemExit('Nothing to send.')
+        if send(args.message, args.socket, args.spooldir):
+            print('Message handed to the publisher.')
+        else:
+            print(f'Publisher not running, message spooled in {args.spooldir}.')
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+'''
+Compressed archive format for SIGPROC filterbanks with random access in
+time. The data are cut into blocks of fixed duration, each compressed on its
+own (zstd if the zstandard module is installed, zlib otherwise), and an index
+of the blocks is appended, such that reading a time range decompresses only
+the blocks that overlap with it.
+
+  MAGIC | SIGPROC header | block 0 | block 1 | ... | index | meta | trailer
+
+The index holds the offset, compressed size, first sample and number of
+samples of each block, meta is json (codec, block size, number of samples),
+the trailer gives the offsets of index and meta. Archives are read
+transparently by filterbank.py (read_header, open_data, read_block,
+iter_chunks), i.e. by all tools built on it.
+
+  fil_archive.py pack scan.fil --remove        # scan.fil -> scan.filz
+  fil_archive.py unpack scan.filz --start 100 --stop 102 -o cand.fil
+  fil_archive.py info scan.filz
+'''
+import argparse
+import json
+import os
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import filterbank
+import readahead
+
+MAGIC = filterbank.ARCHIVE_MAGIC
+TRAILER = struct.Struct('<QQ8s')  # offset of the index, offset of meta, MAGIC
+INDEX_DTYPE = np.dtype([('offset', '<i8'), ('size', '<i8'), ('first', '<i8'), ('nsamples', '<i8')])
+SUFFIX = '.filz'
+
+
+def options():
+    parser = argparse.ArgumentParser(
+        description='Converts filterbanks to and from a compressed archive with random '+
+        'access in time.')
+    general = parser.add_argument_group('General info about the data.')
+    general.add_argument('action', type=str, choices=['pack', 'unpack', 'info'],
+                         help='pack: filterbank to archive. unpack: archive (or a time range '+
+                         'of it) to filterbank. info: print the layout of an archive.')
+    general.add_argument('filename', type=str,
+                         help='Filterbank for pack, archive otherwise.')
+    general.add_argument('-o', '--outfile', type=str, default=None,
+                         help='Output file. Default is the input with .fil and .filz swapped.')
+    general.add_argument('--block_sec', type=float, default=1.0,
+                         help='Duration of the blocks in seconds. Default=%(default)s.')
+    general.add_argument('--codec', type=str, default=None, choices=['zstd', 'zlib'],
+                         help='Compression. Default is zstd if available, else zlib.')
+    general.add_argument('--level', type=int, default=3,
+                         help='Compression level. Default=%(default)s.')
+    general.add_argument('--nthreads', type=int, default=4,
+                         help='Number of blocks compressed at the same time. Default=%(default)s.')
+    general.add_argument('--remove', action='store_true',
+                         help='For pack: remove the filterbank once the archive is complete.')
+    general.add_argument('--start', type=float, default=0.0,
+                         help='For unpack: seconds into the file to start at. Default=%(default)s.')
+    general.add_argument('--stop', type=float, default=None,
+                         help='For unpack: seconds into the file to stop at. Default is the end.')
+    return parser.parse_args()
+
+
+def default_codec():
+    try:
+        import zstandard
+        return 'zstd'
+    except ImportError:
+        return 'zlib'
+
+
+def compressor(codec, level=3):
+    '''
+    Returns a function that compresses bytes with codec.
+    '''
+    if codec == 'zstd':
+        import zstandard
+        # compressor objects are not thread-safe, each call gets its own
+        return lambda data: zstandard.ZstdCompressor(level=level).compress(data)
+    if codec == 'zlib':
+        return lambda data: zlib.compress(data, level)
+    raise InputError(f'Unknown codec {codec}.')
+
+
+def decompressor(codec):
+    '''
+    Returns a function that decompresses bytes compressed with codec.
+    '''
+    if codec == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise InputError('Archive is zstd compressed, please install zstandard.')
+        return lambda data: zstandard.ZstdDecompressor().decompress(data)
+    if codec == 'zlib':
+        return zlib.decompress
+    raise InputError(f'Unknown codec {codec}.')
+
+
+def pack(filename, outfile=None, block_sec=1.0, codec=None, level=3, nthreads=4):
+    '''
+    Writes the archive of the filterbank filename. The archive only appears
+    under its final name once it is complete. Returns the name of the archive.
+    '''
+    if outfile is None:
+        outfile = (filename[:-4] if filename.endswith('.fil') else filename) + SUFFIX
+    codec = default_codec() if codec is None else codec
+    compress = compressor(codec, level)
+    header, header_size = filterbank.read_header(filename)
+    bytes_per_spectrum = filterbank.get_bytes_per_spectrum(header)
+    nsamples = filterbank.get_nsamples(header, header_size, filename)
+    block = max(int(round(block_sec / header['tsamp'])), 1)
+    index = np.zeros((nsamples + block - 1) // block, dtype=INDEX_DTYPE)
+    tmpfile = f'{outfile}.{os.getpid()}.tmp'
+    with open(filename, 'rb') as fin, open(tmpfile, 'wb') as fout, \
+            ThreadPoolExecutor(max_workers=nthreads) as pool:
+        fout.write(MAGIC)
+        fout.write(fin.read(header_size))
+
+        def read_blocks():
+            with readahead.Reader(filename, header_size) as reader:
+                for first in range(0, nsamples, block):
+                    yield first, reader.read(min(block, nsamples - first) * bytes_per_spectrum)
+
+        # blocks are compressed in parallel but written in order, with a bounded number in flight
+        pending = []
+        for i, (first, raw) in enumerate(read_blocks()):
+            pending.append((i, first, len(raw) // bytes_per_spectrum, pool.submit(compress, raw)))
+            if len(pending) >= 2 * nthreads:
+                _write_block(fout, index, *pending.pop(0))
+        for entry in pending:
+            _write_block(fout, index, *entry)
+        index_offset = fout.tell()
+        fout.write(index.tobytes())
+        meta_offset = fout.tell()
+        fout.write(json.dumps({'codec': codec, 'block_nsamples': block, 'nsamples': nsamples,
+                               'header_size': header_size, 'bytes_per_spectrum': bytes_per_spectrum,
+                               'source': os.path.basename(filename)}).encode())
+        fout.write(TRAILER.pack(index_offset, meta_offset, MAGIC))
+    os.replace(tmpfile, outfile)
+    return outfile
+
+
+def _write_block(fout, index, i, first, nsamples, future):
+    data = future.result()
+    index[i] = (fout.tell(), len(data), first, nsamples)
+    fout.write(data)
+
+
+class Archive:
+    '''
+    Read access to an archive. Slicing in time, archive[start:stop], returns
+    the packed samples of shape (n, nifs, ncols) like the memory map of
+    filterbank.open_data; only the blocks needed are read and decompressed.
+    The most recently decompressed blocks are kept for sequential reads.
+    '''
+
+    def __init__(self, filename, ncache=4):
+        self.filename = filename
+        self.header, self.header_size = filterbank.read_header(filename, offset=len(MAGIC))
+        with open(filename, 'rb') as f:
+            f.seek(-TRAILER.size, os.SEEK_END)
+            trailer = f.read(TRAILER.size)
+            if len(trailer) < TRAILER.size or not TRAILER.unpack(trailer)[2] == MAGIC:
+                raise InputError(f'{filename} is not a complete archive.')
+            index_offset, meta_offset, _ = TRAILER.unpack(trailer)
+            f.seek(index_offset)
+            self.index = np.frombuffer(f.read(meta_offset - index_offset), dtype=INDEX_DTYPE)
+            self.meta = json.loads(f.read(os.path.getsize(filename) - TRAILER.size - meta_offset))
+        self.nsamples = self.meta['nsamples']
+        self.decompress = decompressor(self.meta['codec'])
+        nbits = self.header['nbits']
+        nchans = self.header['nchans']
+        ncols = nchans * nbits // 8 if nbits in filterbank.PACKED_NBITS else nchans
+        self.dtype = filterbank.get_dtype(nbits)
+        self.shape = (self.nsamples, self.header['nifs'], ncols)
+        self.ncache = ncache
+        self.cache = {}
+
+    def __len__(self):
+        return self.nsamples
+
+    def block(self, i):
+        '''
+        Returns block i as an array of shape (n, nifs, ncols).
+        '''
+        if i not in self.cache:
+            offset, size, _, nsamples = self.index[i]
+            with open(self.filename, 'rb') as f:
+                f.seek(offset)
+                raw = self.decompress(f.read(size))
+            if len(self.cache) >= self.ncache:
+                del self.cache[next(iter(self.cache))]
+            self.cache[i] = np.frombuffer(raw, dtype=self.dtype).reshape((nsamples,) + self.shape[1:])
+        return self.cache[i]
+
+    def read(self, start, stop):
+        '''
+        Returns samples start to stop (exclusive) of shape (n, nifs, ncols).
+        '''
+        start, stop = max(start, 0), min(stop, self.nsamples)
+        if stop <= start:
+            return np.zeros((0,) + self.shape[1:], dtype=self.dtype)
+        block = self.meta['block_nsamples']
+        parts = [self.block(i) for i in range(start // block, (stop - 1) // block + 1)]
+        first = (start // block) * block
+        return np.concatenate(parts)[start - first:stop - first]
+
+    def read_seconds(self, t_start, t_stop):
+        '''
+        Returns the unpacked samples between t_start and t_stop seconds into
+        the file with shape (n, nifs, nchans).
+        '''
+        tsamp = self.header['tsamp']
+        return filterbank.unpack(self.read(int(t_start / tsamp), int(round(t_stop / tsamp))),
+                                 self.header['nbits'])
+
+    def __getitem__(self, key):
+        if isinstance(key, slice) and (key.step in (None, 1)):
+            start, stop, _ = key.indices(self.nsamples)
+            return self.read(start, stop)
+        if isinstance(key, (int, np.integer)):
+            return self.read(int(key), int(key) + 1)[0]
+        raise InputError('Archives can only be sliced in time with step 1.')
+
+
+def unpack(filename, outfile=None, t_start=0.0, t_stop=None, chunk_sec=10.0):
+    '''
+    Writes the samples between t_start and t_stop seconds (default: all)
+    of the archive filename to the filterbank outfile, with tstart adjusted.
+    Returns the name of the filterbank.
+    '''
+    if outfile is None:
+        outfile = (filename[:-len(SUFFIX)] if filename.endswith(SUFFIX) else filename) + '.fil'
+    archive = Archive(filename)
+    header = dict(archive.header)
+    tsamp = header['tsamp']
+    start = max(int(t_start / tsamp), 0)
+    stop = archive.nsamples if t_stop is None else min(int(round(t_stop / tsamp)), archive.nsamples)
+    header['tstart'] = header['tstart'] + start * tsamp / 86400.
+    header.pop('nsamples', None)
+    chunk = max(int(chunk_sec / tsamp), 1)
+    with open(outfile, 'wb') as f:
+        filterbank.write_header(f, header)
+        for first in range(start, stop, chunk):
+            f.write(archive.read(first, min(first + chunk, stop)).tobytes())
+    return outfile
+
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+    pass
+
+
+class InputError(Error):
+    """Exception raised for errors in the input.
+
+    Attributes:
+        message -- explanation of the error
+    """
+
+    def __init__(self, message):
+        self.message = message
+
+
+if __name__ == "__main__":
+    args = options()
+    if args.action == 'pack':
+        outfile = pack(args.filename, args.outfile, args.block_sec, args.codec, args.level,
+                       args.nthreads)
+        ratio = os.path.getsize(args.filename) / os.path.getsize(outfile)
+        print(f'Archived {args.filename} to {outfile}, compression ratio {ratio:.2f}.')
+        if args.remove:
+            os.remove(args.filename)
+    elif args.action == 'unpack':
+        print(f'Written {unpack(args.filename, args.outfile, args.start, args.stop)}.')
+    else:
+        archive = Archive(args.filename)
+        meta = archive.meta
+        tsamp = archive.header['tsamp']
+        print(f'{args.filename}: {meta["nsamples"]*tsamp:.1f}s of {meta["source"]} in '+
+              f'{len(archive.index)} blocks of {meta["block_nsamples"]*tsamp:.2f}s, '+
+              f'{meta["codec"]} compressed with ratio '+
+              f'{meta["nsamples"]*meta["bytes_per_spectrum"]/max(archive.index["size"].sum(), 1):.2f}.')
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+'''
+Reading and writing of SIGPROC filterbank files as written by digifil and
+splice. The data are memory-mapped such that only the parts that are actually
+accessed get read from disk, i.e. even the multi-GB *_IFall_vdif_pol*.fil files
+can be worked on chunk by chunk in bounded memory.
+'''
+import argparse
+import os
+import struct
+import numpy as np
+
+
+def options():
+    parser = argparse.ArgumentParser(
+        description='Prints the header of a SIGPROC filterbank file.')
+    general = parser.add_argument_group()
+    general.add_argument('filterbank', type=str,
+                         help='SIGPROC filterbank file.')
+    general.add_argument('-k', '--keyword', type=str, default=None,
+                         help='If set will print only the value of this keyword.')
+    return parser.parse_args()
+
+
+# types of the keywords that can appear in a SIGPROC header
+HEADER_KEYS = {
+    'telescope_id': 'i', 'machine_id': 'i', 'data_type': 'i',
+    'barycentric': 'i', 'pulsarcentric': 'i', 'nbits': 'i',
+    'nsamples': 'i', 'nchans': 'i', 'nifs': 'i', 'nbeams': 'i',
+    'ibeam': 'i',
+    'tstart': 'd', 'tsamp': 'd', 'fch1': 'd', 'foff': 'd',
+    'refdm': 'd', 'az_start': 'd', 'za_start': 'd', 'src_raj': 'd',
+    'src_dej': 'd', 'period': 'd',
+    'source_name': 's', 'rawdatafile': 's',
+    'signed': 'b',
+}
+
+# nbits for which samples are packed several to a byte
+PACKED_NBITS = [1, 2, 4]
+# compressed archives (fil_archive.py) start with this, followed by the SIGPROC header
+ARCHIVE_MAGIC = b'FILZ0001'
+
+
+def _read_string(f):
+    nbytes = struct.unpack('i', f.read(4))[0]
+    if (nbytes < 1) or (nbytes > 80):
+        raise InputError(f'Invalid string length {nbytes} in filterbank header.')
+    return f.read(nbytes).decode()
+
+
+def read_header(filename, offset=0):
+    '''
+    Parses the header of a SIGPROC filterbank file (or archive thereof)
+    that starts offset bytes into the file. Returns a dictionary with all
+    keywords found and the size of the header in bytes.
+    '''
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        if (offset == 0) and (f.read(len(ARCHIVE_MAGIC)) == ARCHIVE_MAGIC):
+            return read_header(filename, offset=len(ARCHIVE_MAGIC))
+        f.seek(offset)
+        return parse_header(f, filename)
+
+
+def parse_header(f, name='stream'):
+    '''
+    Parses a SIGPROC header from the binary file object f, which has to be
+    positioned at its start, e.g. a BytesIO of the first bytes of a stream.
+    Returns the header dictionary and the size of the header in bytes.
+    '''
+    header = {}
+    start = f.tell()
+    if not _read_string(f) == 'HEADER_START':
+        raise InputError(f'{name} does not look like a SIGPROC filterbank file.')
+    while True:
+        key = _read_string(f)
+        if key == 'HEADER_END':
+            break
+        if key not in HEADER_KEYS:
+            raise InputError(f'Unknown keyword {key} in header of {name}.')
+        kind = HEADER_KEYS[key]
+        if kind == 's':
+            header[key] = _read_string(f)
+        elif kind == 'b':
+            header[key] = struct.unpack('b', f.read(1))[0]
+        else:
+            header[key] = struct.unpack(kind, f.read(struct.calcsize(kind)))[0]
+    header.setdefault('nifs', 1)
+    return header, f.tell() - start
+
+
+def get_dtype(nbits):
+    '''
+    Returns the numpy dtype of samples with nbits bits as written by digifil.
+    Packed sub-byte samples are returned as uint8.
+    '''
+    if nbits in PACKED_NBITS:
+        return np.uint8
+    dtypes = {8: np.uint8, 16: np.uint16, 32: np.float32, -32: np.float32}
+    if nbits not in dtypes:
+        raise InputError(f'nbits={nbits} not supported.')
+    return dtypes[nbits]
+
+
+def get_bytes_per_spectrum(header):
+    '''
+    Returns the number of bytes per time sample (all IFs and channels).
+    '''
+    nbits_total = header['nchans'] * header['nifs'] * abs(header['nbits'])
+    if not nbits_total % 8 == 0:
+        raise InputError(f'{header["nchans"]} channels with {header["nbits"]} bits do '+
+                         'not fill an integer number of bytes.')
+    return nbits_total // 8
+
+
+def unpack(raw, nbits):
+    '''
+    Unpacks 1, 2 or 4-bit samples along the last axis of the uint8 array raw.
+    The first sample is in the least significant bits, as written by digifil.
+    '''
+    if nbits not in PACKED_NBITS:
+        return raw
+    per_byte = 8 // nbits
+    shifts = (np.arange(per_byte, dtype=np.uint8) * nbits)
+    unpacked = (raw[..., np.newaxis] >> shifts) & np.uint8(2**nbits - 1)
+    return unpacked.reshape(raw.shape[:-1] + (raw.shape[-1] * per_byte,))
+
+
+def pack(data, nbits):
+    '''
+    Inverse of unpack: packs 1, 2 or 4-bit samples along the last axis of data.
+    '''
+    if nbits not in PACKED_NBITS:
+        return data
+    per_byte = 8 // nbits
+    data = np.asarray(data, dtype=np.uint8)
+    data = data.reshape(data.shape[:-1] + (data.shape[-1] // per_byte, per_byte))
+    shifts = (np.arange(per_byte, dtype=np.uint8) * nbits)
+    return np.bitwise_or.reduce(data << shifts, axis=-1).astype(np.uint8)
+
+
+def get_nsamples(header, header_size, filename):
+    '''
+    Returns the number of time samples in filename, computed from the file
+    size rather than trusting the (often missing) nsamples keyword.
+    '''
+    if is_archive(filename):
+        import fil_archive
+        return fil_archive.Archive(filename).nsamples
+    return (os.path.getsize(filename) - header_size) // get_bytes_per_spectrum(header)
+
+
+def get_freqs(header):
+    '''
+    Returns the centre frequencies in MHz of all channels in file order.
+    '''
+    return header['fch1'] + header['foff'] * np.arange(header['nchans'])
+
+
+def is_archive(filename):
+    with open(filename, 'rb') as f:
+        return f.read(len(ARCHIVE_MAGIC)) == ARCHIVE_MAGIC
+
+
+def open_data(filename):
+    '''
+    Memory-maps the data of filename. Returns the header dictionary and a
+    read-only array of shape (nsamples, nifs, nchans). For packed data (nbits<8)
+    the last axis holds the packed bytes; use unpack or read_block to get samples.
+    For an archive the array is replaced by a fil_archive.Archive, which
+    decompresses the blocks of the samples that are sliced out.
+    '''
+    if is_archive(filename):
+        import fil_archive
+        archive = fil_archive.Archive(filename)
+        return archive.header, archive
+    header, header_size = read_header(filename)
+    nsamples = get_nsamples(header, header_size, filename)
+    nbits = header['nbits']
+    ncols = header['nchans'] * nbits // 8 if nbits in PACKED_NBITS else header['nchans']
+    data = np.memmap(filename, dtype=get_dtype(nbits), mode='r', offset=header_size,
+                     shape=(nsamples, header['nifs'], ncols))
+    return header, data
+
+
+def read_block(filename, start, nsamples):
+    '''
+    Returns nsamples time samples of filename as of sample start with shape
+    (nsamples, nifs, nchans). This is a view into the memory map unless the data
+    need to be unpacked.
+    '''
+    header, data = open_data(filename)
+    return unpack(data[start:start+nsamples], header['nbits'])
+
+
+def total_intensity(data):
+    '''
+    Collapses the IF axis of data with shape (nsamples, nifs, nchans) into
+    total intensity, i.e. PP+QQ for full-polarisation data, as float32.
+    '''
+    return data[:, :min(data.shape[1], 2)].astype(np.float32).sum(axis=1)
+
+
+def iter_chunks(filename, nsamples, overlap=0, start=0, stop=None):
+    '''
+    Iterates over filename in chunks of nsamples time samples. Each chunk is
+    extended by overlap samples from the next chunk (e.g. the maximum dispersion
+    delay), while consecutive chunks start nsamples apart. Yields the sample
+    number the chunk starts at and an array of shape (n, nifs, nchans).
+    Only the current chunk is ever touched, so memory usage is bounded
+    independent of the file size.
+    '''
+    header, data = open_data(filename)
+    stop = data.shape[0] if stop is None else min(stop, data.shape[0])
+    for chunk_start in range(start, stop, nsamples):
+        chunk_stop = min(chunk_start + nsamples + overlap, stop)
+        yield chunk_start, unpack(data[chunk_start:chunk_stop], header['nbits'])
+
+
+def _write_string(f, string):
+    f.write(struct.pack('i', len(string)))
+    f.write(string.encode())
+
+
+def write_header(f, header):
+    '''
+    Writes header (a dictionary as returned by read_header) to the open
+    binary file f. Returns the number of bytes written.
+    '''
+    start = f.tell()
+    _write_string(f, 'HEADER_START')
+    for key, value in header.items():
+        if key not in HEADER_KEYS:
+            raise InputError(f'Unknown keyword {key}, cannot write it to a SIGPROC header.')
+        _write_string(f, key)
+        kind = HEADER_KEYS[key]
+        if kind == 's':
+            _write_string(f, value)
+        else:
+            f.write(struct.pack(kind, value))
+    _write_string(f, 'HEADER_END')
+    return f.tell() - start
+
+
+def write_data(f, data, nbits):
+    '''
+    Appends data of shape (nsamples, nifs, nchans) to the open binary file f,
+    converting to the sample type of nbits and packing if needed.
+    '''
+    if nbits in PACKED_NBITS:
+        f.write(pack(data, nbits).tobytes())
+    else:
+        f.write(np.asarray(data).astype(get_dtype(nbits), copy=False).tobytes())
+
+
+def write_filterbank(filename, header, chunks):
+    '''
+    Writes a new filterbank file. chunks is either one array of shape
+    (nsamples, nifs, nchans) or an iterable of such arrays, such that large
+    files can be written without holding them in memory.
+    '''
+    if isinstance(chunks, np.ndarray):
+        chunks = [chunks]
+    header = dict(header)
+    header.pop('nsamples', None)  # we cannot know this up front when streaming
+    with open(filename, 'wb') as f:
+        write_header(f, header)
+        for chunk in chunks:
+            write_data(f, chunk, header['nbits'])
+    return filename
+
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+    pass
+
+
+class InputError(Error):
+    """Exception raised for errors in the input.
+
+    Attributes:
+        message -- explanation of the error
+    """
+
+    def __init__(self, message):
+        self.message = message
+
+
+if __name__ == "__main__":
+    args = options()
+    header, header_size = read_header(args.filterbank)
+    header['nsamples'] = get_nsamples(header, header_size, args.filterbank)
+    if args.keyword is not None:
+        print(header[args.keyword])
+    else:
+        for key, value in header.items():
+            print(f'{key:15s}: {value}')
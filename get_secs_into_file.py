@@ -1,8 +1,8 @@
 #!/usr/bin/env python3
 
 import argparse
-from astropy.time import Time
 from extract_baseband_chunk import get_vdif_info, mount_files, cleanup
+from vlbi_time import mjd2yday
 
 
 def options():
@@ -53,7 +53,7 @@ def get_secs(info, mjds, datarate=128):
         for mjd in mjds:
             if (mjd > start) and (mjd < stop):
                 print(f'MJD {mjd} is at {(mjd-start)*86400:.3f} seconds into {infile}')
-                print(f"{mjd} is {Time(mjd, format='mjd', scale='utc').yday} in yday.\n")
+                print(f"{mjd} is {mjd2yday(mjd)} in yday.\n")
                 mjds_not_found.remove(mjd)
         # we don't need to search the mjds that we already found in the next outer loop again.
         mjds = mjds_not_found.copy()
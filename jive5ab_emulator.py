@@ -0,0 +1,577 @@
+#!/usr/bin/env python3
+'''
+Stand-in for jive5ab that implements the commands spif2file.sh sends via
+cmd2flexbuff, such that the split stage can be run and timed without a
+FlexBuff. Runtimes, the spif2file settings and spif2file=connect/on/? behave
+as in jive5ab: the recipe is applied to the local input file in a background
+thread, and spif2file? reports active until all output is written. Replies
+have the layout spif2file.sh parses, i.e. the state is the 10th field of
+what cmd2flexbuff prints for "runtime=...;spif2file?".
+
+Faults can be injected to see how the control flow copes: slow replies,
+commands that fail or get no reply at all, a throttled, stalling or aborted
+transfer.
+
+  jive5ab_emulator.py serve --port 2620          # then FLEXIP=127.0.0.1 FLEXPORT=2620
+  jive5ab_emulator.py bench exp ef 0001 8 VDIF_8000-512-16-2 --generate 20 --repeat 3
+
+bench runs the full spif2file control flow against an emulator in the same
+process and splits each run into the time spent before the transfer starts,
+the transfer itself and the polling after it ended.
+'''
+import argparse
+import os
+import random
+import re
+import socketserver
+import threading
+import time
+import numpy as np
+import readahead
+import vdif_decode
+import vlbi_time
+
+RECIPE = re.compile(r'^(swap_sign_mag\+)?(\d+)>((?:\[[\d,]+\])+):([\d,-]+)$')
+BLOCK_SIZE = 16 * 2**20
+WORD_DTYPES = {8: np.uint8, 16: np.uint16, 32: np.uint32, 64: np.uint64}
+
+
+def options():
+    parser = argparse.ArgumentParser(
+        description='Emulates the jive5ab commands used by spif2file on local files, with '+
+        'fault injection, and benchmarks the spif2file control flow against it.')
+    general = parser.add_argument_group('General info about the data.')
+    general.add_argument('action', type=str, choices=['serve', 'bench'],
+                         help='serve: run the emulator. bench: time spif2file against it.')
+    general.add_argument('scan', type=str, nargs='*',
+                         help='For bench: experiment station scan nif mode, as given to spif2file.')
+    general.add_argument('--host', type=str, default='127.0.0.1',
+                         help='Address to listen on. Default=%(default)s.')
+    general.add_argument('--port', type=int, default=None,
+                         help='Port to listen on, 0 picks a free one. Default is 2620 for serve '+
+                         'and a free one for bench.')
+    bench = parser.add_argument_group('Benchmark.')
+    bench.add_argument('--vbsdir', type=str, default=None,
+                       help='Directory with the recording <exp>_<st>_no0<scan>. Default is '+
+                       'a temporary directory, which needs --generate.')
+    bench.add_argument('--generate', type=float, default=0,
+                       help='Write this many seconds of synthetic VDIF as the recording first.')
+    bench.add_argument('--outdir', type=str, default=None,
+                       help='Where the IFs are written. Default is a temporary directory.')
+    bench.add_argument('--skip', type=float, default=0,
+                       help='Seconds to skip, as for spif2file. Default=%(default)s.')
+    bench.add_argument('--length', type=float, default=9999,
+                       help='Seconds to split, as for spif2file. Default=%(default)s.')
+    bench.add_argument('--repeat', type=int, default=1,
+                       help='Number of runs. Default=%(default)s.')
+    bench.add_argument('--first_poll', type=float, default=None,
+                       help='Passed to spif2file as SPIF2FILE_FIRST_POLL, seconds between '+
+                       'submitting the split and the first status query.')
+    bench.add_argument('--poll', type=float, default=None,
+                       help='Passed to spif2file as SPIF2FILE_POLL, seconds between status queries.')
+    bench.add_argument('--spif2file', type=str, default='spif2file',
+                       help='spif2file command to run. Default=%(default)s.')
+    bench.add_argument('--keep', action='store_true',
+                       help='Keep the split files of the last run.')
+    faults = parser.add_argument_group('Fault injection.')
+    faults.add_argument('--delay', type=float, default=0,
+                        help='Seconds before each reply. Default=%(default)s.')
+    faults.add_argument('--fail', type=float, default=0,
+                        help='Probability that a command fails with return code 4. Default=%(default)s.')
+    faults.add_argument('--silent', type=float, default=0,
+                        help='Probability that a command line gets no reply. Default=%(default)s.')
+    faults.add_argument('--rate', type=float, default=0,
+                        help='Limit the transfer to this many MB/s, 0 means no limit. Default=%(default)s.')
+    faults.add_argument('--stall', type=float, default=0,
+                        help='Seconds the transfer stalls halfway while staying active. Default=%(default)s.')
+    faults.add_argument('--abort', type=float, default=0,
+                        help='End the transfer after this fraction of the data, 0 means never. '+
+                        'Default=%(default)s.')
+    faults.add_argument('--seed', type=int, default=None,
+                        help='Seed for the random faults.')
+    return parser.parse_args()
+
+
+def parse_recipe(recipe):
+    '''
+    Returns whether sign and magnitude are swapped, the bits per input
+    sample and a list of (tag, bits) of a jive5ab splitter recipe such as
+    swap_sign_mag+32>[16,17,24,25][0,1,8,9]:0-1. The bits of each group go
+    to the output with that tag.
+    '''
+    match = RECIPE.match(recipe.strip())
+    if match is None:
+        raise InputError(f'Cannot parse recipe {recipe}.')
+    swap, word_bits, groups, tagspec = match.groups()
+    groups = [[int(b) for b in g.split(',')] for g in groups[1:-1].split('][')]
+    tags = []
+    for part in tagspec.split(','):
+        first, _, last = part.partition('-')
+        tags += list(range(int(first), int(last or first) + 1))
+    if not len(tags) == len(groups):
+        raise InputError(f'Recipe {recipe} has {len(groups)} groups but {len(tags)} tags.')
+    if int(word_bits) not in WORD_DTYPES:
+        raise InputError(f'Recipe {recipe}: {word_bits}-bit samples are not supported.')
+    return bool(swap), int(word_bits), list(zip(tags, groups))
+
+
+def _runs(bits):
+    '''
+    Returns (first input bit, length, first output bit) of the runs of
+    consecutive bits, such that e.g. 2-bit samples are moved in one go.
+    '''
+    runs = []
+    for out, b in enumerate(bits):
+        if runs and (b == runs[-1][0] + runs[-1][1]):
+            runs[-1][1] += 1
+        else:
+            runs.append([b, 1, out])
+    return runs
+
+
+class Splitter:
+    '''
+    Applies a recipe to blocks of input frames (VDIF or Mark5B) and returns
+    the VDIF frames of each output. Each output frame is made from a whole
+    number of input frames and carries the time of the first of them.
+    '''
+
+    def __init__(self, recipe, vdifsize, bitspersample, frame_size, mark5b=False):
+        self.swap, self.word_bits, self.outputs = parse_recipe(recipe)
+        self.mark5b = mark5b
+        self.header_size = vdif_decode.MARK5B_HEADER_SIZE if mark5b else vdif_decode.VDIF_HEADER_SIZE
+        self.frame_size = frame_size
+        self.payload = frame_size - self.header_size
+        self.vdifsize = vdifsize
+        self.bitspersample = bitspersample
+        self.ratio = {}
+        for tag, bits in self.outputs:
+            nbytes = self.payload * len(bits) / self.word_bits  # output bytes per input frame
+            if (len(bits) not in (1, 2, 4, 8, 16, 32, 64)) or not (vdifsize / nbytes).is_integer():
+                raise InputError(f'Groups of {len(bits)} bits of {self.payload} byte frames '+
+                                 f'do not fill {vdifsize} byte VDIF frames.')
+            self.ratio[tag] = int(vdifsize / nbytes)
+        # all outputs are written in step, each block has to fill whole frames of each
+        self.frames_per_block = int(np.lcm.reduce(list(self.ratio.values())))
+
+    def _times(self, frames):
+        if self.mark5b:
+            header = vdif_decode.parse_mark5b_headers(frames)
+            # Mark5B only has the last 3 digits of the MJD, the recording is assumed to be recent
+            today = int(time.time() // 86400) + 40587
+            mjd = today - (today - header['mjd_day'].astype(np.int64)) % 1000
+            ref_epoch, seconds = vlbi_time.mjd2vdif(mjd + header['seconds'] / 86400.)
+            return (np.asarray(ref_epoch), np.round(seconds).astype(np.int64),
+                    header['frame_nr'].astype(np.int64), np.zeros(len(frames), dtype=np.int64))
+        header = vdif_decode.parse_vdif_headers(frames)
+        return (header['ref_epoch'], header['seconds'].astype(np.int64),
+                header['frame_nr'].astype(np.int64), header['station'])
+
+    def split(self, frames):
+        '''
+        frames is a uint8 array of shape (n, frame_size) with n a multiple of
+        frames_per_block. Returns a dictionary that maps each tag to its
+        VDIF frames as bytes.
+        '''
+        n = len(frames)
+        words = np.ascontiguousarray(frames[:, self.header_size:]).view(
+            WORD_DTYPES[self.word_bits]).reshape(-1)
+        if self.swap:
+            mask = np.array(int('01' * (self.word_bits // 2), 2), dtype=words.dtype)
+            one = np.array(1, dtype=words.dtype)
+            words = ((words & mask) << one) | ((words >> one) & mask)
+        ref_epoch, seconds, frame_nr, station = self._times(frames)
+        out = {}
+        for tag, bits in self.outputs:
+            k = len(bits)
+            dtype = WORD_DTYPES[max(8, k)]
+            samples = np.zeros(len(words), dtype=dtype)
+            for first, length, pos in _runs(bits):
+                run = (words >> np.array(first, dtype=words.dtype)) & \
+                    np.array(2**length - 1, dtype=words.dtype)
+                samples |= run.astype(dtype) << np.array(pos, dtype=dtype)
+            if k < 8:
+                # several samples per byte, the first in the lowest bits
+                samples = samples.reshape(-1, 8 // k)
+                packed = np.zeros(len(samples), dtype=np.uint8)
+                for i in range(8 // k):
+                    packed |= samples[:, i] << np.uint8(i * k)
+                payload = packed.view(np.uint8)
+            else:
+                payload = samples.astype(samples.dtype.newbyteorder('<')).view(np.uint8)
+            ratio = self.ratio[tag]
+            first = np.arange(0, n, ratio)
+            headers = np.zeros((len(first), 4), dtype='<u4')
+            headers[:, 0] = seconds[first] & 0x3FFFFFFF
+            headers[:, 1] = (ref_epoch[first] << 24) | (frame_nr[first] // ratio)
+            headers[:, 2] = (int(np.log2(k // self.bitspersample)) << 24) | ((self.vdifsize + 32) // 8)
+            headers[:, 3] = ((self.bitspersample - 1) << 26) | (tag << 16) | (station[first] & 0xFFFF)
+            block = np.zeros((len(first), self.vdifsize + 32), dtype=np.uint8)
+            block[:, :16] = headers.view(np.uint8)
+            block[:, 32:] = payload.reshape(len(first), self.vdifsize)
+            out[tag] = block.tobytes()
+        return out
+
+
+class Faults:
+    '''
+    What goes wrong, and how often.
+    '''
+
+    def __init__(self, delay=0, fail=0, silent=0, rate=0, stall=0, abort=0, seed=None):
+        self.delay = delay
+        self.fail = fail
+        self.silent = silent
+        self.rate = rate
+        self.stall = stall
+        self.abort = abort
+        self.random = random.Random(seed)
+
+    def happens(self, probability):
+        return (probability > 0) and (self.random.random() < probability)
+
+
+class Transfer(threading.Thread):
+    '''
+    A spif2file=on: splits bytes start to stop of infile into the outputs.
+    '''
+
+    def __init__(self, settings, start, stop, faults, log):
+        super().__init__(daemon=True)
+        self.settings = dict(settings)
+        self.start_byte = start
+        self.stop_byte = stop
+        self.faults = faults
+        self.log = log
+        self.nbytes = 0
+        self.error = None
+        self.started = time.time()
+        self.stopped = threading.Event()
+
+    def run(self):
+        infile, recipe, pattern, flag = self.settings['connect']
+        files = {}
+        try:
+            frame_size = vdif_decode.get_frame_size(infile)
+            mark5b = frame_size == vdif_decode.MARK5B_HEADER_SIZE + vdif_decode.MARK5B_PAYLOAD_SIZE
+            splitter = Splitter(recipe, self.settings.get('vdifsize', frame_size - 32),
+                                self.settings.get('bitspersample', 2), frame_size, mark5b)
+            step = splitter.frames_per_block * frame_size
+            start = self.start_byte // frame_size * frame_size
+            # output frames start on multiples of frames_per_block, such that they count from 0 each second
+            first = np.frombuffer(readahead.read_range(infile, start, frame_size), dtype=np.uint8)
+            if len(first) == frame_size:
+                frame_nr = splitter._times(first.reshape(1, frame_size))[2][0]
+                start += int(-frame_nr % splitter.frames_per_block) * frame_size
+            stop = min(self.stop_byte, os.path.getsize(infile))
+            stop = start + (stop - start) // step * step
+            if self.faults.abort > 0:
+                stop = start + int((stop - start) * self.faults.abort) // step * step
+            files = {tag: open(pattern.replace('{tag}', str(tag)), 'ab' if 'a' in flag else 'wb')
+                     for tag, _ in splitter.outputs}
+            block = max(BLOCK_SIZE // step, 1) * step
+            stalled = self.faults.stall <= 0
+            t0 = time.time()
+            with readahead.Reader(infile, start, stop - start) as reader:
+                while (self.nbytes < stop - start) and not self.stopped.is_set():
+                    raw = reader.read(block)
+                    if len(raw) < step:
+                        break
+                    frames = np.frombuffer(raw[:len(raw) // step * step], dtype=np.uint8)
+                    for tag, data in splitter.split(frames.reshape(-1, frame_size)).items():
+                        files[tag].write(data)
+                    self.nbytes += len(raw)
+                    if self.faults.rate > 0:
+                        time.sleep(max(0, t0 + self.nbytes / (self.faults.rate * 1e6) - time.time()))
+                    if not stalled and (self.nbytes >= (stop - start) / 2):
+                        stalled = True
+                        self.log('stall', seconds=self.faults.stall)
+                        self.stopped.wait(self.faults.stall)
+        except Exception as e:
+            self.error = e
+            self.log('error', message=str(e))
+        finally:
+            for f in files.values():
+                f.close()
+        self.log('done', nbytes=self.nbytes, started=self.started)
+
+
+class Emulator:
+    '''
+    The state of all runtimes and the command interpreter. Every command
+    and the end of every transfer is recorded in events with its time.
+    '''
+
+    def __init__(self, faults=None, verbose=False):
+        self.faults = Faults() if faults is None else faults
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.runtimes = {}
+        self.events = []
+
+    def log(self, runtime, event, **info):
+        entry = dict(time=time.time(), runtime=runtime, event=event, **info)
+        with self.lock:
+            self.events.append(entry)
+        if self.verbose:
+            details = ' '.join(f'{k}={v}' for k, v in info.items())
+            print(f'{time.strftime("%d-%m-%y %H:%M:%S")} [{runtime}] {event} {details}', flush=True)
+
+    def runtime(self, name):
+        with self.lock:
+            return self.runtimes.setdefault(name, {'settings': {}, 'transfer': None})
+
+    def execute(self, line, session):
+        '''
+        Executes the ;-separated commands of line for a connection whose
+        current runtime is session['runtime']. Returns the reply line or None
+        for no reply.
+        '''
+        if self.faults.happens(self.faults.silent):
+            self.log(session['runtime'], 'silent', line=line)
+            return None
+        replies = []
+        for command in line.split(';'):
+            command = command.strip()
+            if command:
+                replies.append(self.command(command, session))
+        if self.faults.delay > 0:
+            time.sleep(self.faults.delay)
+        return ' '.join(replies)
+
+    def command(self, command, session):
+        query = '?' in command.split('=')[0]
+        name, _, args = command.partition('?' if query else '=')
+        name, args = name.strip(), args.strip()
+        sep = '?' if query else ' ='
+        if self.faults.happens(self.faults.fail):
+            self.log(session['runtime'], 'fault', command=command)
+            return f'!{name}{sep} 4 : fault injected;'
+        self.log(session['runtime'], name + ('?' if query else '='), args=args)
+        try:
+            if name == 'runtime':
+                return f'!runtime{sep} 0 : {self._runtime(query, args, session)};'
+            if name == 'spif2file':
+                return f'!spif2file{sep} {self._spif2file(query, args, session["runtime"])};'
+            if name in ('mode', 'net_protocol') and not query:
+                self.runtime(session['runtime'])['settings'][name] = args
+                return f'!{name}{sep} 0;'
+        except InputError as e:
+            return f'!{name}{sep} 4 : {e.message};'
+        return f'!{name}{sep} 7 : unknown command;'
+
+    def _runtime(self, query, args, session):
+        if query or not args:
+            return session['runtime']
+        name, _, action = args.partition(':')
+        if action.strip() == 'delete':
+            with self.lock:
+                entry = self.runtimes.pop(name, None)
+            if entry and entry['transfer'] is not None:
+                entry['transfer'].stopped.set()
+            session['runtime'] = '0'
+            return name
+        session['runtime'] = name
+        self.runtime(name)
+        return name
+
+    def _spif2file(self, query, args, runtime):
+        entry = self.runtime(runtime)
+        transfer = entry['transfer']
+        if query:
+            active = (transfer is not None) and transfer.is_alive()
+            nbytes = 0 if transfer is None else transfer.nbytes
+            return f'0 : {"active" if active else "inactive"} : {nbytes}'
+        action, _, rest = args.partition(':')
+        if action in ('vdifsize', 'bitspersample', 'bitsperchannel'):
+            entry['settings'][action] = int(rest)
+            return '0'
+        if action == 'connect':
+            infile, _, rest = rest.partition(':')
+            recipe, _, output = rest.rpartition('=')
+            pattern, _, flag = output.partition(',')
+            if not os.path.exists(infile):
+                raise InputError(f'cannot open {infile}')
+            parse_recipe(recipe)
+            entry['settings']['connect'] = (infile, recipe, pattern, flag or 'w')
+            return '0'
+        if action == 'on':
+            if 'connect' not in entry['settings']:
+                raise InputError('not connected')
+            if (transfer is not None) and transfer.is_alive():
+                raise InputError('already active')
+            start, _, stop = rest.partition(':')
+            entry['transfer'] = Transfer(entry['settings'], int(start or 0), int(stop or 2**62),
+                                         self.faults, lambda event, **info: self.log(runtime, event, **info))
+            entry['transfer'].start()
+            return '1'
+        if action in ('off', 'disconnect'):
+            if transfer is not None:
+                transfer.stopped.set()
+            if action == 'disconnect':
+                entry['settings'].pop('connect', None)
+            return '0'
+        raise InputError(f'unknown action {action}')
+
+
+def serve(emulator, host='127.0.0.1', port=0):
+    '''
+    Returns a started TCP server for emulator; cmd2flexbuff keeps the
+    connection open until it gives up waiting, so connections are only
+    closed by the client.
+    '''
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            session = {'runtime': '0'}
+            t0 = time.time()
+            for line in self.rfile:
+                line = line.decode(errors='replace').strip()
+                if line:
+                    reply = emulator.execute(line, session)
+                    if reply is not None:
+                        self.wfile.write(reply.encode() + b'\n')
+            emulator.log(session['runtime'], 'connection', seconds=time.time() - t0)
+
+    server = socketserver.ThreadingTCPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def generate(filename, mode, seconds):
+    '''
+    Writes seconds of VDIF with random samples and consecutive headers in
+    the given mode, starting at the current second.
+    '''
+    fmt, payload, datarate, nchan, nbits = vdif_decode.parse_mode(mode)
+    if not fmt == 'vdif':
+        raise InputError('Only VDIF modes can be generated.')
+    fps = int(datarate * 1e6 / 8 / payload)
+    ref_epoch, start = vlbi_time.mjd2vdif(time.time() / 86400. + 40587)
+    rng = np.random.default_rng(1)
+    noise = rng.integers(0, 256, size=(fps, payload), dtype=np.uint8)
+    headers = np.zeros((fps, 8), dtype='<u4')
+    headers[:, 1] = (ref_epoch << 24) | np.arange(fps)
+    headers[:, 2] = (int(np.log2(nchan)) << 24) | ((payload + 32) // 8)
+    headers[:, 3] = (nbits - 1) << 26
+    with open(filename, 'wb') as f:
+        for s in range(int(np.ceil(seconds))):
+            headers[:, 0] = int(start) + s
+            f.write(np.concatenate([headers.view(np.uint8), np.roll(noise, s, axis=0)], axis=1).tobytes())
+
+
+def bench(args, emulator, port):
+    '''
+    Runs spif2file args.repeat times against emulator and prints where the
+    time went.
+    '''
+    import shutil
+    import subprocess
+    import tempfile
+    if not len(args.scan) == 5:
+        raise InputError('bench needs experiment station scan nif mode.')
+    experiment, station, scan, nif, mode = args.scan
+    for prog in [args.spif2file, 'cmd2flexbuff', 'vdif_print_headers']:
+        if shutil.which(prog) is None:
+            raise InputError(f'{prog} is not in PATH.')
+    tmpdir = tempfile.mkdtemp(prefix='jive5ab_bench_')
+    vbsdir = args.vbsdir or f'{tmpdir}/vbs'
+    outdir = args.outdir or f'{tmpdir}/out'
+    os.makedirs(vbsdir, exist_ok=True)
+    recording = f'{vbsdir}/{experiment}_{station}_no0{scan}'
+    if args.generate > 0:
+        generate(recording, mode, args.generate)
+    if not os.path.exists(recording):
+        raise InputError(f'{recording} does not exist, use --generate.')
+    env = dict(os.environ, FLEXIP=args.host, FLEXPORT=str(port))
+    if args.first_poll is not None:
+        env['SPIF2FILE_FIRST_POLL'] = str(args.first_poll)
+    if args.poll is not None:
+        env['SPIF2FILE_POLL'] = str(args.poll)
+    command = [args.spif2file, experiment, station, scan, nif, mode, str(args.skip),
+               str(args.length), scan, '0', vbsdir, outdir, outdir, '0']
+    results = []
+    for run in range(args.repeat):
+        first_event = len(emulator.events)
+        t0 = time.time()
+        proc = subprocess.run(command, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        t1 = time.time()
+        events = emulator.events[first_event:]
+        on = [e['time'] for e in events if e['event'] == 'spif2file=' and e['args'].startswith('on')]
+        # transfers left running by an earlier run may end during this one
+        done = [e for e in events if (e['event'] == 'done') and (e['started'] >= t0)]
+        running = [r['transfer'] for r in list(emulator.runtimes.values())
+                   if (r['transfer'] is not None) and r['transfer'].is_alive()]
+        nbytes = sum(e['nbytes'] for e in done)
+        t_on = on[0] if on else t1
+        t_done = done[-1]['time'] if done else t_on
+        result = {'wall': t1 - t0, 'setup': t_on - t0, 'transfer': t_done - t_on,
+                  'tail': t1 - t_done, 'nbytes': nbytes,
+                  'commands': sum(1 for e in events if e['event'].endswith(('=', '?'))),
+                  'connections': sum(1 for e in events if e['event'] == 'connection'),
+                  'in_cmd2flexbuff': sum(e['seconds'] for e in events if e['event'] == 'connection'),
+                  'running': len(running),
+                  'faults': sum(1 for e in events if e['event'] in ('fault', 'silent')),
+                  'errors': [e['message'] for e in events if e['event'] == 'error']}
+        results.append(result)
+        print(f'run {run+1}: {result["wall"]:.1f}s total, {result["setup"]:.1f}s before the '+
+              f'transfer, {result["transfer"]:.1f}s transfer ({nbytes/1e6/max(result["transfer"], 1e-3):.0f} '+
+              f'MB/s), {result["tail"]:.1f}s after it; {result["connections"]} cmd2flexbuff calls '+
+              f'took {result["in_cmd2flexbuff"]:.1f}s; {result["faults"]} faults injected; '+
+              f'exit code {proc.returncode}')
+        if running:
+            print(f'  {len(running)} transfer(s) still active when spif2file returned')
+        for error in result['errors']:
+            print(f'  transfer error: {error}')
+        if proc.returncode:
+            print(proc.stdout.decode(errors='replace'))
+        if (run < args.repeat - 1) or not args.keep:
+            for i in range(int(nif)):
+                vdif = f'{outdir}/{experiment}_{station}_no0{scan}_IF{i+1}.vdif'
+                if os.path.exists(vdif):
+                    os.remove(vdif)
+    wall = np.mean([r['wall'] for r in results])
+    transfer = np.mean([r['transfer'] for r in results])
+    print(f'mean of {len(results)} runs: {wall:.1f}s total of which {transfer:.1f}s transfer, '+
+          f'{wall - transfer:.1f}s ({(wall - transfer) / max(wall, 1e-3) * 100:.0f}%) control overhead')
+    if args.vbsdir is None:
+        shutil.rmtree(f'{tmpdir}/vbs', ignore_errors=True)
+    if (args.outdir is None) and not args.keep:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return results
+
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+    pass
+
+
+class InputError(Error):
+    """Exception raised for errors in the input.
+
+    Attributes:
+        message -- explanation of the error
+    """
+
+    def __init__(self, message):
+        self.message = message
+
+
+if __name__ == "__main__":
+    args = options()
+    faults = Faults(args.delay, args.fail, args.silent, args.rate, args.stall, args.abort, args.seed)
+    emulator = Emulator(faults, verbose=(args.action == 'serve'))
+    if args.port is None:
+        args.port = 2620 if args.action == 'serve' else 0
+    server = serve(emulator, args.host, args.port)
+    port = server.server_address[1]
+    if args.action == 'serve':
+        print(f'Emulating jive5ab on {args.host}:{port}, set FLEXIP={args.host} FLEXPORT={port}.',
+              flush=True)
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+    else:
+        bench(args, emulator, port)
+    server.shutdown()
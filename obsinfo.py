@@ -1,9 +1,7 @@
 #!/usr/bin/env python3
 import argparse
-from astropy.time import Time
-import os
-import pandas as pd
-from create_config import vex2dic, sched2df, fixStationName, getFreq
+import query_server
+from create_config import loadSchedule, fixStationName, getFreq
 
 def options():
     parser = argparse.ArgumentParser()
@@ -37,19 +35,7 @@ def options():
 
 
 def main(args):
-    vexfile = os.path.abspath(args.vexfile)
-    vex = vex2dic(vexfile)
-    # per default we expect the dataframe to be in the same dir
-    # as the vexfile. If it's not there we create it such that
-    # we can re-use it again later.
-    sched_dir = os.path.dirname(vexfile)
-    vexfile_name = os.path.basename(vexfile)
-    df_file = f'{sched_dir}/{vexfile_name}.df'
-    if not os.path.exists(df_file):
-        df = sched2df(vex)
-        df.to_pickle(df_file)
-    else:
-        df = pd.read_pickle(df_file)
+    vex, df, _ = loadSchedule(args.vexfile)
     if not args.setup == None:
         fmodes = list(df.fmode.unique())
         stations = list(df.station.unique())
@@ -85,10 +71,10 @@ def main(args):
         df = df[(df.station == station)]
         if args.sources:
             if args.time_spent:
-                sources = list(df.source.unique())
-                times = [df[(df.source == source)]['length_sec'].sum() -
-                         df[(df.source == source)]['missing_sec'].sum() for source in sources]
-                missing = [df[(df.source == source)]['missing_sec'].sum() for source in sources]
+                totals = df.groupby('source', sort=False)[['length_sec', 'missing_sec']].sum()
+                sources = list(totals.index)
+                missing = list(totals.missing_sec)
+                times = list(totals.length_sec - totals.missing_sec)
                 for source, time, miss in zip(sources, times, missing):
                     print(f'{source}: {time} s = {time/60.:.2f} min = {time/60./60.:.2f} hrs')
                     print(f'Recording but off source: {miss/60./60.:.2f} hrs')
@@ -119,5 +105,6 @@ def main(args):
 
 
 if __name__ == "__main__":
-    args = options()
-    main(args)
+    if not query_server.forward('obsinfo'):
+        args = options()
+        main(args)
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+'''
+Sizes the buffers of the fifos between digifil and splice and monitors how
+full they are while data flow. The buffer size follows from the byte rate of
+the filterbank each digifil writes and is capped by the system limits in
+/proc/sys/fs. The fifos are opened (non-blocking, read-only) right after they
+were created and are kept open until splice is done, such that the buffer size
+is set before any data flow and the fill levels can be sampled via FIONREAD.
+Never reads any data from the fifos.
+
+A fifo that is mostly empty while the others are full belongs to the IF whose
+digifil holds up splice; if all of them are full, splice (or the disk it
+writes to) is the bottleneck.
+'''
+import argparse
+import fcntl
+import os
+import struct
+import termios
+import time
+import numpy as np
+
+# not exposed by the fcntl module of older python versions
+F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+F_GETPIPE_SZ = getattr(fcntl, 'F_GETPIPE_SZ', 1032)
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+DEFAULT_PIPE_SIZE = 16 * PAGE_SIZE
+
+
+def options():
+    parser = argparse.ArgumentParser(
+        description='Sets the buffer size of the fifos between digifil and splice according '+
+        'to the data rate and reports their fill levels.')
+    general = parser.add_argument_group('General info about the data.')
+    general.add_argument('fifos', type=str, nargs='+',
+                         help='The fifos, one per IF.')
+    general.add_argument('--bw', type=float, required=True,
+                         help='Bandwidth per IF in MHz.')
+    general.add_argument('--nchan', type=int, default=1,
+                         help='Number of channels per IF. Default=%(default)s.')
+    general.add_argument('--nbit', type=int, default=8, choices=[2, 8, 16, -32],
+                         help='Bit depth of the filterbanks. Default=%(default)s.')
+    general.add_argument('--pol', type=int, default=2, choices=[0, 1, 2, 3, 4],
+                         help='Polarisation product as passed to process_vdif. Default=%(default)s.')
+    general.add_argument('--tscrunch', type=int, default=1,
+                         help='Downsampling factor of digifil. Default=%(default)s.')
+    general.add_argument('--buffer_sec', type=float, default=0.5,
+                         help='Seconds of data each fifo should be able to hold. '+
+                         'Default=%(default)s.')
+    general.add_argument('--interval', type=float, default=1.0,
+                         help='Seconds between two samples of the fill levels. '+
+                         'Default=%(default)s.')
+    general.add_argument('--pid', type=int, default=None,
+                         help='Stop monitoring once this process (e.g. the one running splice) '+
+                         'has finished. Monitoring stops anyway once all fifos are removed.')
+    general.add_argument('--size_only', action='store_true',
+                         help='If set will only print the buffer size and exit.')
+    return parser.parse_args()
+
+
+def _read_proc(name, default):
+    try:
+        with open(f'/proc/sys/fs/{name}') as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return default
+
+
+def byte_rate(bw, nbit=8, pol=2, tscrunch=1):
+    '''
+    Returns the number of bytes per second digifil writes for one IF of
+    bw MHz. The number of channels does not matter as the sampling time
+    scales with it.
+    '''
+    npol = 4 if pol == 4 else 1
+    return bw * 1e6 / tscrunch * npol * abs(nbit) / 8.
+
+
+def pipe_size(rate, buffer_sec=0.5, nfifos=1, min_size=0):
+    '''
+    Returns the buffer size in bytes for a fifo that carries rate bytes per
+    second such that it holds buffer_sec seconds of data (but at least
+    min_size bytes). The kernel only accepts powers of two pages and each
+    fifo may use at most pipe-max-size bytes; the buffers of all nfifos
+    together have to stay within the soft limit per user, too.
+    '''
+    max_size = _read_proc('pipe-max-size', 1048576)
+    soft_pages = _read_proc('pipe-user-pages-soft', 0)
+    if soft_pages > 0:
+        max_size = min(max_size, soft_pages * PAGE_SIZE // max(nfifos, 1))
+    size = max(rate * buffer_sec, min_size, DEFAULT_PIPE_SIZE)
+    size = PAGE_SIZE * 2**int(np.ceil(np.log2(size / PAGE_SIZE)))
+    # max_size need not be a power of two pages
+    while (size > max_size) and (size > DEFAULT_PIPE_SIZE):
+        size //= 2
+    return int(size)
+
+
+def open_fifo(fifo, size):
+    '''
+    Opens fifo without blocking and without consuming any data and sets its
+    buffer to size bytes. Returns the file descriptor and the actual buffer
+    size, which may be smaller than requested if the system does not allow more.
+    '''
+    fd = os.open(fifo, os.O_RDONLY | os.O_NONBLOCK)
+    try:
+        actual = fcntl.fcntl(fd, F_SETPIPE_SZ, size)
+    except OSError as e:
+        print(f'Could not set the buffer of {fifo} to {size} bytes: {e.strerror}')
+        actual = fcntl.fcntl(fd, F_GETPIPE_SZ)
+    return fd, actual
+
+
+def fill_level(fd):
+    '''
+    Returns the number of bytes waiting in the pipe behind fd.
+    '''
+    buf = fcntl.ioctl(fd, termios.FIONREAD, struct.pack('i', 0))
+    return struct.unpack('i', buf)[0]
+
+
+def _alive(pid):
+    if pid is None:
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def monitor(fifos, sizes, fds, interval=1.0, pid=None):
+    '''
+    Samples the fill levels of all fifos every interval seconds until pid
+    has finished or all fifos are removed. Samples taken before any data
+    flowed are not counted. Returns an array of shape (nsamples, nfifos)
+    with the fill levels as fraction of the buffer size.
+    '''
+    levels = []
+    started = False
+    while _alive(pid) and any(os.path.exists(fifo) for fifo in fifos):
+        level = np.array([fill_level(fd) for fd in fds]) / np.array(sizes, dtype=float)
+        started |= level.any()
+        if started:
+            levels.append(level)
+        time.sleep(interval)
+    return np.array(levels).reshape(-1, len(fifos))
+
+
+def report(fifos, levels, full=0.9, empty=0.1):
+    '''
+    Prints the fill statistics of each fifo and which stage looks like
+    the bottleneck. Returns the name of the bottleneck fifo, 'splice' or None.
+    '''
+    if len(levels) == 0:
+        print('No data were seen in the fifos.')
+        return None
+    mean = levels.mean(axis=0)
+    frac_full = (levels >= full).mean(axis=0)
+    frac_empty = (levels <= empty).mean(axis=0)
+    for i, fifo in enumerate(fifos):
+        print(f'{os.path.basename(fifo)}: mean fill {100*mean[i]:5.1f}%, '+
+              f'full {100*frac_full[i]:5.1f}%, empty {100*frac_empty[i]:5.1f}% of the time')
+    if frac_full.min() > 0.5:
+        print('All fifos are full most of the time, splice is the bottleneck.')
+        return 'splice'
+    slowest = int(np.argmin(mean))
+    if mean[slowest] < np.median(mean) - 0.25:
+        print(f'Bottleneck is the digifil writing to {os.path.basename(fifos[slowest])}.')
+        return fifos[slowest]
+    print('The fifos are filled evenly, no single IF is holding up splice.')
+    return None
+
+
+if __name__ == "__main__":
+    args = options()
+    npol = 4 if args.pol == 4 else 1
+    rate = byte_rate(args.bw, args.nbit, args.pol, args.tscrunch)
+    # a fifo should at least hold a couple of spectra
+    min_size = 2 * args.nchan * npol * abs(args.nbit) // 8
+    size = pipe_size(rate, args.buffer_sec, len(args.fifos), min_size)
+    if args.size_only:
+        print(size)
+    else:
+        fds, sizes = zip(*[open_fifo(fifo, size) for fifo in args.fifos])
+        print(f'Set the buffers of {len(fds)} fifos to {min(sizes)} bytes '+
+              f'({rate/1e6:.1f} MB/s per IF).')
+        try:
+            levels = monitor(args.fifos, sizes, fds, args.interval, args.pid)
+        finally:
+            for fd in fds:
+                os.close(fd)
+        report(args.fifos, levels)
@@ -4,6 +4,9 @@ import subprocess
 import os, stat
 import string
 import random
+import math
+import time
+import dedisperse
 
 
 def options():
@@ -75,14 +78,31 @@ def options():
     digifil.add_argument('--nthreads', type=int, default=1,
                          help='Number of threads to use per instance of digifil. '+
                          'Default=%(default)s.')
+    digifil.add_argument('--cpus', type=str, default=None,
+                         help='If set digifil is bound to these CPUs, e.g. 0-3,8. '+
+                         'Default is to leave this to the kernel.')
+    digifil.add_argument('--mem_node', type=int, default=None,
+                         help='If set (and numactl is available) digifil will allocate its '+
+                         'memory on this NUMA node.')
+    digifil.add_argument('--coherent', action='store_true',
+                         help='If set digifil coherently dedisperses to --dm, or if that is not '+
+                         'given to the DM of psrname as known to dm_utils (FRBs and psrcat).')
+    digifil.add_argument('--nfft', type=int, default=None,
+                         help='FFT length per channel for coherent dedispersion. Default is '+
+                         'the one with the highest throughput given the dispersion smearing.')
     prepdata.add_argument('--do_prepdata', action='store_true',
-                          help='If set will run prepdata or prepsubband on filterbank files')
+                          help='If set will dedisperse the filterbank files.')
+    prepdata.add_argument('--presto', action='store_true',
+                          help='If set will run PRESTO\'s prepdata or prepsubband instead of '+
+                          'the native dedispersion engine (dedisperse.py).')
     prepdata.add_argument('--ncpus', type=int, default=1,
-                          help='Number of cpus to use. Only affects whether ' +
+                          help='Number of cpus to use. For the native engine this is the number '+
+                          'of worker processes. For PRESTO only affects whether ' +
                           'prepdata (ncpus=1) or prepsubband (ncpus>1) is used.'+
                           'Default=%(default)s.')
     prepdata.add_argument('--dm', type=float, default=None,
-                          help='Dispersion measure to use. Default is that which psrcat provides.')
+                          help='Dispersion measure to use, also for --coherent. '+
+                          'Default is that which psrcat provides.')
     prepdata.add_argument('--nozerodm', action='store_false',
                           help='if set will not add -zerodm to prepdata/prepsubband commands.')
     prepdata.add_argument('--clip', type=int, default=5,
@@ -139,7 +159,51 @@ def make_hdr(psr, freq, filename, pol=2, usb=True, ra=None, dec=None,
     return hdrfile
 
 
-def run_digifil(hdr, fil_out_dir=None, start=1, nsecs=120, nchan=128, overwrite=False, pol=2, nbit=8, tscrunch=1, nthreads=1, dm=0.0, coherent=False, keepBP=False):
+def bind_cpus(cpulist):
+    '''
+    Binds this process, and with it digifil, to the CPUs in cpulist (e.g.
+    0-3,8). Returns the CPUs actually bound to.
+    '''
+    from cpu_placement import parse_cpulist, format_cpulist
+    cpus = set(parse_cpulist(cpulist)) & os.sched_getaffinity(0)
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+    return format_cpulist(os.sched_getaffinity(0))
+
+
+def dispersion_smearing(dm, flo, fhi):
+    '''
+    Returns the dispersion delay in seconds between flo and fhi (MHz).
+    '''
+    return dedisperse.DISPERSION_CONSTANT * dm * (flo**-2 - fhi**-2)
+
+
+def coherent_fft_length(dm, freq, bw, nchan, max_nfft=2**20):
+    '''
+    Returns the FFT length per channel with the highest throughput for
+    coherent dedispersion to dm of nchan channels across bw MHz centred on
+    freq, and the number of samples consecutive FFTs overlap by. The overlap
+    is the smearing within the lowest channel; of each FFT of length nfft only
+    nfft-overlap samples are kept, such that the cost per output sample goes
+    as nfft*log(nfft)/(nfft-overlap).
+    '''
+    chan_bw = abs(bw) / nchan
+    flo = freq - abs(bw) / 2
+    # channels are complex sampled at their bandwidth
+    overlap = int(math.ceil(dispersion_smearing(dm, flo, flo + chan_bw) * chan_bw * 1e6))
+    overlap += overlap % 2
+    nfft = 16
+    while nfft <= overlap:
+        nfft *= 2
+    best = nfft
+    while nfft <= max_nfft:
+        if nfft * math.log2(nfft) / (nfft - overlap) < best * math.log2(best) / (best - overlap):
+            best = nfft
+        nfft *= 2
+    return best, overlap
+
+
+def run_digifil(hdr, fil_out_dir=None, start=1, nsecs=120, nchan=128, overwrite=False, pol=2, nbit=8, tscrunch=1, nthreads=1, dm=0.0, coherent=False, keepBP=False, mem_node=None, nfft=None):
     filterbankfile = hdr.replace('.hdr', '.fil')
     if fil_out_dir is not None:
         filterbankfile = '{0}/{1}'.format(fil_out_dir, os.path.basename(filterbankfile))
@@ -154,12 +218,13 @@ def run_digifil(hdr, fil_out_dir=None, start=1, nsecs=120, nchan=128, overwrite=
     if not nbit in valid_nbit:
         raise InputError(f'nbit={nbit} not in supported values of {valid_nbit}. ')
     if tscrunch > 1:
-        cmd = 'digifil -cont -c -b{4} -S{0} -T{1} -2 -D 0.0 -t {6} -o {2} {3} -threads {5}'.format(
-            start, nsecs, filterbankfile, hdr, nbit, nthreads, tscrunch)
+        cmd = 'digifil -cont -c -b{4} -S{0} -T{1} -2 -D {7} -t {6} -o {2} {3} -threads {5}'.format(
+            start, nsecs, filterbankfile, hdr, nbit, nthreads, tscrunch, dm)
     else:
-        cmd = 'digifil -cont -c -b{4} -S{0} -T{1} -2 -D 0.0 -o {2} {3} -threads {5}'.format(
-            start, nsecs, filterbankfile, hdr, nbit, nthreads)
-    leakage_factor = 512 if nchan <= 128 else 2*nchan
+        cmd = 'digifil -cont -c -b{4} -S{0} -T{1} -2 -D {6} -o {2} {3} -threads {5}'.format(
+            start, nsecs, filterbankfile, hdr, nbit, nthreads, dm)
+    # a coherent filterbank dedisperses within each channel as it forms them
+    leakage_factor = 'D' if (coherent and dm > 0.0) else (512 if nchan <= 128 else 2*nchan)
     if pol < 2:
         cmd = '{0} -P{1} -F{2}:{3}'.format(cmd, pol, nchan, leakage_factor)
     else:
@@ -174,12 +239,16 @@ def run_digifil(hdr, fil_out_dir=None, start=1, nsecs=120, nchan=128, overwrite=
             cmd = '{0} -d3 -F{1}:{2}'.format(cmd, nchan, leakage_factor)
         else:
             raise InputError(f'pol = {pol} not implemented. Choices are 0, 1, 2, 3, 4')
-    if dm > 0.0:
-        cmd = '{0} -D {1}'.format(cmd, dm)
-        if coherent:
-            cmd = '{0} -F{1}:D'.format(cmd, nchan)
+    if coherent and dm > 0.0:
+        cmd = '{0} -do_dedisp true'.format(cmd)
+        if nfft is not None:
+            cmd = '{0} -x {1}'.format(cmd, nfft)
     if keepBP:
         cmd = '{0} -I0'.format(cmd)
+    if mem_node is not None:
+        import shutil
+        if shutil.which('numactl'):
+            cmd = 'numactl --preferred={0} {1}'.format(mem_node, cmd)
     print('running {0}'.format(cmd))
     try:
         id = id_generator()
@@ -188,14 +257,20 @@ def run_digifil(hdr, fil_out_dir=None, start=1, nsecs=120, nchan=128, overwrite=
         id = id_generator()
         outfile_nme = '/tmp/digifil.{0}'.format(id)
         outfile = open(outfile_nme, 'w')
+        t0 = time.perf_counter()
         subprocess.check_call(cmd, shell=True, stdout=outfile,
                               stderr=errfile)
+        elapsed = time.perf_counter() - t0
     except subprocess.CalledProcessError:
         with open(outfile_nme, 'r') as f:
             stdout = f.readlines()
         with open(errfile_nme, 'r') as f:
             stderr = f.readlines()
         raise RunError(f'Digifil died. \n stdout reports \n {stdout} \n stderr reports \n {stderr}')
+    # one line per run such that coherent and incoherent runs can be compared from the logs
+    mode = f'coherent dm={dm} nfft={nfft}' if (coherent and dm > 0.0) else 'incoherent'
+    print(f'digifil timing: {os.path.basename(filterbankfile)} {mode} nchan={nchan} '+
+          f'wall={elapsed:.1f}s data={nsecs}s realtime={nsecs/elapsed:.2f}x')
     return filterbankfile
 
 
@@ -270,14 +345,36 @@ if __name__ == "__main__":
     if args.hdr_only:
         print("Not creating filterbanks. Hdr files done.")
         quit(0)
+    if args.cpus is not None:
+        node = '' if args.mem_node is None else f' (NUMA node {args.mem_node})'
+        print(f'{os.path.basename(args.filename)} runs on cpus {bind_cpus(args.cpus)}{node}')
+    dm, nfft = 0.0, None
+    if args.coherent:
+        dm = args.dm
+        if dm is None:
+            import dm_utils
+            dm = dm_utils.get_dm(args.psrname)
+        if dm is None:
+            raise InputError(f'No DM known for {args.psrname}, supply --dm for --coherent.')
+        nfft, overlap = coherent_fft_length(dm, args.freq, args.bw, args.nchan)
+        if args.nfft is not None:
+            nfft = args.nfft
+        print(f'Coherent dedispersion to DM {dm}: smearing within the lowest channel is '+
+              f'{overlap} samples, FFT length per channel is {nfft}.')
     filterbankfile = run_digifil(hdr, args.fil_out_dir, args.start, args.nsec, args.nchan,
                                  overwrite=args.force, pol=args.pol,
                                  nbit=args.nbit, tscrunch=args.tscrunch,
-                                 nthreads=args.nthreads, keepBP=args.keepBP)
+                                 nthreads=args.nthreads, dm=dm, coherent=args.coherent,
+                                 keepBP=args.keepBP, mem_node=args.mem_node, nfft=nfft)
     if args.do_prepdata:
         if args.dm is not None:
             dm1 = args.dm
         else:
             dm1 = psr_info(args.psrname)[2]
-        prepdata(filterbankfile, dm1, zerodm=args.nozerodm, clip=args.clip,
-                 dm2=args.dm2, dmstep=args.dmstep, ncpus=args.ncpus)
+        if args.presto:
+            prepdata(filterbankfile, dm1, zerodm=args.nozerodm, clip=args.clip,
+                     dm2=args.dm2, dmstep=args.dmstep, ncpus=args.ncpus)
+        else:
+            dedisperse.dedisperse(filterbankfile, dedisperse.dm_trials(dm1, args.dm2, args.dmstep),
+                                  outbase=filterbankfile.replace('.fil', ''),
+                                  zerodm=args.nozerodm, clip=args.clip, ncpus=args.ncpus)
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+'''
+Resident server that keeps parsed vex files, schedules, the $VEXDB database
+and DM lookups in memory, such that the tools the online chain runs for every
+scan do not each start python, import pandas and parse the same files again.
+Everything is cached with the modification time and size of the files it was
+read from and re-read as soon as they change.
+
+While the server runs, obsinfo.py, dbInfo.py and create_config.py hand their
+command line to it and print its answer; dm_utils.get_dm asks it for DMs. If it
+does not run they do all the work themselves, as before.
+
+  query_server.py serve &     # start the server
+  query_server.py status      # list what is cached
+
+The protocol is one JSON object per line on a Unix socket, e.g.
+{"tool": "obsinfo", "argv": ["-i", "pr123a.vex"], "cwd": "/tmp", "env": {...}}
+is answered with {"returncode": 0, "stdout": "...", "stderr": "..."}, and
+{"tool": "dm", "source": "R3"} with {"dm": 349.7, "pulsar": false}.
+'''
+import argparse
+import json
+import os
+import socket
+import sys
+
+SOCKET = os.environ.get('QUERY_SERVER_SOCKET',
+                        os.path.expanduser('~/.query_server/server.sock'))
+TOOLS = ['obsinfo', 'dbInfo', 'create_config']
+_CACHE = {}
+_SERVING = False  # set in the server, whose tools must not query themselves
+
+
+def options():
+    parser = argparse.ArgumentParser(
+        description='Keeps vex files, schedules, the vex database and DMs in memory and '+
+        'answers the queries of obsinfo.py, dbInfo.py, create_config.py and dm_utils.')
+    general = parser.add_argument_group('General info about the data.')
+    general.add_argument('action', type=str, choices=['serve', 'status'],
+                         help='serve: run the server. status: print what the server has cached.')
+    general.add_argument('--socket', type=str, default=SOCKET,
+                         help='Unix socket the server listens on. Can also be set with the '+
+                         'environment variable QUERY_SERVER_SOCKET. Default=%(default)s.')
+    return parser.parse_args()
+
+
+def _stamp(files):
+    stamp = []
+    for f in files:
+        try:
+            stat = os.stat(f)
+            stamp.append((f, stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            stamp.append((f, None, None))
+    return tuple(stamp)
+
+
+def cached(key, files, loader):
+    '''
+    Returns loader() and keeps the result for as long as none of files
+    changed. Within a short-lived tool this is simply loader(), in the server
+    the result is re-used by all later queries. None (a failed load) is not
+    kept, the next call tries again.
+    '''
+    files = [os.path.abspath(f) for f in files]
+    stamp = _stamp(files)
+    entry = _CACHE.get(key)
+    if (entry is None) or (not entry[0] == stamp):
+        result = loader()
+        if result is None:
+            _CACHE.pop(key, None)
+            return None
+        _CACHE[key] = (stamp, result)
+    return _CACHE[key][1]
+
+
+def query(request, socket_path=SOCKET, timeout=600):
+    '''
+    Sends request to the server and returns its answer, or None if the
+    server does not run or fails to answer. Within the server it is always
+    None: a tool it runs holds the lock a nested query waits for.
+    '''
+    if _SERVING or not os.path.exists(socket_path):
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.settimeout(timeout)
+            s.connect(socket_path)
+            s.sendall(json.dumps(request).encode() + b'\n')
+            answer = s.makefile().readline()
+        return json.loads(answer) if answer else None
+    except (OSError, ValueError):
+        return None
+
+
+def forward(tool, socket_path=SOCKET):
+    '''
+    Lets the server run tool with the current command line. Prints its
+    output and exits with its return code. Returns False if the server does
+    not run, the tool then has to do the work itself.
+    '''
+    answer = query({'tool': tool, 'argv': sys.argv[1:], 'cwd': os.getcwd(),
+                    'env': dict(os.environ)}, socket_path)
+    if answer is None:
+        return False
+    sys.stdout.write(answer['stdout'])
+    sys.stderr.write(answer['stderr'])
+    sys.exit(answer['returncode'])
+
+
+class Server:
+    '''
+    Runs the tools in this process such that everything they load through
+    cached() stays in memory. Requests are handled one at a time as running a
+    tool changes the working directory, environment and output of the whole
+    process; each takes milliseconds once the data are cached.
+    '''
+
+    def __init__(self):
+        import threading
+        self.lock = threading.Lock()
+        self.modules = {}
+
+    def module(self, tool):
+        '''
+        Returns the module of tool, reloaded if its source changed.
+        '''
+        import importlib
+        if tool not in self.modules:
+            module = importlib.import_module(tool)
+            self.modules[tool] = (module, _stamp([module.__file__]))
+        module, stamp = self.modules[tool]
+        if not _stamp([module.__file__]) == stamp:
+            module = importlib.reload(module)
+            self.modules[tool] = (module, _stamp([module.__file__]))
+        return module
+
+    def run_tool(self, tool, argv, cwd, env):
+        '''
+        Runs tool with argv in cwd and env. Output is captured on the file
+        descriptors such that worker processes and subprocesses are captured,
+        too. Returns the return code and what went to stdout and stderr.
+        '''
+        import tempfile
+        module = self.module(tool)
+        saved = (sys.argv, os.getcwd(), dict(os.environ))
+        outputs = [tempfile.TemporaryFile(mode='w+'), tempfile.TemporaryFile(mode='w+')]
+        saved_fds = [os.dup(1), os.dup(2)]
+        returncode = 0
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            for fd, output in zip([1, 2], outputs):
+                os.dup2(output.fileno(), fd)
+            sys.argv = [f'{tool}.py'] + argv
+            os.chdir(cwd)
+            os.environ.clear()
+            os.environ.update(env)
+            try:
+                module.main(module.options())
+            except SystemExit as e:
+                returncode = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+                if isinstance(e.code, str):
+                    print(e.code, file=sys.stderr)
+            except Exception:
+                import traceback
+                traceback.print_exc()
+                returncode = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            for fd, saved_fd in zip([1, 2], saved_fds):
+                os.dup2(saved_fd, fd)
+                os.close(saved_fd)
+            sys.argv = saved[0]
+            os.chdir(saved[1])
+            os.environ.clear()
+            os.environ.update(saved[2])
+        texts = []
+        for output in outputs:
+            output.seek(0)
+            texts.append(output.read())
+            output.close()
+        return returncode, texts[0], texts[1]
+
+    def handle(self, request):
+        with self.lock:
+            tool = request.get('tool')
+            if tool == 'dm':
+                import dm_utils
+                dm_utils.isPulsar = False
+                dm = dm_utils.get_dm(request['source'], use_server=False)
+                return {'dm': dm, 'pulsar': dm_utils.isPulsar}
+            if tool == 'status':
+                return {'cached': [str(key) for key in _CACHE],
+                        'tools': sorted(self.modules)}
+            if tool not in TOOLS:
+                return {'returncode': 2, 'stdout': '', 'stderr': f'Unknown tool {tool}.\n'}
+            returncode, stdout, stderr = self.run_tool(tool, request.get('argv', []),
+                                                       request.get('cwd', os.getcwd()),
+                                                       request.get('env', dict(os.environ)))
+            return {'returncode': returncode, 'stdout': stdout, 'stderr': stderr}
+
+
+def serve(socket_path=SOCKET):
+    '''
+    Answers requests on socket_path until killed.
+    '''
+    import socketserver
+    server = Server()
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                try:
+                    answer = server.handle(json.loads(line.decode()))
+                except Exception as e:
+                    answer = {'returncode': 1, 'stdout': '', 'stderr': f'{e}\n', 'error': str(e)}
+                self.wfile.write(json.dumps(answer).encode() + b'\n')
+
+    # the tools are imported from where this file lives and have to share its cache
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    sys.modules.setdefault('query_server', sys.modules[__name__])
+    sys.modules['query_server']._SERVING = True
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+    with socketserver.ThreadingUnixStreamServer(socket_path, Handler) as s:
+        s.daemon_threads = True
+        print(f'Answering queries on {socket_path}.', flush=True)
+        try:
+            s.serve_forever()
+        finally:
+            os.remove(socket_path)
+
+
+if __name__ == "__main__":
+    args = options()
+    if args.action == 'serve':
+        serve(args.socket)
+    else:
+        answer = query({'tool': 'status'}, args.socket)
+        if answer is None:
+            print(f'No server running on {args.socket}.')
+            sys.exit(1)
+        print(f'Tools loaded: {", ".join(answer["tools"])}')
+        for key in answer['cached']:
+            print(f'  {key}')
@@ -0,0 +1,464 @@
+#!/usr/bin/env python3
+'''
+Quick-look folding of pulsar scans from the filterbank stream as it leaves
+splice. The blocks are dedispersed into a few subbands and folded with the
+phase predicted from polycos (given, or made with tempo2 from the par file of
+the source) into a coarse cube of subints x subbands x phase bins. When the
+scan is complete the cube, the profile and its S/N are written to a small
+sidecar next to the filterbank (<scan>.fold.npz), such that pulsar scans are
+checked without reading the filterbank again.
+
+  splice ... | quicklook.py tap --out scan.quicklook.npz --par psr.par --site ef > scan.fil
+  quickfold.py file scan.fil --par psr.par --site ef    # the same for a filterbank on disk
+  quickfold.py show scan.fold.npz
+
+Without polycos the phase is predicted from the spin parameters in the par
+file, corrected for the orbit of the Earth around the Sun only. That is good
+enough to see slow pulsars but smears fast ones and is meaningless for
+binaries; the sidecar records which prediction was used.
+'''
+import argparse
+import glob
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import numpy as np
+import filterbank
+from dedisperse import DISPERSION_CONSTANT, delays
+
+AU_SEC = 499.004784     # light travel time of one AU
+OBLIQUITY = np.radians(23.43929)
+
+
+def options():
+    parser = argparse.ArgumentParser(
+        description='Folds a pulsar filterbank into a coarse cube and writes profile and S/N '+
+        'to a sidecar.')
+    general = parser.add_argument_group('General info about the data.')
+    general.add_argument('action', type=str, choices=['file', 'show'],
+                         help='file: fold a filterbank (or archive). show: summarise a sidecar.')
+    general.add_argument('filename', type=str,
+                         help='Filterbank for file, sidecar for show.')
+    general.add_argument('-o', '--out', type=str, default=None,
+                         help='Sidecar to write. Default is <filterbank>.fold.npz.')
+    general.add_argument('--par', type=str, default=None,
+                         help='Ephemeris of the pulsar, e.g. from psrcat -e.')
+    general.add_argument('--polyco', type=str, default=None,
+                         help='TEMPO style polycos covering the scan; preferred over --par.')
+    general.add_argument('--site', type=str, default=None,
+                         help='Telescope code known to tempo2, to make polycos from --par.')
+    general.add_argument('--dm', type=float, default=None,
+                         help='DM to dedisperse at. Default is the one of the ephemeris.')
+    general.add_argument('--nbins', type=int, default=64,
+                         help='Number of phase bins, fewer if the period is short. Default=%(default)s.')
+    general.add_argument('--nsub', type=int, default=32,
+                         help='Number of subbands. Default=%(default)s.')
+    general.add_argument('--subint', type=float, default=10.0,
+                         help='Length of the subints in s. Default=%(default)s.')
+    return parser.parse_args()
+
+
+def sidecar_name(filename):
+    for suffix in ('.fil', '.filz', '.quicklook.npz'):
+        if filename.endswith(suffix):
+            return filename[:-len(suffix)] + '.fold.npz'
+    return filename + '.fold.npz'
+
+
+def read_par(parfile):
+    '''
+    Returns the parameters of the par file as a dictionary of strings,
+    keeping only the value of each line (not fit flags and errors).
+    '''
+    par = {}
+    with open(parfile) as f:
+        for line in f:
+            words = line.split()
+            if len(words) >= 2 and not words[0].startswith('#'):
+                par[words[0].upper()] = words[1]
+    return par
+
+
+def _float(value):
+    return float(value.replace('D', 'E').replace('d', 'e'))
+
+
+def _sexagesimal(value):
+    sign = -1 if value.strip().startswith('-') else 1
+    parts = [abs(float(p)) for p in value.split(':')]
+    return sign * sum(p / 60**i for i, p in enumerate(parts))
+
+
+class Polycos:
+    '''
+    Phase prediction from TEMPO style polycos. Each set is valid for span
+    minutes around its reference time tmid.
+    '''
+    kind = 'polyco'
+
+    def __init__(self, filename):
+        self.sets = []
+        with open(filename) as f:
+            lines = [line for line in f if line.strip()]
+        i = 0
+        while i + 1 < len(lines):
+            first, second = lines[i].split(), lines[i+1].split()
+            ncoeff = int(second[4])
+            nlines = (ncoeff + 2) // 3
+            coeffs = [_float(c) for line in lines[i+2:i+2+nlines] for c in line.split()]
+            self.sets.append({'psr': first[0], 'tmid': _float(first[3]), 'dm': _float(first[4]),
+                              'rphase': _float(second[0]), 'f0': _float(second[1]),
+                              'span': _float(second[3]), 'coeffs': np.array(coeffs[:ncoeff])})
+            i += 2 + nlines
+        if not self.sets:
+            raise InputError(f'{filename} contains no polycos.')
+        self.psr = self.sets[0]['psr']
+        self.dm = self.sets[0]['dm']
+
+    def _set(self, mjd):
+        best = min(self.sets, key=lambda s: abs(s['tmid'] - mjd))
+        if abs(best['tmid'] - mjd) * 1440 > best['span'] / 2 + 1:
+            raise InputError(f'No polyco covers MJD {mjd:.5f}.')
+        return best
+
+    def phase(self, mjd0, sec):
+        '''
+        Returns the phase in turns (up to a constant) at sec seconds after mjd0.
+        '''
+        s = self._set(mjd0 + np.mean(sec) / 86400.)
+        dt = (mjd0 - s['tmid']) * 1440. + np.asarray(sec, dtype=np.float64) / 60.
+        return s['rphase'] % 1 + dt * 60 * s['f0'] + np.polynomial.polynomial.polyval(dt, s['coeffs'])
+
+    def frequency(self, mjd0, sec):
+        '''
+        Returns the apparent spin frequency in Hz at sec seconds after mjd0.
+        '''
+        s = self._set(mjd0 + sec / 86400.)
+        dt = (mjd0 - s['tmid']) * 1440. + sec / 60.
+        deriv = np.polynomial.polynomial.polyder(s['coeffs'])
+        return s['f0'] + np.polynomial.polynomial.polyval(dt, deriv) / 60.
+
+
+def earth_position(mjd):
+    '''
+    Returns the heliocentric position of the Earth in light seconds in
+    equatorial coordinates, from the low precision solar coordinates of
+    Meeus (Astronomical Algorithms, ch. 25), good to about 0.01 degrees.
+    '''
+    t = (np.asarray(mjd, dtype=np.float64) - 51544.5) / 36525.
+    mean_lon = np.radians(280.46646 + 36000.76983 * t)
+    anomaly = np.radians(357.52911 + 35999.05029 * t)
+    ecc = 0.016708634 - 0.000042037 * t
+    centre = np.radians((1.914602 - 0.004817 * t) * np.sin(anomaly) +
+                        (0.019993 - 0.000101 * t) * np.sin(2 * anomaly) + 0.000289 * np.sin(3 * anomaly))
+    lon = mean_lon + centre
+    distance = 1.000001018 * (1 - ecc**2) / (1 + ecc * np.cos(anomaly + centre)) * AU_SEC
+    # the Earth is opposite the Sun as seen from the Earth
+    x, y = -distance * np.cos(lon), -distance * np.sin(lon)
+    return np.array([x, y * np.cos(OBLIQUITY), y * np.sin(OBLIQUITY)])
+
+
+class ParPrediction:
+    '''
+    Phase prediction from the spin parameters (F0, F1, F2 at PEPOCH) of a
+    par file. Arrival times are moved to the Sun (Roemer delay of the
+    Earth's orbit); the rotation of the Earth, the other delays and binary
+    motion are ignored.
+    '''
+    kind = 'par'
+
+    def __init__(self, par):
+        if not ('F0' in par or 'P0' in par):
+            raise InputError('The ephemeris has neither F0 nor P0.')
+        self.psr = par.get('PSRJ', par.get('PSRB', par.get('PSR', 'unknown')))
+        self.f = [_float(par['F0']) if 'F0' in par else 1 / _float(par['P0'])] + \
+            [_float(par.get(key, '0')) for key in ('F1', 'F2')]
+        self.pepoch = _float(par.get('PEPOCH', par.get('POSEPOCH', '55000')))
+        self.dm = _float(par.get('DM', '0'))
+        self.binary = par.get('BINARY')
+        ra = np.radians(15 * _sexagesimal(par.get('RAJ', '0')))
+        dec = np.radians(_sexagesimal(par.get('DECJ', '0')))
+        self.direction = np.array([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)])
+
+    def phase(self, mjd0, sec):
+        sec = np.asarray(sec, dtype=np.float64)
+        roemer = self.direction @ earth_position(mjd0 + sec / 86400.)
+        dt = (mjd0 - self.pepoch) * 86400. + sec + roemer
+        f0, f1, f2 = self.f
+        # the spin-down terms are small, the big one is evaluated relative to the start
+        dt0 = (mjd0 - self.pepoch) * 86400.
+        return (f0 * dt0) % 1 + f0 * (dt - dt0) + f1 * dt**2 / 2 + f2 * dt**3 / 6
+
+    def frequency(self, mjd0, sec):
+        return float(np.diff(self.phase(mjd0, [sec - 0.5, sec + 0.5]))[0])
+
+
+def make_polycos(parfile, site, mjd, freq, hours=12):
+    '''
+    Makes polycos for site with tempo2 from hours before to hours after mjd.
+    Returns them, or None if tempo2 is missing or fails.
+    '''
+    if shutil.which('tempo2') is None:
+        return None
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cmd = ['tempo2', '-f', os.path.abspath(parfile), '-polyco',
+               f'{mjd - hours/24:.6f} {mjd + hours/24:.6f} 60 12 12 {site} {freq:.3f}']
+        try:
+            subprocess.run(cmd, cwd=tmpdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                           timeout=120, check=True)
+            return Polycos(glob.glob(f'{tmpdir}/polyco*.dat')[0])
+        except (subprocess.SubprocessError, OSError, IndexError, ValueError, Error):
+            return None
+
+
+def predictor(header, parfile=None, polyco=None, site=None):
+    '''
+    Returns the phase prediction for the scan with header: the polycos if
+    given, else polycos made with tempo2 for site, else the par file itself.
+    '''
+    if polyco is not None:
+        return Polycos(polyco)
+    if parfile is None:
+        raise InputError('Folding needs a par file or polycos.')
+    freqs = filterbank.get_freqs(header)
+    if site is not None:
+        polycos = make_polycos(parfile, site, header['tstart'], freqs.mean())
+        if polycos is not None:
+            return polycos
+    return ParPrediction(read_par(parfile))
+
+
+class Folder:
+    '''
+    Folds filterbank data added in chunks of shape (n, nifs, nchans) into a
+    cube of subints x subbands x phase bins. The data are first averaged in
+    time to a fraction of a phase bin. Within each subband the channels are
+    then shifted by whole samples to its top, and the subbands are folded with
+    the phase at the top of the band, such that the cube is dedispersed.
+    Chunks need not be contiguous, after a gap the dedispersion starts over.
+    '''
+
+    def __init__(self, header, prediction, dm=None, nbins=64, nsub=32, subint=10.0):
+        self.header = header
+        self.prediction = prediction
+        self.dm = prediction.dm if dm is None else dm
+        self.tsamp = header['tsamp']
+        self.mjd0 = header['tstart']
+        freqs = filterbank.get_freqs(header)
+        self.fref = freqs.max()
+        self.period = 1 / prediction.frequency(self.mjd0, 0.)
+        # bins shorter than a sample would only be filled in turn
+        self.nbins = int(min(nbins, 2**max(int(np.log2(self.period / self.tsamp)), 1)))
+        self.ds = max(int(self.period / self.nbins / self.tsamp / 4), 1)
+        # subbands of neighbouring channels, within which channels of equal delay are summed at once
+        self.subbands = [s for s in np.array_split(np.arange(len(freqs)), min(nsub, len(freqs)))
+                         if len(s) > 0]
+        self.sub_freqs = np.array([freqs[s].max() for s in self.subbands])
+        self.runs = []
+        for chans, f in zip(self.subbands, self.sub_freqs):
+            shifts = delays(freqs[chans], self.dm, self.ds * self.tsamp, fref=f)
+            edges = np.flatnonzero(np.diff(shifts)) + 1
+            self.runs.append([(int(shifts[a]), chans[a], chans[b-1] + 1)
+                              for a, b in zip(np.r_[0, edges], np.r_[edges, len(chans)])])
+        self.max_shift = max(shift for runs in self.runs for shift, _, _ in runs)
+        # delay of the top of each subband after the top of the band
+        self.sub_delays = DISPERSION_CONSTANT * self.dm * (self.sub_freqs**-2 - self.fref**-2)
+        self.subint_samples = max(int(round(subint / self.tsamp)), 1)
+        self.sums = np.zeros((4, len(self.subbands), self.nbins), dtype=np.float64)
+        self.hits = np.zeros_like(self.sums)
+        self.pending = None  # samples not averaged yet
+        self.tail = None     # averaged samples, channels as rows, still needed for the delays
+        self.next = 0
+        self.nsamples = 0
+
+    def add(self, first, chunk):
+        '''
+        Adds the (unpacked) samples of shape (n, nifs, nchans) that start at
+        sample first.
+        '''
+        data = chunk[:, 0] if chunk.shape[1] == 1 else filterbank.total_intensity(chunk)
+        if not first == self.next:
+            self.pending, self.tail = None, None
+        self.next = first + len(chunk)
+        if self.ds > 1:
+            if self.pending is not None:
+                data = np.concatenate([self.pending, data])
+                first -= len(self.pending)
+            n = len(data) // self.ds * self.ds
+            self.pending = data[n:]
+            data = data[:n].reshape(-1, self.ds, data.shape[1]).sum(axis=1, dtype=np.float32)
+        # channels as rows, such that the shifted slices below are contiguous
+        data = _transpose(data)
+        if self.tail is not None:
+            data = np.concatenate([self.tail.astype(data.dtype), data], axis=1)
+            first -= self.tail.shape[1] * self.ds
+        nout = data.shape[1] - self.max_shift
+        self.tail = data[:, max(nout, 0):]
+        if nout <= 0:
+            return
+        nsub = len(self.subbands)
+        series = np.zeros((nsub, nout), dtype=np.float32)
+        for j, runs in enumerate(self.runs):
+            for shift, c0, c1 in runs:
+                series[j] += data[c0:c1, shift:shift+nout].sum(axis=0, dtype=np.float32)
+        # within a chunk the phase is quadratic in time to well below a bin
+        sec = (first + (self.ds - 1) / 2 + np.array([0, nout / 2, nout]) * self.ds) * self.tsamp
+        phase = np.polyval(np.polyfit(np.arange(3) - 1., self.prediction.phase(self.mjd0, sec), 2),
+                           np.arange(nout) / (nout / 2) - 1.)
+        freq = self.prediction.frequency(self.mjd0, sec[1])
+        # phase at the top of the band of the samples of each subband
+        phase = phase[np.newaxis] - freq * self.sub_delays[:, np.newaxis]
+        bins = ((phase % 1) * self.nbins).astype(np.int64) % self.nbins + \
+            np.arange(nsub)[:, np.newaxis] * self.nbins
+        # the samples of a subint are consecutive
+        samples = first + np.arange(nout + 1) * self.ds
+        for k in range(first // self.subint_samples, (samples[-2]) // self.subint_samples + 1):
+            a, b = np.searchsorted(samples[:-1], [k * self.subint_samples, (k + 1) * self.subint_samples])
+            self.sums = _grow(self.sums, k + 1)
+            self.hits = _grow(self.hits, k + 1)
+            self.sums[k] += np.bincount(bins[:, a:b].ravel(), weights=series[:, a:b].ravel(),
+                                        minlength=nsub * self.nbins).reshape(nsub, self.nbins)
+            self.hits[k] += np.bincount(bins[:, a:b].ravel(),
+                                        minlength=nsub * self.nbins).reshape(nsub, self.nbins)
+        self.nsamples += nout * self.ds
+
+    def result(self):
+        '''
+        Returns a dictionary with the cube (mean per bin, NaN where nothing
+        was folded), the profile, its S/N and what it was folded with.
+        '''
+        nsubint = int(np.any(self.hits > 0, axis=(1, 2)).nonzero()[0].max() + 1) if self.nsamples else 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cube = self.sums[:nsubint] / self.hits[:nsubint]
+            # each subband has its own level, the profile is the sum of the baselined subbands
+            sub = self.sums[:nsubint].sum(axis=0) / self.hits[:nsubint].sum(axis=0)
+        sub -= np.nanmedian(sub, axis=1, keepdims=True)
+        profile = np.nansum(sub, axis=0)
+        snr, peak, width = profile_snr(profile)
+        return {'cube': cube.astype(np.float32), 'profile': profile.astype(np.float32),
+                'snr': np.float64(snr), 'peak_bin': np.int64(peak), 'width_bins': np.int64(width),
+                'sub_freqs': self.sub_freqs, 'subint_sec': np.float64(self.subint_samples * self.tsamp),
+                'period': np.float64(self.period), 'dm': np.float64(self.dm),
+                'psr': np.str_(self.prediction.psr), 'prediction': np.str_(self.prediction.kind),
+                'binary': np.bool_(getattr(self.prediction, 'binary', None) is not None),
+                'nsamples': np.int64(self.nsamples)}
+
+
+def _transpose(data, block=64):
+    '''
+    Returns data transposed and contiguous. Copying blocks of a few samples
+    keeps the reads in cache, which is several times faster than numpy's
+    transpose of the whole array.
+    '''
+    out = np.empty(data.shape[::-1], dtype=data.dtype)
+    for i in range(0, len(data), block):
+        out[:, i:i+block] = data[i:i+block].T
+    return out
+
+
+def _grow(a, n):
+    if len(a) >= n:
+        return a
+    grown = np.zeros((max(n, 2 * len(a)),) + a.shape[1:], dtype=a.dtype)
+    grown[:len(a)] = a
+    return grown
+
+
+def profile_snr(profile):
+    '''
+    Returns the S/N of the best matching boxcar (of 1 up to half the bins,
+    wrapping around), its first bin and its width. The noise is estimated
+    from the bins outside the boxcar.
+    '''
+    profile = np.asarray(profile, dtype=np.float64)
+    nbins = len(profile)
+    if nbins < 4 or not np.all(np.isfinite(profile)):
+        return 0., 0, 0
+    best = (-np.inf, 0, 1)
+    sigma = 1.4826 * np.median(np.abs(profile - np.median(profile))) or profile.std() or 1.
+    for width in 2**np.arange(int(np.log2(nbins))):
+        sums = np.convolve(np.concatenate([profile, profile[:width-1]]), np.ones(width), 'valid')
+        start = int(np.argmax(sums))
+        score = (sums[start] - width * np.median(profile)) / (sigma * np.sqrt(width))
+        if score > best[0]:
+            best = (score, start, int(width))
+    _, start, width = best
+    on = (start + np.arange(width)) % nbins
+    off = np.delete(profile, on)
+    if off.std() == 0:
+        return 0., start, width
+    return float((profile[on] - off.mean()).sum() / (off.std() * np.sqrt(width))), start, width
+
+
+def save(outfile, result, header):
+    tmpfile = f'{outfile}.{os.getpid()}.tmp.npz'
+    np.savez(tmpfile, header=json.dumps(header), **result)
+    os.replace(tmpfile, outfile)
+    return outfile
+
+
+def load(infile):
+    '''
+    Returns the fold in the sidecar infile and the filterbank header.
+    '''
+    with np.load(infile) as f:
+        result = {key: f[key] for key in f.files if not key == 'header'}
+        header = json.loads(str(f['header']))
+    return result, header
+
+
+def summary(result, header, name=''):
+    '''
+    Returns a one line summary of the fold.
+    '''
+    text = (f'{name}: {result["psr"]} P={result["period"]*1e3:.3f} ms DM={result["dm"]:.2f}, '+
+            f'S/N {result["snr"]:.1f} with a {result["width_bins"]} bin wide peak at phase '+
+            f'{result["peak_bin"]/len(result["profile"]):.2f} of {len(result["profile"])} bins, '+
+            f'{len(result["cube"])} subints of {result["subint_sec"]:.0f}s, {result["prediction"]} prediction')
+    if result['prediction'] == 'par' and result['binary']:
+        text += ' (binary motion ignored)'
+    return text
+
+
+def fold_file(filename, outfile=None, parfile=None, polyco=None, site=None, dm=None,
+              chunk_sec=1.0, **kwargs):
+    '''
+    Folds the filterbank (or archive) filename and writes the sidecar.
+    Returns its name and the summary.
+    '''
+    outfile = sidecar_name(filename) if outfile is None else outfile
+    header, _ = filterbank.read_header(filename)
+    folder = Folder(header, predictor(header, parfile, polyco, site), dm, **kwargs)
+    for first, chunk in filterbank.iter_chunks(filename, max(int(chunk_sec / header['tsamp']), 1)):
+        folder.add(first, chunk)
+    result = folder.result()
+    return save(outfile, result, header), summary(result, header, os.path.basename(filename))
+
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+    pass
+
+
+class InputError(Error):
+    """Exception raised for errors in the input.
+
+    Attributes:
+        message -- explanation of the error
+    """
+
+    def __init__(self, message):
+        self.message = message
+
+
+if __name__ == "__main__":
+    args = options()
+    if args.action == 'file':
+        outfile, text = fold_file(args.filename, args.out, args.par, args.polyco, args.site, args.dm,
+                                  nbins=args.nbins, nsub=args.nsub, subint=args.subint)
+        print(f'quickfold: {text}')
+    else:
+        result, header = load(args.filename)
+        print(summary(result, header, os.path.basename(args.filename)))
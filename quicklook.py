@@ -0,0 +1,457 @@
+#!/usr/bin/env python3
+'''
+Quick-look statistics of a scan, computed from the filterbank stream as it
+leaves splice: per-channel bandpass, rms and kurtosis, the zero-DM time
+series and a heavily downsampled dynamic spectrum. They are written to a
+small sidecar next to the filterbank (<scan>.quicklook.npz) and summarised
+in one line, such that dead IFs or RFI storms show up as soon as a scan is
+spliced, without reading the filterbank again.
+
+  splice ... | quicklook.py tap --out scan.quicklook.npz > scan.fil
+  quicklook.py file scan.fil           # the same for a filterbank on disk
+  quicklook.py show scan.quicklook.npz
+
+The tap passes the stream on unchanged. The statistics are computed in a
+separate thread; if that cannot keep up, data are left out of the statistics
+rather than slowing down splice, and the fraction left out is recorded. Given
+the ephemeris of a pulsar (--par, --polyco) the tap also folds the stream, see
+quickfold.py.
+'''
+import argparse
+import io
+import json
+import os
+import queue
+import sys
+import threading
+import numpy as np
+import filterbank
+import quickfold
+from cpu_placement import format_cpulist
+
+CHUNK_SIZE = 4 * 2**20
+SIGMA = 5.0
+
+
+def options():
+    parser = argparse.ArgumentParser(
+        description='Computes quick-look statistics of a filterbank stream or file and '+
+        'writes them to a sidecar.')
+    general = parser.add_argument_group('General info about the data.')
+    general.add_argument('action', type=str, choices=['tap', 'file', 'show'],
+                         help='tap: pass stdin on to stdout and analyse it on the way. '+
+                         'file: analyse a filterbank (or archive). show: summarise a sidecar.')
+    general.add_argument('filename', type=str, nargs='?', default=None,
+                         help='Filterbank for file, sidecar for show.')
+    general.add_argument('-o', '--out', type=str, default=None,
+                         help='Sidecar to write. Default for file is <filterbank>.quicklook.npz.')
+    general.add_argument('--tres', type=float, default=0.01,
+                         help='Time resolution of the zero-DM series in s. Default=%(default)s.')
+    general.add_argument('--dyn_tres', type=float, default=1.0,
+                         help='Time resolution of the dynamic spectrum in s. Default=%(default)s.')
+    general.add_argument('--dyn_nchan', type=int, default=64,
+                         help='Number of channels of the dynamic spectrum. Default=%(default)s.')
+    general.add_argument('--buffer_mb', type=float, default=64,
+                         help='For tap: data held for the statistics before they are left out. '+
+                         'Default=%(default)s.')
+    general.add_argument('--par', type=str, default=None,
+                         help='For tap: fold the stream with this ephemeris (quickfold.py).')
+    general.add_argument('--polyco', type=str, default=None,
+                         help='For tap: fold the stream with these polycos, preferred over --par.')
+    general.add_argument('--site', type=str, default=None,
+                         help='For tap: telescope code known to tempo2, to make polycos from --par.')
+    general.add_argument('--fold_out', type=str, default=None,
+                         help='For tap: sidecar of the fold. Default is <scan>.fold.npz next to --out.')
+    return parser.parse_args()
+
+
+def sidecar_name(filename):
+    for suffix in ('.fil', '.filz'):
+        if filename.endswith(suffix):
+            return filename[:-len(suffix)] + '.quicklook.npz'
+    return filename + '.quicklook.npz'
+
+
+def _grow(a, n):
+    if len(a) >= n:
+        return a
+    grown = np.zeros((max(n, 2 * len(a)),) + a.shape[1:], dtype=a.dtype)
+    grown[:len(a)] = a
+    return grown
+
+
+class QuickLook:
+    '''
+    Accumulates the statistics of filterbank data added in chunks of shape
+    (n, nifs, nchans), which need not be contiguous in time. Data of up to 8
+    bits are histogrammed per channel, which is faster than summing powers
+    and gives exact moments; deeper data are summed.
+    '''
+
+    def __init__(self, header, tres=0.01, dyn_tres=1.0, dyn_nchan=64):
+        self.header = header
+        nchan = header['nchans']
+        self.tbin = max(int(round(tres / header['tsamp'])), 1)
+        # the dynamic spectrum is made from the zero-DM bins
+        self.dyn_ratio = max(int(round(dyn_tres / header['tsamp'] / self.tbin)), 1)
+        self.dyn_bin = self.dyn_ratio * self.tbin
+        self.dyn_nchan = min(dyn_nchan, nchan)
+        while nchan % self.dyn_nchan:
+            self.dyn_nchan -= 1
+        self.nsamples = 0    # samples analysed
+        self.nend = 0        # samples up to the last one analysed
+        if 0 < header['nbits'] <= 8:
+            # total intensity adds up to two IFs
+            self.nlevels = 2**header['nbits'] * min(header['nifs'], 2)
+            self.hist = np.zeros(nchan * self.nlevels, dtype=np.int64)
+            # the smaller the indices, the faster bincount
+            self.offsets = np.arange(nchan, dtype=np.uint16 if len(self.hist) <= 2**16 else np.int32) * \
+                self.nlevels
+        else:
+            self.nlevels = None
+            self.ref = None
+            # power sums of the samples relative to ref, which keeps the moments accurate
+            self.sums = np.zeros((4, nchan), dtype=np.float64)
+        self.dyn = np.zeros((64, self.dyn_nchan + 1), dtype=np.float64)
+        self.zero_dm = np.zeros((1024, 2), dtype=np.float64)
+
+    def _bin_sums(self, first, data):
+        '''
+        Returns the zero-DM bins that data of shape (n, nchans) starting at
+        sample first fall into, the sum over the samples in each bin per
+        channel and the number of samples. Whole bins are summed as a reshaped
+        array, which is much faster than reduceat.
+        '''
+        n, nbin = len(data), self.tbin
+        dtype = np.float32 if data.dtype.kind in 'ui' else np.float64
+        head = min(-first % nbin, n)
+        body = (n - head) // nbin * nbin
+        parts, sums, counts = [], [], []
+        if head:
+            parts.append(first // nbin)
+            sums.append(data[:head].sum(axis=0, dtype=dtype)[np.newaxis])
+            counts.append([head])
+        if body:
+            parts.append(np.arange(body // nbin) + (first + head) // nbin)
+            sums.append(data[head:head+body].reshape(-1, nbin, data.shape[1]).sum(axis=1, dtype=dtype))
+            counts.append(np.full(body // nbin, nbin))
+        if head + body < n:
+            parts.append((first + head + body) // nbin)
+            sums.append(data[head+body:].sum(axis=0, dtype=dtype)[np.newaxis])
+            counts.append([n - head - body])
+        return np.hstack(parts).astype(np.int64), np.concatenate(sums), np.concatenate(counts)
+
+    def add(self, first, chunk):
+        '''
+        Adds the (unpacked) samples of shape (n, nifs, nchans) that start at
+        sample first.
+        '''
+        n = len(chunk)
+        if n == 0:
+            return
+        if self.nlevels is not None:
+            data = chunk[:, 0] if chunk.shape[1] == 1 else chunk[:, :2].sum(axis=1, dtype=np.int32)
+            self.hist += np.bincount((data + self.offsets).ravel(), minlength=len(self.hist))
+        else:
+            data = filterbank.total_intensity(chunk)
+            if self.ref is None:
+                self.ref = data.mean(axis=0)
+            d = data - self.ref
+            d2 = d * d
+            self.sums[0] += d.sum(axis=0, dtype=np.float64)
+            self.sums[1] += d2.sum(axis=0, dtype=np.float64)
+            self.sums[2] += (d2 * d).sum(axis=0, dtype=np.float64)
+            self.sums[3] += (d2 * d2).sum(axis=0, dtype=np.float64)
+        bins, sums, counts = self._bin_sums(first, data)
+        nchan = sums.shape[1]
+        self.zero_dm = _grow(self.zero_dm, bins[-1] + 1)
+        self.zero_dm[bins, 0] += sums.sum(axis=1) / nchan
+        self.zero_dm[bins, 1] += counts
+        dyn_bins = bins // self.dyn_ratio
+        self.dyn = _grow(self.dyn, dyn_bins[-1] + 1)
+        # consecutive zero-DM bins can fall into the same bin of the dynamic spectrum
+        np.add.at(self.dyn[:, :-1], dyn_bins, sums.reshape(len(sums), self.dyn_nchan, -1).sum(axis=2) /
+                  (nchan // self.dyn_nchan))
+        np.add.at(self.dyn[:, -1], dyn_bins, counts)
+        self.nsamples += n
+        self.nend = max(self.nend, first + n)
+
+    def _moments(self):
+        '''
+        Returns the mean and the second to fourth central moments of each channel.
+        '''
+        if self.nlevels is not None:
+            hist = self.hist.reshape(-1, self.nlevels).astype(np.float64)
+            levels = np.arange(self.nlevels, dtype=np.float64)
+            n = np.maximum(hist.sum(axis=1), 1)
+            mean = hist @ levels / n
+            d = levels[np.newaxis] - mean[:, np.newaxis]
+            return mean, (hist * d**2).sum(axis=1) / n, (hist * d**3).sum(axis=1) / n, \
+                (hist * d**4).sum(axis=1) / n
+        m1, p2, p3, p4 = self.sums / max(self.nsamples, 1)
+        ref = np.zeros_like(m1) if self.ref is None else self.ref
+        return ref + m1, np.maximum(p2 - m1**2, 0), p3 - 3 * m1 * p2 + 2 * m1**3, \
+            p4 - 4 * m1 * p3 + 6 * m1**2 * p2 - 3 * m1**4
+
+    def result(self):
+        '''
+        Returns a dictionary of arrays with the statistics. Bins without any
+        data analysed are NaN.
+        '''
+        mean, var, m3, m4 = self._moments()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            skew = np.where(var > 0, m3 / var**1.5, 0)
+            kurtosis = np.where(var > 0, m4 / var**2 - 3, 0)
+            zero_dm = self.zero_dm[:(self.nend + self.tbin - 1) // self.tbin]
+            dyn = self.dyn[:(self.nend + self.dyn_bin - 1) // self.dyn_bin]
+            zero_dm = zero_dm[:, 0] / zero_dm[:, -1]
+            dyn = dyn[:, :-1] / dyn[:, -1:]
+        freqs = filterbank.get_freqs(self.header)
+        return {'freqs': freqs, 'bandpass': mean.astype(np.float32),
+                'rms': np.sqrt(var).astype(np.float32), 'skewness': skew.astype(np.float32),
+                'kurtosis': kurtosis.astype(np.float32), 'zero_dm': zero_dm.astype(np.float32),
+                'zero_dm_tsamp': np.float64(self.tbin * self.header['tsamp']),
+                'dynspec': dyn.astype(np.float32),
+                'dynspec_freqs': freqs.reshape(self.dyn_nchan, -1).mean(axis=1),
+                'dynspec_tsamp': np.float64(self.dyn_bin * self.header['tsamp']),
+                'nsamples': np.int64(self.nsamples), 'nsamples_stream': np.int64(self.nend)}
+
+
+def save(outfile, stats, header):
+    tmpfile = f'{outfile}.{os.getpid()}.tmp.npz'
+    np.savez(tmpfile, header=json.dumps(header), **stats)
+    os.replace(tmpfile, outfile)
+    return outfile
+
+
+def load(infile):
+    '''
+    Returns the statistics in the sidecar infile and the filterbank header.
+    '''
+    with np.load(infile) as f:
+        stats = {key: f[key] for key in f.files if not key == 'header'}
+        header = json.loads(str(f['header']))
+    return stats, header
+
+
+def summary(stats, header, name=''):
+    '''
+    Returns a one line summary: dead channels (no variance), channels whose
+    level, rms or kurtosis is off, zero-DM bins more than SIGMA off and the
+    fraction of the stream that was not analysed.
+    '''
+    from rfi_flag import robust_outliers
+    dead = stats['rms'] == 0
+    live = np.flatnonzero(~dead)
+    odd = np.zeros_like(dead)
+    if len(live) > 2:
+        for key in ('bandpass', 'rms', 'kurtosis'):
+            odd[live] |= robust_outliers(stats[key][live], SIGMA)
+    zero_dm = stats['zero_dm'][np.isfinite(stats['zero_dm'])]
+    spikes = robust_outliers(zero_dm, SIGMA).mean() if len(zero_dm) > 2 else 0.
+    missed = 1 - stats['nsamples'] / max(stats['nsamples_stream'], 1)
+    text = (f'{name}: {stats["nsamples_stream"] * header["tsamp"]:.1f}s, '+
+            f'{header["nchans"]} channels, dead: {format_cpulist(np.flatnonzero(dead)) or "none"}, '+
+            f'outliers: {format_cpulist(np.flatnonzero(odd)) or "none"}, '+
+            f'zero-DM: {spikes*100:.1f}% of {stats["zero_dm_tsamp"]*1e3:.0f} ms bins beyond {SIGMA:.0f} sigma')
+    if missed > 0:
+        text += f', {missed*100:.1f}% of the stream not analysed'
+    return text
+
+
+def analyse(filename, outfile=None, tres=0.01, dyn_tres=1.0, dyn_nchan=64, chunk_sec=1.0):
+    '''
+    Computes the statistics of the filterbank (or archive) filename and
+    writes the sidecar. Returns its name and the summary.
+    '''
+    outfile = sidecar_name(filename) if outfile is None else outfile
+    header, _ = filterbank.read_header(filename)
+    quicklook = QuickLook(header, tres, dyn_tres, dyn_nchan)
+    for first, chunk in filterbank.iter_chunks(filename, max(int(chunk_sec / header['tsamp']), 1)):
+        quicklook.add(first, chunk)
+    stats = quicklook.result()
+    return save(outfile, stats, header), summary(stats, header, os.path.basename(filename))
+
+
+def _write_all(fd, data):
+    view = memoryview(data)
+    while len(view):
+        view = view[os.write(fd, view):]
+
+
+class Tap(threading.Thread):
+    '''
+    Analyses the (offset, bytes) pieces of the data part of a filterbank
+    stream put into its queue; None ends it. Pieces may be left out. The
+    data are also added to folder (a quickfold.Folder) if given.
+    '''
+
+    def __init__(self, header, buffer_size=64*2**20, folder=None, **kwargs):
+        super().__init__(daemon=True)
+        self.header = header
+        self.quicklook = QuickLook(header, **kwargs)
+        self.folder = folder
+        self.fold_error = None
+        self.bytes_per_spectrum = filterbank.get_bytes_per_spectrum(header)
+        self.queue = queue.Queue(maxsize=max(int(buffer_size // CHUNK_SIZE), 1))
+        self.pending = b''
+        self.offset = 0
+        self.error = None
+
+    def run(self):
+        nbits = self.header['nbits']
+        ncols = self.header['nchans'] * nbits // 8 if nbits in filterbank.PACKED_NBITS else \
+            self.header['nchans']
+        bps = self.bytes_per_spectrum
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is not None:
+                continue
+            offset, data = item
+            try:
+                if not offset == self.offset + len(self.pending):
+                    # something was left out, continue at the next full spectrum
+                    skip = -offset % bps
+                    self.pending, self.offset, data = b'', offset + skip, data[skip:]
+                self.pending += data
+                n = len(self.pending) // bps
+                if n > 0:
+                    raw = np.frombuffer(self.pending, dtype=np.uint8, count=n*bps).view(
+                        filterbank.get_dtype(nbits))
+                    chunk = filterbank.unpack(raw.reshape(n, self.header['nifs'], ncols), nbits)
+                    self.quicklook.add(self.offset // bps, chunk)
+                    if self.folder is not None:
+                        self._fold(self.offset // bps, chunk)
+                    self.pending = self.pending[n*bps:]
+                    self.offset += n * bps
+            except Exception as e:
+                self.error = e
+
+    def _fold(self, first, chunk):
+        # a failing fold does not stop the statistics
+        try:
+            self.folder.add(first, chunk)
+        except Exception as e:
+            self.fold_error, self.folder = e, None
+
+
+def tap(outfile, buffer_size=64*2**20, fold=None, **kwargs):
+    '''
+    Copies stdin to stdout and writes the statistics of the filterbank
+    passing through to outfile. Returns the summary, or None if the stream
+    could not be analysed; the data are passed on in any case. If fold is
+    given (a dictionary with parfile, polyco, site and outfile) the stream
+    is folded as well and the summary of the fold is printed.
+    '''
+    fin, fout = sys.stdin.buffer.fileno(), sys.stdout.buffer.fileno()
+    start = b''
+    while b'HEADER_END' not in start:
+        data = os.read(fin, CHUNK_SIZE)
+        if not data:
+            break
+        _write_all(fout, data)
+        start += data
+    try:
+        if b'HEADER_END' not in start:
+            raise InputError('no filterbank header')
+        header, header_size = filterbank.parse_header(io.BytesIO(start))
+        thread = Tap(header, buffer_size, _folder(header, fold), **kwargs)
+    except Exception as e:
+        print(f'quicklook: cannot analyse the stream: {getattr(e, "message", e)}', file=sys.stderr)
+        thread = None
+    else:
+        thread.start()
+        thread.queue.put((0, start[header_size:]))
+    offset = len(start) - (header_size if thread else 0)
+    # reads from a pipe return at most a pipe buffer, they are queued in batches of CHUNK_SIZE
+    batch, batch_offset = [], offset
+    while True:
+        data = os.read(fin, CHUNK_SIZE)
+        if not data:
+            break
+        _write_all(fout, data)
+        offset += len(data)
+        if thread is not None:
+            batch.append(data)
+            if offset - batch_offset >= CHUNK_SIZE:
+                try:
+                    thread.queue.put_nowait((batch_offset, b''.join(batch)))
+                except queue.Full:
+                    pass
+                batch, batch_offset = [], offset
+    if thread is None:
+        return None
+    if batch:
+        thread.queue.put((batch_offset, b''.join(batch)))
+    thread.queue.put(None)
+    thread.join()
+    if thread.error is not None:
+        print(f'quicklook: analysis failed: {thread.error}', file=sys.stderr)
+        return None
+    if thread.fold_error is not None:
+        print(f'quickfold: folding failed: {getattr(thread.fold_error, "message", thread.fold_error)}',
+              file=sys.stderr)
+    elif thread.folder is not None:
+        result = thread.folder.result()
+        quickfold.save(fold['outfile'], result, header)
+        print(f'quickfold: {quickfold.summary(result, header, os.path.basename(fold["outfile"]))}',
+              file=sys.stderr)
+    stats = thread.quicklook.result()
+    save(outfile, stats, header)
+    return summary(stats, header, os.path.basename(outfile))
+
+
+def _folder(header, fold):
+    '''
+    Returns the quickfold.Folder for the stream with header, or None if
+    there is nothing to fold or the phase cannot be predicted.
+    '''
+    if fold is None:
+        return None
+    try:
+        prediction = quickfold.predictor(header, fold['parfile'], fold['polyco'], fold['site'])
+        return quickfold.Folder(header, prediction)
+    except Exception as e:
+        print(f'quickfold: cannot fold the stream: {getattr(e, "message", e)}', file=sys.stderr)
+        return None
+
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+    pass
+
+
+class InputError(Error):
+    """Exception raised for errors in the input.
+
+    Attributes:
+        message -- explanation of the error
+    """
+
+    def __init__(self, message):
+        self.message = message
+
+
+if __name__ == "__main__":
+    args = options()
+    kwargs = {'tres': args.tres, 'dyn_tres': args.dyn_tres, 'dyn_nchan': args.dyn_nchan}
+    if args.action == 'tap':
+        if args.out is None:
+            raise InputError('tap needs --out.')
+        fold = None
+        if (args.par is not None) or (args.polyco is not None):
+            fold = {'parfile': args.par, 'polyco': args.polyco, 'site': args.site,
+                    'outfile': args.fold_out or quickfold.sidecar_name(args.out)}
+        text = tap(args.out, int(args.buffer_mb * 2**20), fold, **kwargs)
+        if text is not None:
+            print(f'quicklook: {text}', file=sys.stderr)
+    elif args.filename is None:
+        raise InputError(f'{args.action} needs a filename.')
+    elif args.action == 'file':
+        outfile, text = analyse(args.filename, args.out, **kwargs)
+        print(f'quicklook: {text}')
+    else:
+        stats, header = load(args.filename)
+        print(summary(stats, header, os.path.basename(args.filename)))
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+'''
+Shared reader for the large files on vbs_fs (FUSE) mounts and scratch disks.
+Default buffered reads of a few kB (or dd with bs=frame_size) cap FUSE at a
+fraction of what the disks deliver. Here a background thread issues aligned
+reads of several MB ahead of the consumer, with posix_fadvise hints such that
+the kernel reads ahead as well. The size of the reads is tuned per file system
+from the measured throughput: starting small it is doubled as long as that
+pays off, and the result is remembered for the next run.
+
+  readahead.py /mnt/vbs/exp/exp_ef_no0001    # measure and print the read size
+'''
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+import cpu_placement
+
+ALIGN = 2**20
+MIN_READ = 4 * 2**20   # tuning starts here, anything smaller is too small anyway
+MAX_READ = 64 * 2**20
+READ_SIZES = os.path.expanduser('~/.readahead/read_sizes.json')
+_read_sizes = None
+
+
+def options():
+    parser = argparse.ArgumentParser(
+        description='Measures the best read size for the file system files are on.')
+    general = parser.add_argument_group('General info about the data.')
+    general.add_argument('files', type=str, nargs='+',
+                         help='Files to read, at least a few hundred MB each.')
+    return parser.parse_args()
+
+
+def mount_point(filename):
+    '''
+    Returns the mount point of the file system filename is on, which
+    identifies the device across runs (the st_dev of FUSE mounts does not).
+    '''
+    path = os.path.dirname(os.path.abspath(filename))
+    dev = os.stat(path).st_dev
+    while not path == '/':
+        parent = os.path.dirname(path)
+        if not os.stat(parent).st_dev == dev:
+            break
+        path = parent
+    return path
+
+
+def _load_read_sizes():
+    global _read_sizes
+    if _read_sizes is None:
+        try:
+            with open(READ_SIZES) as f:
+                _read_sizes = json.load(f)
+        except (OSError, ValueError):
+            _read_sizes = {}
+    return _read_sizes
+
+
+def get_read_size(filename):
+    '''
+    Returns the tuned read size for the file system of filename, or None if
+    it was never measured.
+    '''
+    return _load_read_sizes().get(mount_point(filename))
+
+
+def set_read_size(filename, size):
+    sizes = _load_read_sizes()
+    sizes[mount_point(filename)] = size
+    try:
+        os.makedirs(os.path.dirname(READ_SIZES), exist_ok=True)
+        tmpfile = f'{READ_SIZES}.{os.getpid()}.tmp'
+        with open(tmpfile, 'w') as f:
+            json.dump(sizes, f, indent=1)
+        os.replace(tmpfile, READ_SIZES)
+    except OSError:
+        pass
+
+
+def _fadvise(fd, offset, length, advice):
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, offset, length, advice)
+        except OSError:
+            pass
+
+
+class Reader:
+    '''
+    Reads nbytes (default: all) of filename as of offset in the background.
+    Iterating yields the data in chunks of the current read size, read(n)
+    returns exactly n bytes unless the end is reached. Use as a context
+    manager or call close().
+    '''
+
+    def __init__(self, filename, offset=0, nbytes=None, read_size=None, prefetch=4, tune=None):
+        self.filename = filename
+        self.fd = os.open(filename, os.O_RDONLY)
+        size = os.fstat(self.fd).st_size
+        self.offset = offset
+        self.stop = size if nbytes is None else min(size, offset + nbytes)
+        # without a measured size the read size is tuned while reading
+        self.tune = (read_size is None) and (get_read_size(filename) is None) if tune is None else tune
+        if self.tune:
+            self.read_size = MIN_READ
+        else:
+            self.read_size = read_size or get_read_size(filename) or MIN_READ
+        _fadvise(self.fd, offset, self.stop - offset, getattr(os, 'POSIX_FADV_SEQUENTIAL', 0))
+        self.queue = queue.Queue(maxsize=prefetch)
+        self.stopped = threading.Event()
+        self.buffer = b''
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        # the reads mostly wait for the disks, leave the cores of running digifils alone
+        cpu_placement.avoid_pinned()
+        rates = {}
+        pos = self.offset
+        try:
+            while (pos < self.stop) and not self.stopped.is_set():
+                # reads end on multiples of ALIGN such that all but the first are aligned
+                end = min(self.stop, ((pos + self.read_size) // ALIGN) * ALIGN)
+                if end <= pos:
+                    end = min(self.stop, pos + self.read_size)
+                _fadvise(self.fd, end, self.read_size, getattr(os, 'POSIX_FADV_WILLNEED', 3))
+                t0 = time.perf_counter()
+                data = os.pread(self.fd, end - pos, pos)
+                if self.tune and len(data) >= MIN_READ:
+                    self._adapt(rates, len(data) / max(time.perf_counter() - t0, 1e-9))
+                if not data:
+                    break
+                pos += len(data)
+                self._put(data)
+        except Exception as e:
+            self._put(e)
+        self._put(None)
+
+    def _adapt(self, rates, rate):
+        '''
+        Doubles the read size as long as that raises the throughput by more
+        than 10%, then stores the size for the file system.
+        '''
+        rates.setdefault(self.read_size, []).append(rate)
+        if len(rates[self.read_size]) < 2:
+            return
+        best = max(rates[self.read_size])
+        smaller = rates.get(self.read_size // 2)
+        if (smaller is not None) and (best < 1.1 * max(smaller)):
+            self.read_size //= 2
+            self.tune = False
+        elif self.read_size >= MAX_READ:
+            self.tune = False
+        else:
+            self.read_size *= 2
+        if not self.tune:
+            set_read_size(self.filename, self.read_size)
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def __iter__(self):
+        if self.buffer:
+            data, self.buffer = self.buffer, b''
+            yield data
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.put(None)
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def read(self, n):
+        chunks = [self.buffer]
+        have = len(self.buffer)
+        self.buffer = b''
+        if have < n:
+            for data in self:
+                chunks.append(data)
+                have += len(data)
+                if have >= n:
+                    break
+        data = b''.join(chunks)
+        self.buffer = data[n:]
+        return data[:n]
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        os.close(self.fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_range(filename, offset, nbytes):
+    '''
+    Returns nbytes of filename as of offset.
+    '''
+    with Reader(filename, offset, nbytes) as reader:
+        return reader.read(nbytes)
+
+
+def copy_range(infile, outfile, offset, nbytes):
+    '''
+    Copies nbytes of infile as of offset to outfile. Returns the number of
+    bytes copied.
+    '''
+    copied = 0
+    with Reader(infile, offset, nbytes) as reader, open(outfile, 'wb') as f:
+        for data in reader:
+            f.write(data)
+            copied += len(data)
+    return copied
+
+
+def iter_frames(filename, frame_size, nframes, start_frame=0, stop_frame=None, ncols=None):
+    '''
+    Iterates over the frames of filename in blocks of nframes frames. Yields
+    the index of the first frame and a uint8 array of shape (n, ncols) with
+    the first ncols bytes of each frame (default: all), e.g. ncols=16 for the
+    headers. The whole file is read sequentially in large reads, which on
+    FUSE is much faster than touching each header.
+    '''
+    import numpy as np
+    total = os.path.getsize(filename) // frame_size
+    stop_frame = total if stop_frame is None else min(stop_frame, total)
+    ncols = frame_size if ncols is None else ncols
+    with Reader(filename, start_frame * frame_size, (stop_frame - start_frame) * frame_size) as reader:
+        for first in range(start_frame, stop_frame, nframes):
+            n = min(nframes, stop_frame - first)
+            block = np.empty((n, ncols), dtype=np.uint8)
+            done = 0
+            # read in pieces of about a read size such that only a few MB are held in addition
+            per_read = max(reader.read_size // frame_size, 1)
+            while done < n:
+                k = min(per_read, n - done)
+                raw = reader.read(k * frame_size)
+                k = len(raw) // frame_size
+                if k == 0:
+                    # the file ended early, e.g. it is still being written
+                    if done:
+                        yield first, block[:done]
+                    return
+                frames = np.frombuffer(raw, dtype=np.uint8, count=k*frame_size).reshape(k, frame_size)
+                block[done:done+k] = frames[:, :ncols]
+                done += k
+            yield first, block
+
+
+if __name__ == "__main__":
+    args = options()
+    for filename in args.files:
+        with Reader(filename, tune=True) as reader:
+            t0 = time.perf_counter()
+            nbytes = sum(len(data) for data in reader)
+            seconds = time.perf_counter() - t0
+        print(f'{filename}: {nbytes/seconds/1e6:.0f} MB/s, read size for {mount_point(filename)} '+
+              f'is {get_read_size(filename)//2**20} MB')
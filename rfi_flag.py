@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+'''
+Computes an RFI channel mask from a (spliced) filterbank file and writes it
+as a flag file for Heimdall/FETCH. The flag file lists the flagged channel
+numbers, one per line. Flag files are named after the station and frequency
+setup (<station>.flag_<fmin>-<fmax>MHz_<nchan>chan, as expected by
+submit_job.py) such that they act as a cache: they are computed once per
+setup and re-used afterwards.
+'''
+import argparse
+import os
+import numpy as np
+import filterbank
+
+
+def options():
+    parser = argparse.ArgumentParser(
+        description='Creates a flag file for a filterbank based on spectral kurtosis and '+
+        'robust per-channel statistics.')
+    general = parser.add_argument_group('General info about the data.')
+    general.add_argument('filterbank', type=str,
+                         help='Filterbank file to compute the mask from.')
+    general.add_argument('-o', '--outfile', type=str, default=None,
+                         help='Name of the flag file. Either this or --flagdir and --station '+
+                         'need to be set.')
+    general.add_argument('--flagdir', type=str, default=None,
+                         help='Directory with flag files. File name will be derived from '+
+                         'the station and the frequency setup in the filterbank header.')
+    general.add_argument('--station', type=str, default=None,
+                         help='2-letter station code used in the flag file name.')
+    general.add_argument('--refresh', action='store_true',
+                         help='If set will recompute the mask even if the flag file exists.')
+    general.add_argument('--sigma', type=float, default=5.0,
+                         help='Threshold in robust standard deviations above which a '+
+                         'channel is flagged. Default=%(default)s.')
+    general.add_argument('--frac', type=float, default=0.2,
+                         help='A channel is flagged if its spectral kurtosis is off in more '+
+                         'than this fraction of all chunks. Default=%(default)s.')
+    general.add_argument('--chunksize', type=int, default=8192,
+                         help='Number of samples per chunk. Default=%(default)s.')
+    general.add_argument('--nsec', type=float, default=None,
+                         help='Use only the first nsec seconds of the file. Default is all.')
+    return parser.parse_args()
+
+
+def flag_file_name(flagdir, station, fmin, fmax, nchan):
+    '''
+    Returns the path of the flag file for a given station and frequency setup.
+    '''
+    return f'{flagdir}/{station}.flag_{int(fmin)}-{int(fmax)}MHz_{int(nchan)}chan'
+
+
+def get_setup(header):
+    '''
+    Returns the lower and upper band edge in MHz and the number of channels
+    of a filterbank, i.e. the key of the flag file cache.
+    '''
+    freqs = filterbank.get_freqs(header)
+    fmin = freqs.min() - abs(header['foff']) / 2.
+    fmax = fmin + abs(header['foff']) * header['nchans']
+    return int(fmin), int(fmax), header['nchans']
+
+
+def robust_outliers(x, sigma):
+    '''
+    Returns a boolean mask of all entries of x that are more than sigma robust
+    standard deviations (via the median absolute deviation) off the median.
+    Works along the last axis.
+    '''
+    median = np.median(x, axis=-1, keepdims=True)
+    mad = 1.4826 * np.median(np.abs(x - median), axis=-1, keepdims=True)
+    mad[mad == 0] = np.finfo(np.float32).eps
+    return np.abs(x - median) > sigma * mad
+
+
+def spectral_kurtosis(s1, s2, m):
+    '''
+    Returns the spectral kurtosis estimator for m samples of power with
+    sum s1 and sum of squares s2.
+    '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (m + 1.) / (m - 1.) * (m * s2 / s1**2 - 1.)
+
+
+def compute_mask(filename, sigma=5.0, frac=0.2, chunksize=8192, nsamples=None):
+    '''
+    Streams through filename in chunks and returns a boolean mask that is
+    True for every channel that is to be flagged. Channels are flagged if they
+    are dead, if their mean or standard deviation are outliers across the band,
+    or if their spectral kurtosis is an outlier in more than frac of all chunks.
+    '''
+    header, _ = filterbank.read_header(filename)
+    nchan = header['nchans']
+    s1 = np.zeros(nchan, dtype=np.float64)
+    s2 = np.zeros(nchan, dtype=np.float64)
+    sk_bad = np.zeros(nchan, dtype=np.int64)
+    nchunks = 0
+    ntotal = 0
+    for _, chunk in filterbank.iter_chunks(filename, chunksize, stop=nsamples):
+        if chunk.shape[0] < 2:
+            continue
+        data = filterbank.total_intensity(chunk)
+        c1 = data.sum(axis=0, dtype=np.float64)
+        c2 = np.square(data, dtype=np.float64).sum(axis=0)
+        sk = spectral_kurtosis(c1, c2, data.shape[0])
+        sk = np.nan_to_num(sk, nan=0.0, posinf=0.0, neginf=0.0)
+        sk_bad += robust_outliers(sk, sigma)
+        s1 += c1
+        s2 += c2
+        ntotal += data.shape[0]
+        nchunks += 1
+    if nchunks == 0:
+        raise InputError(f'{filename} does not contain enough data to compute a mask.')
+    mean = s1 / ntotal
+    std = np.sqrt(np.maximum(s2 / ntotal - mean**2, 0))
+    mask = (std == 0)
+    mask |= robust_outliers(mean, sigma)
+    mask |= robust_outliers(std, sigma)
+    mask |= sk_bad > frac * nchunks
+    return mask
+
+
+def write_flag_file(outfile, mask):
+    '''
+    Writes the channel numbers of all flagged channels to outfile. The file is
+    written to a temporary name first such that concurrent readers (or
+    writers) never see a partial file.
+    '''
+    tmpfile = f'{outfile}.{os.getpid()}.tmp'
+    np.savetxt(tmpfile, np.flatnonzero(mask), fmt='%d')
+    os.replace(tmpfile, outfile)
+    return outfile
+
+
+def get_flag_file(filename, outfile=None, flagdir=None, station=None, refresh=False,
+                  **kwargs):
+    '''
+    Returns the flag file for the setup of filename, computing it only if it
+    does not exist yet (or refresh is set). kwargs are passed to compute_mask.
+    '''
+    if outfile is None:
+        if (flagdir is None) or (station is None):
+            raise InputError('Need either an outfile or both flagdir and station.')
+        header, _ = filterbank.read_header(filename)
+        outfile = flag_file_name(flagdir, station, *get_setup(header))
+    if os.path.exists(outfile) and not refresh:
+        print(f'Re-using existing flag file {outfile}.')
+        return outfile
+    mask = compute_mask(filename, **kwargs)
+    print(f'Flagged {mask.sum()} out of {len(mask)} channels.')
+    return write_flag_file(outfile, mask)
+
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+    pass
+
+
+class InputError(Error):
+    """Exception raised for errors in the input.
+
+    Attributes:
+        message -- explanation of the error
+    """
+
+    def __init__(self, message):
+        self.message = message
+
+
+if __name__ == "__main__":
+    args = options()
+    nsamples = None
+    if args.nsec is not None:
+        header, _ = filterbank.read_header(args.filterbank)
+        nsamples = int(args.nsec / header['tsamp'])
+    flagfile = get_flag_file(args.filterbank, args.outfile, args.flagdir, args.station,
+                             refresh=args.refresh, sigma=args.sigma, frac=args.frac,
+                             chunksize=args.chunksize, nsamples=nsamples)
+    print(f'Flag file is {flagfile}')
@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+'''
+Distributes base2fil work over any number of processing nodes. A config is
+split into one config per scan, and each of these becomes a task in a queue
+kept in an SQLite database (put it on a file system all nodes can see and
+that supports locking). Workers on any node claim tasks with a lease they keep
+renewing while base2fil runs; a task whose worker disappeared becomes
+available again once its lease expired. Workers record which host ran a task,
+its log and the filterbanks it produced.
+
+The scan is the smallest unit: all IFs of a scan have to end up on the same
+node to be spliced. Several workers on one machine work just as well, e.g.
+for testing with --command 'sleep 1 && echo Output {config}'.
+'''
+import argparse
+import json
+import os
+import socket
+import sqlite3
+import subprocess
+import threading
+import time
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    config TEXT UNIQUE NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    submitted REAL,
+    started REAL,
+    finished REAL,
+    returncode INTEGER,
+    log TEXT,
+    outputs TEXT
+)
+'''
+SCAN_ARRAYS = ['scans', 'skips', 'lengths', 'scannames', 'byteranges']
+# arrays older configs may lack, with what base2fil.sh assumes for a missing entry
+OPTIONAL_ARRAYS = {'byteranges': '-'}
+
+
+def options():
+    parser = argparse.ArgumentParser(
+        description='Queue of per-scan base2fil tasks that workers on several nodes '+
+        'process in parallel.')
+    general = parser.add_argument_group('General info about the data.')
+    general.add_argument('action', type=str, choices=['submit', 'worker', 'status', 'requeue'],
+                         help='submit: split configs into per-scan tasks and queue them. '+
+                         'worker: process tasks until stopped. '+
+                         'status: print all tasks. requeue: set failed tasks back to pending.')
+    general.add_argument('queue', type=str,
+                         help='SQLite database that holds the queue. Created if needed.')
+    general.add_argument('configs', type=str, nargs='*',
+                         help='base2fil configs to submit. A .json file is read as manifest '+
+                         'of configs as written by create_config.py --manifest.')
+    general.add_argument('--command', type=str, default='base2fil {config}',
+                         help='Command a worker runs for a task. Default=\'%(default)s\'.')
+    general.add_argument('--lease', type=float, default=300,
+                         help='Seconds a claimed task stays with a worker without heartbeat. '+
+                         'Default=%(default)s.')
+    general.add_argument('--max_attempts', type=int, default=3,
+                         help='A task is marked as failed after this many attempts. '+
+                         'Default=%(default)s.')
+    general.add_argument('--poll', type=float, default=30,
+                         help='Seconds a worker waits before looking for new tasks. '+
+                         'Default=%(default)s.')
+    general.add_argument('--once', action='store_true',
+                         help='If set a worker exits once there is nothing left to do.')
+    return parser.parse_args()
+
+
+def connect(queue):
+    '''
+    Opens (and if needed creates) the queue database.
+    '''
+    db = sqlite3.connect(queue, timeout=60, isolation_level=None)
+    db.row_factory = sqlite3.Row
+    db.execute(SCHEMA)
+    return db
+
+
+def read_scan_arrays(config):
+    '''
+    Sources config in bash and returns a dictionary with the lists of scans,
+    skips, lengths, scannames and byteranges defined therein. Optional
+    arrays the config does not define are left out.
+    '''
+    script = 'source "$0" > /dev/null; ' + \
+             '; '.join(f'echo ${{{name}[@]}}' for name in SCAN_ARRAYS)
+    lines = subprocess.check_output(['bash', '-c', script, config]).decode().split('\n')
+    arrays = {name: line.split() for name, line in zip(SCAN_ARRAYS, lines)}
+    for name in OPTIONAL_ARRAYS:
+        if not arrays[name]:
+            del arrays[name]
+    if not len(arrays['scans']) == len(arrays['scannames']):
+        raise InputError(f'scans and scannames in {config} differ in length.')
+    return arrays
+
+
+def read_manifest(manifest):
+    '''
+    Returns the list of configs in a manifest written by create_config.py.
+    '''
+    with open(manifest) as f:
+        return [entry['config'] for entry in json.load(f)]
+
+
+def split_config(config, configdir):
+    '''
+    Writes one config per scan of config to configdir. Each is a copy of
+    config with the scan arrays reduced to that one scan. Returns the list of
+    new configs.
+    '''
+    arrays = read_scan_arrays(config)
+    with open(config) as f:
+        text = f.read()
+    base = os.path.splitext(os.path.basename(config))[0]
+    os.makedirs(configdir, exist_ok=True)
+    configs = []
+    for i, scanname in enumerate(arrays['scannames']):
+        lines = []
+        for name in SCAN_ARRAYS:
+            if name not in arrays:
+                continue
+            if i < len(arrays[name]):
+                lines.append(f'{name}=( {arrays[name][i]} )')
+            elif name in OPTIONAL_ARRAYS:
+                # the full array of the original config must not shine through
+                lines.append(f'{name}=( {OPTIONAL_ARRAYS[name]} )')
+        scan_config = f'{configdir}/{base}_scan{scanname}.conf'
+        with open(scan_config, 'w') as f:
+            f.write(text.rstrip('\n') + '\n\n# scan arrays set by scan_queue.py\n' +
+                    '\n'.join(lines) + '\n')
+        configs.append(scan_config)
+    return configs
+
+
+def submit(db, configs):
+    '''
+    Adds configs as pending tasks. Configs that are queued already are left
+    alone. Returns the number of new tasks.
+    '''
+    n = 0
+    for config in configs:
+        cursor = db.execute('INSERT OR IGNORE INTO tasks (config, submitted) VALUES (?, ?)',
+                            (os.path.abspath(config), time.time()))
+        n += cursor.rowcount
+    return n
+
+
+def claim(db, worker, lease=300, max_attempts=3):
+    '''
+    Claims the oldest task that is pending or whose lease has expired.
+    Returns the task as a row or None if there is nothing to do.
+    '''
+    now = time.time()
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        # tasks that lost their worker too often are given up
+        db.execute("UPDATE tasks SET status='failed' WHERE status='running' AND lease_expires<? "+
+                   "AND attempts>=?", (now, max_attempts))
+        task = db.execute("SELECT * FROM tasks WHERE status='pending' OR "+
+                          "(status='running' AND lease_expires<?) ORDER BY id LIMIT 1",
+                          (now,)).fetchone()
+        if task is not None:
+            db.execute("UPDATE tasks SET status='running', worker=?, lease_expires=?, "+
+                       "attempts=attempts+1, started=? WHERE id=?",
+                       (worker, now + lease, now, task['id']))
+        db.execute('COMMIT')
+    except Exception:
+        db.execute('ROLLBACK')
+        raise
+    return task
+
+
+def heartbeat(queue, task_id, worker, lease, stop):
+    '''
+    Renews the lease of task_id every lease/3 seconds until stop is set.
+    '''
+    db = connect(queue)
+    while not stop.wait(lease / 3.):
+        db.execute('UPDATE tasks SET lease_expires=? WHERE id=? AND worker=?',
+                   (time.time() + lease, task_id, worker))
+    db.close()
+
+
+def finish(db, task_id, worker, returncode, log, outputs, max_attempts=3):
+    '''
+    Records the result of a task. Failed tasks go back to pending until they
+    used up max_attempts.
+    '''
+    task = db.execute('SELECT attempts FROM tasks WHERE id=?', (task_id,)).fetchone()
+    if returncode == 0:
+        status = 'done'
+    else:
+        status = 'failed' if task['attempts'] >= max_attempts else 'pending'
+    db.execute('UPDATE tasks SET status=?, finished=?, returncode=?, log=?, outputs=? '+
+               'WHERE id=? AND worker=?',
+               (status, time.time(), returncode, log, json.dumps(outputs), task_id, worker))
+    return status
+
+
+def run_task(task, command, logdir):
+    '''
+    Runs command for task with all output going to a log file. Returns the
+    exit code, the log and the outputs base2fil reported.
+    '''
+    os.makedirs(logdir, exist_ok=True)
+    log = f'{logdir}/{os.path.basename(task["config"])}.{task["attempts"] + 1}.log'
+    with open(log, 'w') as f:
+        returncode = subprocess.call(command.format(config=task['config']), shell=True,
+                                     stdout=f, stderr=subprocess.STDOUT)
+    host = socket.gethostname()
+    with open(log) as f:
+        # base2fil reports each finished filterbank as '<date> <time> Output <path>'
+        outputs = [f'{host}:{line.split(" Output ")[1].strip()}' for line in f
+                   if ' Output ' in line]
+    return returncode, log, outputs
+
+
+def work(queue, command, lease=300, max_attempts=3, poll=30, once=False):
+    '''
+    Processes tasks of queue one at a time until there are none left (once)
+    or forever.
+    '''
+    db = connect(queue)
+    worker = f'{socket.gethostname()}:{os.getpid()}'
+    logdir = f'{os.path.dirname(os.path.abspath(queue))}/logs'
+    while True:
+        task = claim(db, worker, lease, max_attempts)
+        if task is None:
+            if once:
+                break
+            time.sleep(poll)
+            continue
+        print(f'{worker} working on {task["config"]}')
+        stop = threading.Event()
+        beat = threading.Thread(target=heartbeat, args=(queue, task['id'], worker, lease, stop),
+                                daemon=True)
+        beat.start()
+        try:
+            returncode, log, outputs = run_task(task, command, logdir)
+        finally:
+            stop.set()
+            beat.join()
+        status = finish(db, task['id'], worker, returncode, log, outputs, max_attempts)
+        print(f'{worker} finished {task["config"]}: {status}')
+
+
+def status(db):
+    '''
+    Prints all tasks.
+    '''
+    for task in db.execute('SELECT * FROM tasks ORDER BY id'):
+        outputs = ', '.join(json.loads(task['outputs'])) if task['outputs'] else ''
+        print(f'{task["id"]:4d} {task["status"]:8s} {os.path.basename(task["config"]):40s} '+
+              f'{task["worker"] or "":25s} attempts={task["attempts"]} {outputs}')
+
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+    pass
+
+
+class InputError(Error):
+    """Exception raised for errors in the input.
+
+    Attributes:
+        message -- explanation of the error
+    """
+
+    def __init__(self, message):
+        self.message = message
+
+
+if __name__ == "__main__":
+    args = options()
+    db = connect(args.queue)
+    if args.action == 'submit':
+        configdir = f'{os.path.dirname(os.path.abspath(args.queue))}/configs'
+        configs = []
+        for config in args.configs:
+            configs += read_manifest(config) if config.endswith('.json') else [config]
+        configs = [c for config in configs for c in split_config(config, configdir)]
+        print(f'Queued {submit(db, configs)} new tasks.')
+    elif args.action == 'worker':
+        work(args.queue, args.command, args.lease, args.max_attempts, args.poll, args.once)
+    elif args.action == 'status':
+        status(db)
+    else:
+        n = db.execute("UPDATE tasks SET status='pending', attempts=0 WHERE status='failed'").rowcount
+        print(f'Re-queued {n} tasks.')
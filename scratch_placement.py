@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+'''
+Decides which scratch directory each IF of a scan is split into. The write
+bandwidth of each directory is measured once (and cached in the directory for
+a day) and the IFs are spread such that all directories finish writing at
+about the same time, without putting more on a directory than it has space
+for. Directories on the same device share their bandwidth and free space.
+IFs that were split before stay where they are. Prints one directory per IF.
+'''
+import argparse
+import json
+import os
+import sys
+import time
+
+BANDWIDTH_CACHE = '.write_bandwidth.json'
+
+
+def options():
+    parser = argparse.ArgumentParser(
+        description='Distributes the IFs of a scan over several scratch directories '+
+        'according to their write bandwidth and free space.')
+    general = parser.add_argument_group('General info about the data.')
+    general.add_argument('dirs', type=str, nargs='+',
+                         help='Scratch directories.')
+    general.add_argument('--nif', type=int, required=True,
+                         help='Number of IFs.')
+    general.add_argument('--bytes_per_if', type=float, default=0,
+                         help='Expected size of each split file in bytes. Default=%(default)s.')
+    general.add_argument('--basename', type=str, default=None,
+                         help='If set, IFs for which <dir>/<basename>_IF<n>.vdif exists already '+
+                         'stay in that directory.')
+    general.add_argument('--reserve', type=float, default=100,
+                         help='GB to keep free on each device. Default=%(default)s.')
+    general.add_argument('--test_size', type=int, default=256,
+                         help='MB to write when measuring the bandwidth. Default=%(default)s.')
+    general.add_argument('--max_age', type=float, default=86400,
+                         help='Seconds after which a bandwidth measurement is redone. '+
+                         'Default=%(default)s.')
+    return parser.parse_args()
+
+
+def measure_bandwidth(directory, test_size=256, max_age=86400):
+    '''
+    Returns the write bandwidth of directory in MB/s, measured by writing
+    and syncing a file of test_size MB. The result is cached in directory.
+    '''
+    cache = f'{directory}/{BANDWIDTH_CACHE}'
+    try:
+        with open(cache) as f:
+            cached = json.load(f)
+        if time.time() - cached['time'] < max_age:
+            return cached['bandwidth']
+    except (OSError, ValueError, KeyError):
+        pass
+    testfile = f'{directory}/.write_test.{os.getpid()}'
+    block = os.urandom(2**20)
+    t0 = time.time()
+    try:
+        with open(testfile, 'wb') as f:
+            for _ in range(test_size):
+                f.write(block)
+            f.flush()
+            os.fsync(f.fileno())
+        bandwidth = test_size / max(time.time() - t0, 1e-3)
+    finally:
+        if os.path.exists(testfile):
+            os.remove(testfile)
+    with open(cache, 'w') as f:
+        json.dump({'time': time.time(), 'bandwidth': bandwidth}, f)
+    return bandwidth
+
+
+def free_space(directory):
+    '''
+    Returns the number of bytes available to the user in directory.
+    '''
+    stat = os.statvfs(directory)
+    return stat.f_bavail * stat.f_frsize
+
+
+def place(dirs, nif, bytes_per_if, bandwidths, free, fixed=None):
+    '''
+    Returns a list with the directory for each of the nif IFs. Each IF goes
+    to the device on which it would be finished first given what is already
+    placed there and the bandwidth of the device, as long as there is space.
+    fixed maps IF indices (0-based) to directories that must be kept.
+    '''
+    fixed = {} if fixed is None else fixed
+    devices = {}
+    for directory, bandwidth, space in zip(dirs, bandwidths, free):
+        dev = os.stat(directory).st_dev
+        # directories on the same device share bandwidth and space
+        devices.setdefault(dev, {'dirs': [], 'bandwidth': bandwidth, 'free': space, 'load': 0})
+        devices[dev]['dirs'].append(directory)
+    placement = [None] * nif
+    for i, directory in fixed.items():
+        placement[i] = directory
+        devices[os.stat(directory).st_dev]['load'] += 1
+    for i in range(nif):
+        if placement[i] is not None:
+            continue
+        fits = [d for d in devices.values() if (d['load'] + 1) * bytes_per_if <= d['free']]
+        if len(fits) == 0:
+            # better to try than to give up: go for the device with the most space left
+            print(f'Warning: not enough scratch space for IF{i+1} ({bytes_per_if/1e9:.1f} GB).',
+                  file=sys.stderr)
+            best = max(devices.values(), key=lambda d: d['free'] - d['load'] * bytes_per_if)
+        else:
+            best = min(fits, key=lambda d: (d['load'] + 1) / d['bandwidth'])
+        # round-robin over the directories of a device
+        placement[i] = best['dirs'][best['load'] % len(best['dirs'])]
+        best['load'] += 1
+    return placement
+
+
+def existing_placement(dirs, nif, basename):
+    '''
+    Returns a dictionary that maps IF indices (0-based) to the directory in
+    which <basename>_IF<n>.vdif exists already.
+    '''
+    fixed = {}
+    for i in range(nif):
+        for directory in dirs:
+            if os.path.exists(f'{directory}/{basename}_IF{i+1}.vdif'):
+                fixed[i] = directory
+                break
+    return fixed
+
+
+if __name__ == "__main__":
+    args = options()
+    dirs = [os.path.normpath(d) for d in args.dirs]
+    bandwidths = [measure_bandwidth(d, args.test_size, args.max_age) for d in dirs]
+    free = [max(free_space(d) - args.reserve * 1e9, 0) for d in dirs]
+    fixed = existing_placement(dirs, args.nif, args.basename) if args.basename else {}
+    for directory in place(dirs, args.nif, args.bytes_per_if, bandwidths, free, fixed):
+        print(directory)
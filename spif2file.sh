@@ -10,14 +10,35 @@ length=${7:-9999}  #in seconds
 scanname=${8:-${scan}}
 flipped=${9:-0} # recipes assume LO is below sky freq, if LO above sky freq LSB and USB are flipped
 vbs_fs_dir=${10:-"${HOME}/vbs_data/${experiment}/"}
-outdir1=${11:-"/scratch0/${USER}/${experiment}"}
-outdir2=${12:-"/scratch1/${USER}/${experiment}"}
+outdir1=${11:-"/scratch0/${USER}/${experiment}"} # either the directory for odd IFs or a comma-separated list with one directory per IF
+outdir2=${12:-"/scratch1/${USER}/${experiment}"} # directory for even IFs, ignored if outdir1 is a list
 online=${13:-0}
+byterange=${14:-"-"} # start:stop bytes of the scan in the recording (e.g. from create_config.py --gapmaps), overrides skip and length
+first_poll=${SPIF2FILE_FIRST_POLL:-30} # seconds between submitting the split and the first status query
+poll=${SPIF2FILE_POLL:-10}             # seconds between status queries while jive5ab is busy
 
 linkdir="/tmp/${USER}/${experiment}/${scanname}"
 
+# output directory of each IF, first entry is IF1
+if [[ ${outdir1} == *,* ]]; then
+    if_dirs=( ${outdir1//,/ } )
+else
+    if_dirs=()
+    for i in `seq 1 ${nif}`;do
+        if [[ $((i % 2)) -eq 1 ]]; then
+            if_dirs+=( ${outdir1} )
+        else
+            if_dirs+=( ${outdir2} )
+        fi
+    done
+fi
+if [[ ${#if_dirs[@]} -ne ${nif} ]]; then
+    echo "`date +%d'-'%m'-'%y' '%H':'%M':'%S` Got ${#if_dirs[@]} output directories for ${nif} IFs. Aborting."
+    exit 1
+fi
+
 mode=${mode^^} # set all upper case
-directs="${outdir1} ${outdir2} ${linkdir}"
+directs="`printf '%s\n' ${if_dirs[@]} | sort -u` ${linkdir}"
 for dir in $directs;do
     if ! [ -d ${dir} ];then
 	mkdir -p ${dir}
@@ -132,23 +153,25 @@ fi
 echo "`date +%d'-'%m'-'%y' '%H':'%M':'%S` Using mode ${mode}."
 echo "`date +%d'-'%m'-'%y' '%H':'%M':'%S` Using recipe ${recipe}"
 
-let nif=${nif}-2 # we actually do a plus 1 below and go in steps of two
-# rare case of just one IF...
-if [[ ${nif} -lt 0 ]]; then
-    nif=0
-fi
 bytes_per_second=`echo "${input_framesize}*${frames_per_second}" | bc`
 bytes_per_minute=`echo "${bytes_per_second}*60" | bc`
 vbs_fs_file=${experiment}"_${station}_no0"${scan}
 vbs_vdif_file=${experiment}"_${station}_no0"${scanname}
-start_frame=`vdif_print_headers ${vbs_fs_dir}/${vbs_fs_file} -n1 | tail -1 | tr "," " " | tr " " "|" | awk -F "|" '{print $5}'`
-if [[ ${mode:0:6} == 'MARK5B' ]];then
-    start_frame=0
+if [[ ${byterange} != '-' ]]; then
+    # exact to a frame already, located by the time stamps in the frame headers
+    start_byte=${byterange%:*}
+    stop_byte=${byterange#*:}
+else
+    start_frame=`vdif_print_headers ${vbs_fs_dir}/${vbs_fs_file} -n1 | tail -1 | tr "," " " | tr " " "|" | awk -F "|" '{print $5}'`
+    if [[ ${mode:0:6} == 'MARK5B' ]];then
+        start_frame=0
+    fi
+    skipbytes=`echo "(${frames_per_second}-${start_frame}-1)*${input_framesize}" | bc`
+    skipbytes=`echo "${skipbytes}+${bytes_per_second}*${skip}" | bc`
+    start_byte=${skipbytes}
+    stop_byte=`echo "${start_byte}+${bytes_per_second}*${length}+16*${input_framesize}" | bc`
 fi
-skipbytes=`echo "(${frames_per_second}-${start_frame}-1)*${input_framesize}" | bc`
-skipbytes=`echo "${skipbytes}+${bytes_per_second}*${skip}" | bc`
-start_byte=${skipbytes}
-stop_byte=`echo "${start_byte}+${bytes_per_second}*${length}+16*${input_framesize}" | bc`
+echo "`date +%d'-'%m'-'%y' '%H':'%M':'%S` Splitting bytes ${start_byte} to ${stop_byte}."
 
 runtime=${experiment}_${station}_0${scan}
 if [[ ${online} -gt 0 ]];then
@@ -157,23 +180,16 @@ fi
 
 state=$(cmd2flexbuff "runtime=${runtime};spif2file?" | awk '{print $10}')
 while [[ ${state} == 'active' ]];do
-    sleep 30
+    sleep ${first_poll}
     state=$(cmd2flexbuff "runtime=${runtime};spif2file?" | awk '{print $10}')
 done
-for i in `seq 0 2 ${nif}`;do
-    let ii=$i+1
+# jive5ab writes tag i to if_i, which links to IF i+1 in the directory it was placed in
+for i in `seq 0 $((nif-1))`;do
     if [[ -L ${linkdir}/if_${i} ]]; then
         rm ${linkdir}/if_${i}
     fi
-    if [[ -L ${linkdir}/if_${ii} ]]; then
-        rm ${linkdir}/if_${ii}
-    fi
-    let odd_if=$i+1
-    let even_if=$ii+1
-    echo "ln -s ${outdir1}/${vbs_vdif_file}_IF${odd_if}.vdif ${linkdir}/if_${i}"
-    echo "ln -s ${outdir2}/${vbs_vdif_file}_IF${even_if}.vdif ${linkdir}/if_${ii}"
-    ln -s ${outdir1}/${vbs_vdif_file}_IF${odd_if}.vdif ${linkdir}/if_${i}
-    ln -s ${outdir2}/${vbs_vdif_file}_IF${even_if}.vdif ${linkdir}/if_${ii}
+    echo "ln -s ${if_dirs[$i]}/${vbs_vdif_file}_IF$((i+1)).vdif ${linkdir}/if_${i}"
+    ln -s ${if_dirs[$i]}/${vbs_vdif_file}_IF$((i+1)).vdif ${linkdir}/if_${i}
 done
 cmd2flexbuff \
     "runtime=${runtime}; \
@@ -184,11 +200,11 @@ cmd2flexbuff \
      spif2file=bitsperchannel:${bitspersample}; \
      spif2file=connect:${vbs_fs_dir}/${vbs_fs_file}:${recipe}=${linkdir}/if_{tag},w; \
      spif2file=on:${start_byte}:${stop_byte} "
-echo "`date +%d'-'%m'-'%y' '%H':'%M':'%S` Splitting job for ${vbs_fs_file} submitted, waiting 30s."
-sleep 30
+echo "`date +%d'-'%m'-'%y' '%H':'%M':'%S` Splitting job for ${vbs_fs_file} submitted, waiting ${first_poll}s."
+sleep ${first_poll}
 state=$(cmd2flexbuff "runtime=${runtime};spif2file?" | awk '{print $10}')
 while [[ ${state} == 'active' ]];do
-    sleep 10
+    sleep ${poll}
     state=$(cmd2flexbuff "runtime=${runtime};spif2file?" | awk '{print $10}')
 done
 # delete the runtime to make jive5ab disconnect from the input file such that we can unmount the directory if needed
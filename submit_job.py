@@ -30,6 +30,9 @@ def options():
                          help='REQUIRED. Vex file of the experiment (absolute path).')
     general.add_argument('-e', '--expname', type=str, required=False, default=None,
                          help='Only needed if experiment name is different from vex file name.')
+    general.add_argument('-q', '--queue', type=str, required=False, default=None,
+                         help='If set the job is added to this scan_queue.py queue instead of '+
+                         'running base2fil here.')
     return parser.parse_args()
 
 
@@ -115,7 +118,7 @@ def main(args):
 
     ConfigFile = ConfigDir + ExpName + "_" + TelName + "_" + SourceName + "_no" + ScanNbr + ".conf"
     FlagFile = FlagDir + TelName + ".flag_" + str(f_min) + "-" + str(f_max) + "MHz_" + str(NbrOfChan_FFT) + "chan"
-    CreateConfig = "create_config.py -i " + VexFile + " -s " + SourceName + " -t " + TelName + " -N " + str(TotalSlots) + " -d " + str(DownSamp) + " -n " + str(ChanPerIF) + " -S " + ScanNbr + " -F " + FlagFile + " --online" + " -o " + ConfigFile
+    CreateConfig = "create_config.py -i " + VexFile + " -s " + SourceName + " -t " + TelName + " -N " + str(TotalSlots) + " -d " + str(DownSamp) + " -n " + str(ChanPerIF) + " -S " + ScanNbr + " -F " + FlagFile + " --autoflag --online" + " -o " + ConfigFile
     if dm.isPulsar is False:
         CreateConfig += CreateConfig + " --search"
     else:
@@ -123,6 +126,9 @@ def main(args):
     os.system(CreateConfig)
 
     SubmitJob = "base2fil " + ConfigFile
+    if args.queue is not None:
+        # any worker of the queue may pick it up, on this or any other node
+        SubmitJob = "scan_queue.py submit " + args.queue + " " + ConfigFile
     # Check so there are enough available job slots before submitting the job.
     #MaxBusySlots = int(TotalSlots-(NbrOfIF+1))
     #CheckDigifil = "while [ $(ps -ef | grep digifil | grep -v /bin/sh | wc -l) -gt " + str(MaxBusySlots) + " ]; do sleep 30; done"
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# the tools are flat modules in the top directory
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
@@ -0,0 +1,33 @@
+import os
+import cpu_placement
+
+NODES = {0: [0, 1, 2, 3], 1: [4, 5, 6, 7]}
+
+
+def test_place_avoids_running_digifils():
+    # an earlier scan's two IFs still run on 0-1 and 4-5
+    running = {0: 1, 1: 1, 4: 1, 5: 1}
+    placement = cpu_placement.place([0, 1], NODES, nthreads=2, running=running)
+    assert placement == [([2, 3], 0), ([6, 7], 1)]
+
+
+def test_place_moves_off_a_full_node():
+    running = {0: 1, 1: 1, 2: 1, 3: 1}
+    placement = cpu_placement.place([0, 0], NODES, nthreads=2, running=running)
+    assert placement == [([4, 5], 1), ([6, 7], 1)]
+
+
+def test_running_cpus(tmp_path):
+    allowed = sorted(os.sched_getaffinity(os.getpid()))
+    for pid, comm, cpulist in [(10, 'digifil', f'{allowed[0]}'),
+                               (11, 'digifil', cpu_placement.format_cpulist(allowed)),
+                               (12, 'bash', f'{allowed[0]}')]:
+        (tmp_path / str(pid)).mkdir()
+        (tmp_path / str(pid) / 'comm').write_text(comm + '\n')
+        (tmp_path / str(pid) / 'status').write_text(f'Name:\t{comm}\nCpus_allowed_list:\t{cpulist}\n')
+    running = cpu_placement.running_cpus(proc=str(tmp_path))
+    if len(allowed) > 1:
+        assert running == {allowed[0]: 1}
+    else:
+        # on a single CPU nothing can be bound to less than everything
+        assert running == {}
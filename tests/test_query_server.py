@@ -0,0 +1,87 @@
+import os
+import subprocess
+import sys
+import time
+import query_server
+from conftest import REPO
+
+VEX = '''VEX_rev = 1.5;
+$EXPER;
+def PR123A;
+    exper_name = PR123A;
+enddef;
+$MODE;
+def m1;
+    ref $FREQ = 1658MHz8x16MHz:Ef;
+    ref $IF = LO@1400MHzDPolTone/1:Ef;
+    ref $TRACKS = VDIF.8Ch2bit1to1:Ef;
+enddef;
+$SOURCE;
+def B0329+54;
+    source_name = B0329+54;
+    ra = 03h32m59.37s; dec = 54d34'43.6"; ref_coord_frame = J2000;
+enddef;
+$SCHED;
+scan No0001;
+    start=2021y100d12h00m00s; mode=m1; source=B0329+54;
+    station=Ef:    0 sec:  120 sec:    0.000 GB:   :       : 1;
+endscan;
+'''
+
+
+def test_coherent_create_config_through_server(tmp_path):
+    '''
+    create_config.py --coherent looks up the DM of the source while the
+    server runs it, which must not go back through the socket.
+    '''
+    (tmp_path / 'pr123a.vex').write_text(VEX)
+    psrcat = tmp_path / 'psrcat'
+    psrcat.write_text('#!/bin/sh\necho 26.76\n')
+    psrcat.chmod(0o755)
+    socket_path = str(tmp_path / 'server.sock')
+    env = dict(os.environ, QUERY_SERVER_SOCKET=socket_path,
+               PATH=f'{tmp_path}:{os.environ["PATH"]}')
+    server = subprocess.Popen([sys.executable, os.path.join(REPO, 'query_server.py'), 'serve'],
+                              env=env, stdout=subprocess.DEVNULL)
+    try:
+        for _ in range(100):
+            if os.path.exists(socket_path):
+                break
+            time.sleep(0.1)
+        t0 = time.time()
+        answer = query_server.query({'tool': 'create_config',
+                                     'argv': ['-i', 'pr123a.vex', '-s', 'B0329+54', '-t', 'ef',
+                                              '--coherent'],
+                                     'cwd': str(tmp_path), 'env': env}, socket_path, timeout=30)
+        assert time.time() - t0 < 10
+    finally:
+        server.terminate()
+        server.wait()
+    assert answer['returncode'] == 0, answer['stderr']
+    config = (tmp_path / 'PR123A_ef_B0329+54.conf').read_text()
+    assert 'coherentDM=26.76' in config
+
+
+def test_failed_psrcat_lookup_is_retried(tmp_path, monkeypatch):
+    '''
+    Without PSRCAT_FILE a psrcat answer would be kept forever, so a failed
+    lookup must not be kept at all.
+    '''
+    import dm_utils
+    psrcat = tmp_path / 'psrcat'
+    psrcat.write_text('#!/bin/sh\nexit 1\n')
+    psrcat.chmod(0o755)
+    monkeypatch.setenv('PATH', f'{tmp_path}:{os.environ["PATH"]}')
+    monkeypatch.delenv('PSRCAT_FILE', raising=False)
+    monkeypatch.delenv('PSRCAT_RUNDIR', raising=False)
+    monkeypatch.setattr(query_server, '_CACHE', {})
+    assert dm_utils.get_dm('J0000+0000', use_server=False) is None
+    psrcat.write_text('#!/bin/sh\necho 12.5\n')
+    assert dm_utils.get_dm('J0000+0000', use_server=False) == 12.5
+
+
+def test_psrcat_catalogue_falls_back_to_rundir(monkeypatch):
+    import dm_utils
+    monkeypatch.delenv('PSRCAT_FILE', raising=False)
+    monkeypatch.setenv('PSRCAT_RUNDIR', '/opt/psrcat')
+    assert dm_utils.psrcat_catalogue() == ['/opt/psrcat/psrcat.db']
@@ -0,0 +1,15 @@
+import os
+import numpy as np
+import readahead
+
+
+def test_iter_frames_yields_partial_block(tmp_path, monkeypatch):
+    filename = str(tmp_path / 'frames.bin')
+    frames = np.arange(10 * 16, dtype=np.uint8).reshape(10, 16)
+    frames.tofile(filename)
+    # the file ends before the frames it was thought to hold, e.g. it was truncated
+    getsize = os.path.getsize
+    monkeypatch.setattr(readahead.os.path, 'getsize', lambda f: getsize(f) + 3 * 16)
+    blocks = list(readahead.iter_frames(filename, 16, 4))
+    assert [first for first, _ in blocks] == [0, 4, 8]
+    assert np.array_equal(np.concatenate([block for _, block in blocks]), frames)
@@ -0,0 +1,52 @@
+import os
+import subprocess
+import sys
+import numpy as np
+import rfi_flag
+from conftest import REPO
+
+VEX = '''VEX_rev = 1.5;
+$EXPER;
+def PR123A;
+    exper_name = PR123A;
+enddef;
+$MODE;
+def m1;
+    ref $FREQ = 1658MHz8x16MHz:Ef:O8;
+    ref $IF = LO@1400MHzDPolTone/1:Ef:O8;
+    ref $TRACKS = VDIF.8Ch2bit1to1:Ef:O8;
+enddef;
+$SOURCE;
+def R3;
+    source_name = R3;
+    ra = 01h58m00.75s; dec = 65d43'00.3"; ref_coord_frame = J2000;
+enddef;
+$SCHED;
+scan No0001;
+    start=2021y100d12h00m00s; mode=m1; source=R3;
+    station=Ef:    0 sec:  300 sec:    0.000 GB:   :       : 1;
+    station=O8:    0 sec:  300 sec:    0.000 GB:   :       : 1;
+endscan;
+'''
+
+
+def test_flag_file_format(tmp_path):
+    # one channel number per line, as the hand-made flag files read by Heimdall and FETCH
+    mask = np.zeros(256, dtype=bool)
+    mask[[0, 17, 255]] = True
+    flagfile = rfi_flag.write_flag_file(str(tmp_path / 'ef.flag_1572-1700MHz_256chan'), mask)
+    lines = open(flagfile).read().split('\n')
+    assert lines == ['0', '17', '255', '']
+    assert np.loadtxt(flagfile, dtype=int, ndmin=1).tolist() == [0, 17, 255]
+
+
+def test_flag_file_per_station(tmp_path):
+    (tmp_path / 'pr123a.vex').write_text(VEX)
+    env = dict(os.environ, QUERY_SERVER_SOCKET=str(tmp_path / 'none.sock'))
+    subprocess.check_call([sys.executable, os.path.join(REPO, 'create_config.py'), '-i', 'pr123a.vex',
+                           '-s', 'R3', '-t', 'ef', 'o8', '--autoflag',
+                           '-F', str(tmp_path / 'ef.flag_1572-1700MHz_256chan')],
+                          cwd=tmp_path, env=env, stdout=subprocess.DEVNULL)
+    for station in ['ef', 'o8']:
+        config = (tmp_path / f'PR123A_{station}_R3.conf').read_text()
+        assert f'flagFile={tmp_path}/{station}.flag_1572-1700MHz_256chan\n' in config
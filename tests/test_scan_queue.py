@@ -0,0 +1,32 @@
+import subprocess
+import scan_queue
+
+CONFIG = '''experiment=pr123a
+station=effelsberg
+scans=( 001 002 003 )
+skips=( 0 10 20 )
+lengths=( 300 300 120 )
+scannames=( 001 002 003 )
+'''
+
+
+def source(config, *names):
+    script = 'source "$0" > /dev/null; ' + '; '.join(f'echo ${{{name}[0]}}' for name in names)
+    return subprocess.check_output(['bash', '-c', script, config]).decode().split()
+
+
+def test_split_with_byteranges(tmp_path):
+    config = tmp_path / 'pr123a_ef_R3.conf'
+    config.write_text(CONFIG + 'byteranges=( 0:800 800:1600 1600:2400 )\n')
+    configs = scan_queue.split_config(str(config), str(tmp_path / 'scans'))
+    assert len(configs) == 3
+    assert source(configs[2], 'scans', 'skips', 'byteranges') == ['003', '20', '1600:2400']
+    assert source(configs[1], 'scans', 'byteranges') == ['002', '800:1600']
+
+
+def test_split_without_byteranges(tmp_path):
+    config = tmp_path / 'pr123a_ef_R3.conf'
+    config.write_text(CONFIG)
+    configs = scan_queue.split_config(str(config), str(tmp_path / 'scans'))
+    assert source(configs[1], 'scans', 'lengths') == ['002', '300']
+    assert 'byteranges' not in open(configs[1]).read()
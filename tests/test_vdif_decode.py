@@ -0,0 +1,23 @@
+import numpy as np
+import jive5ab_emulator
+import vdif_decode
+
+
+def test_mark5b_matches_swapped_vdif():
+    '''
+    Decoding Mark5B directly has to give what digifil gets from the VDIF
+    jive5ab makes of it by swapping sign and magnitude bits.
+    '''
+    nframes, nchan, nbits = 4, 4, 2
+    frames = np.random.default_rng(1).integers(0, 256, (nframes, vdif_decode.MARK5B_HEADER_SIZE +
+                                                        vdif_decode.MARK5B_PAYLOAD_SIZE), dtype=np.uint8)
+    headers = np.zeros((nframes, 4), dtype='<u4')
+    headers[:, 0] = vdif_decode.MARK5B_SYNC_WORD
+    headers[:, 1] = np.arange(nframes)
+    frames[:, :16] = headers.view(np.uint8)
+    splitter = jive5ab_emulator.Splitter('swap_sign_mag+8>[0,1,2,3,4,5,6,7]:0',
+                                         vdif_decode.MARK5B_PAYLOAD_SIZE, nbits,
+                                         frames.shape[1], mark5b=True)
+    vdif = np.frombuffer(splitter.split(frames)[0], dtype=np.uint8).reshape(nframes, -1)
+    assert np.array_equal(vdif_decode.decode_mark5b(frames, nchan, nbits),
+                          vdif_decode.decode_vdif(vdif)[0])
@@ -0,0 +1,68 @@
+import numpy as np
+import vdif_scan
+
+PAYLOAD = 8000
+FPS = 125        # frames per second of each thread
+NTHREADS = 4
+MODE = 'VDIF_8000-32-4-2'  # 32 Mbps over 4 threads are 125 frames/s each
+SEC0 = 1000
+
+
+def write_vdif(filename, nsec, drop=()):
+    '''
+    Writes nsec seconds of NTHREADS-thread VDIF without the frames in drop,
+    a set of (time index, thread). Returns (time index, thread) of each frame.
+    '''
+    frames = [(k, th) for k in range(nsec * FPS) for th in range(NTHREADS) if (k, th) not in drop]
+    words = np.zeros((len(frames), 8), dtype='<u4')
+    for i, (k, th) in enumerate(frames):
+        words[i, 0] = SEC0 + k // FPS
+        words[i, 1] = (k % FPS) | (30 << 24)
+        words[i, 2] = (PAYLOAD + 32) // 8
+        words[i, 3] = (1 << 26) | (th << 16) | 0x4566
+    data = np.zeros((len(frames), PAYLOAD + 32), dtype=np.uint8)
+    data[:, :32] = words.view(np.uint8).reshape(len(frames), 32)
+    data.tofile(filename)
+    return frames
+
+
+def test_fps_per_thread_from_mode(tmp_path):
+    filename = str(tmp_path / 'multi.vdif')
+    write_vdif(filename, 3)
+    gapmap = vdif_scan.scan_file(filename, mode=MODE)
+    assert gapmap['fps'] == FPS
+    assert gapmap['nthreads'] == NTHREADS
+    assert gapmap['segments'] == [[0, 3 * FPS * NTHREADS, 0.0, 3.0]]
+    assert vdif_scan.frame_range(gapmap, 1.0, 2.0) == (FPS * NTHREADS, 2 * FPS * NTHREADS, 1.0, 2.0)
+
+
+def test_thread_dropout(tmp_path):
+    filename = str(tmp_path / 'dropout.vdif')
+    frames = write_vdif(filename, 3, drop={(FPS + 5, 2)})
+    gapmap = vdif_scan.scan_file(filename, mode=MODE)
+    assert [g[0] for g in gapmap['gaps']] == ['thread_dropout']
+    segment = gapmap['segments'][0]
+    assert segment[1] == len(frames)
+    assert segment[3] == 3.0
+    first_frame, stop_frame, t_first, t_last = vdif_scan.frame_range(gapmap, 1.0, 2.0)
+    # the range runs from the first frame of second 1 up to the first frame of second 2
+    assert frames[first_frame] == (FPS, 0)
+    assert frames[stop_frame] == (2 * FPS, 0)
+    assert (t_first, t_last) == (1.0, 2.0)
+    assert frames[vdif_scan.time_to_frame(gapmap, 2.5)] == (2 * FPS + FPS // 2, 0)
+
+
+def test_range_starts_after_missing_frames(tmp_path):
+    filename = str(tmp_path / 'missing.vdif')
+    # the first 10 frame times of second 2 are missing in all threads
+    drop = {(k, th) for k in range(2 * FPS, 2 * FPS + 10) for th in range(NTHREADS)}
+    frames = write_vdif(filename, 3, drop=drop)
+    gapmap = vdif_scan.scan_file(filename, mode=MODE)
+    assert [g[0] for g in gapmap['gaps']] == ['missing']
+    assert gapmap['segments'][0][3] == 2.0
+    # a start within the last frame before the gap falls into the gap
+    first_frame, stop_frame, t_first, t_last = vdif_scan.frame_range(gapmap, 1.999, 2.5)
+    assert frames[first_frame] == (2 * FPS + 10, 0)
+    assert t_first == (2 * FPS + 10) / FPS
+    assert frames[stop_frame] == (2 * FPS + FPS // 2, 0)
+    assert t_last == (2 * FPS + FPS // 2) / FPS
@@ -0,0 +1,76 @@
+import os
+import sys
+import threading
+import time
+import vdif_stream
+from conftest import REPO
+
+STUB = '''#!{python}
+# reads the input like DSPSR might: first the header, then {how}
+import os
+import sys
+sys.path.insert(0, {repo!r})
+import filterbank
+args = sys.argv[1:]
+hdr = [a for a in args if a.endswith('.hdr')][0]
+datafile = [line.split()[1] for line in open(hdr) if line.startswith('DATAFILE')][0]
+fd = os.open(datafile, os.O_RDONLY)
+data = os.read(fd, 32)
+if {seek}:
+    try:
+        os.lseek(fd, 0, os.SEEK_SET)
+        data = b''
+    except OSError:
+        data = b''
+while len(data) < 2**20:
+    chunk = os.read(fd, 2**20 - len(data))
+    if not chunk:
+        break
+    data += chunk
+with open(args[args.index('-o') + 1], 'wb') as f:
+    filterbank.write_header(f, {{'nchans': 1, 'nbits': 8, 'nifs': 1, 'tsamp': 1e-3}})
+    f.write(data)
+'''
+
+
+def install_stub(tmp_path, monkeypatch, seek):
+    bindir = tmp_path / 'bin'
+    bindir.mkdir()
+    stub = bindir / 'digifil'
+    stub.write_text(STUB.format(python=sys.executable, repo=REPO, seek=seek,
+                                how='rewinds' if seek else 'reads on'))
+    stub.chmod(0o755)
+    monkeypatch.setenv('PATH', f'{bindir}:{os.environ["PATH"]}')
+    monkeypatch.setattr(vdif_stream, 'PROBE_RESULTS', str(tmp_path / 'probe.json'))
+
+
+def test_probe_accepts_sequential_reader(tmp_path, monkeypatch):
+    install_stub(tmp_path, monkeypatch, seek=False)
+    assert vdif_stream.probe(str(tmp_path))
+
+
+def test_probe_rejects_seeking_reader(tmp_path, monkeypatch):
+    install_stub(tmp_path, monkeypatch, seek=True)
+    assert not vdif_stream.probe(str(tmp_path))
+
+
+def test_relay_gives_up_on_missing_reader(tmp_path):
+    src, dst = str(tmp_path / 'src'), str(tmp_path / 'dst')
+    os.mkfifo(src)
+    os.mkfifo(dst)
+    nbytes = 3 * vdif_stream.CHUNK_SIZE
+
+    def jive5ab():
+        with open(src, 'wb') as f:
+            f.write(b'\0' * nbytes)
+
+    writer = threading.Thread(target=jive5ab, daemon=True)
+    writer.start()
+    relay = vdif_stream.Relay(src, dst, open_timeout=0.5)
+    t0 = time.time()
+    relay.start()
+    relay.join(timeout=10)
+    assert not relay.is_alive()
+    assert time.time() - t0 < 5
+    assert relay.ndiscarded == nbytes
+    assert relay.error is not None
@@ -1,7 +1,5 @@
 #!/usr/bin/env python3
-from astropy.time import Time
 import argparse
-import astropy.units as u
 import glob
 import os
 
@@ -47,7 +45,7 @@ def main(args):
             tcand = float(img.split('tcand_')[1].split('_')[0])
             dm = round(float(img.split('dm_')[1].split('_')[0]), 1)
             snr = round(float(img.split('snr_')[1].split('.png')[0]), 1)
-            mjd = (Time(tstart, format="mjd", scale="utc") + tcand*u.s).mjd
+            mjd = tstart + tcand / 86400.
             if args.full:
                 f.write(f'{scan}: {mjd:.12f} {dm} {snr}\n')
             else:
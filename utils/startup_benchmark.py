@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+'''
+Measures how long the command line tools take to start, i.e. to import
+everything and parse their arguments (each is run with --help). Also lists
+the heavy modules each of them pulls in at startup. Run from anywhere; by
+default all python tools of the repository are timed.
+'''
+import argparse
+import glob
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ['astropy', 'pandas', 'numpy', 'scipy', 'matplotlib', 'pika']
+# runs the script as __main__ with --help and reports the heavy modules it imported
+PROBE = '''
+import runpy, sys
+sys.argv = [sys.argv[1], '--help']
+sys.path.insert(0, __import__('os').path.dirname(sys.argv[0]))
+try:
+    runpy.run_path(sys.argv[0], run_name='__main__')
+except SystemExit:
+    pass
+print('MODULES', ' '.join(m for m in {heavy} if m in sys.modules), file=sys.stderr)
+'''.format(heavy=HEAVY_MODULES)
+
+
+def options():
+    parser = argparse.ArgumentParser(
+        description='Measures the startup time of the command line tools.')
+    general = parser.add_argument_group('General info about the data.')
+    general.add_argument('scripts', type=str, nargs='*',
+                         help='Scripts to time. Default are all python scripts of the repository.')
+    general.add_argument('-n', '--repeat', type=int, default=5,
+                         help='Number of runs per script, the median is reported. '+
+                         'Default=%(default)s.')
+    general.add_argument('--python', type=str, default=sys.executable,
+                         help='Python interpreter to use. Default=%(default)s.')
+    return parser.parse_args()
+
+
+def entry_points():
+    '''
+    Returns all python scripts of the repository that can be run.
+    '''
+    scripts = sorted(glob.glob(f'{REPO}/*.py') + glob.glob(f'{REPO}/utils/*.py'))
+    entry = []
+    for script in scripts:
+        with open(script) as f:
+            if '__main__' in f.read():
+                entry.append(script)
+    return entry
+
+
+def startup_time(script, repeat=5, python=sys.executable):
+    '''
+    Returns the median wall time in seconds it takes to run script --help
+    and the heavy modules it imported.
+    '''
+    times = []
+    modules = ''
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        p = subprocess.run([python, '-c', PROBE, script], stdout=subprocess.DEVNULL,
+                           stderr=subprocess.PIPE, universal_newlines=True)
+        times.append(time.perf_counter() - t0)
+        modules = ' '.join(line.split('MODULES')[1].strip() for line in p.stderr.split('\n')
+                           if line.startswith('MODULES'))
+    return statistics.median(times), modules
+
+
+if __name__ == "__main__":
+    args = options()
+    scripts = args.scripts if args.scripts else entry_points()
+    interpreter = []
+    for _ in range(args.repeat):
+        t0 = time.perf_counter()
+        subprocess.run([args.python, '-c', 'pass'])
+        interpreter.append(time.perf_counter() - t0)
+    interpreter = statistics.median(interpreter)
+    print(f'{"script":35s} {"startup [ms]":>12s}  heavy imports')
+    print(f'{"(bare interpreter)":35s} {interpreter*1e3:12.0f}')
+    for script in scripts:
+        seconds, modules = startup_time(os.path.abspath(script), args.repeat, args.python)
+        print(f'{os.path.relpath(script, REPO):35s} {seconds*1e3:12.0f}  {modules}')
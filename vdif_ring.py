@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+'''
+Retention ring for the split per-IF VDIF files on scratch. Instead of being
+deleted as soon as a scan is spliced, the files of the last scans are kept
+until the ring holds more than max_scans scans or max_gb GB; then the least
+recently used scans are evicted. Candidates (MJD, DM) are cut straight from
+the retained files: each IF gets the window around the time the dispersed
+burst crosses its band, so nothing has to be read from the FlexBuff again.
+
+  vdif_ring.py add ring.json <scan>_IF*.vdif --freq_lsb 1650 --bw 16 --max_scans 20
+  vdif_ring.py cut ring.json -c 59000.123 349.7 -o candidates/
+  vdif_ring.py list ring.json
+
+The index is a json file next to the data; all access to it is serialized
+with a lock such that base2fil and the cutting of candidates can run at the
+same time.
+'''
+import argparse
+import contextlib
+import fcntl
+import json
+import os
+import re
+import time
+import readahead
+from dedisperse import DISPERSION_CONSTANT
+from vlbi_time import vdif_epoch_mjd
+
+IF_PATTERN = re.compile(r'^(.*)_IF(\d+)\.vdif$')
+
+
+def options():
+    parser = argparse.ArgumentParser(
+        description='Keeps the split VDIF files of the last scans on scratch and cuts '+
+        'candidates from them.')
+    general = parser.add_argument_group('General info about the data.')
+    general.add_argument('action', type=str, choices=['add', 'cut', 'list'],
+                         help='add: retain the files of a scan and evict old scans. '+
+                         'cut: extract candidates. list: print what is retained.')
+    general.add_argument('ring', type=str,
+                         help='Index file of the ring.')
+    general.add_argument('files', type=str, nargs='*',
+                         help='For add: the per-IF files of one scan, <scan>_IF<n>.vdif.')
+    general.add_argument('--freq_lsb', type=float, default=None,
+                         help='For add: central frequency of IF1 in MHz, i.e. freqLSB_0 in base2fil.')
+    general.add_argument('--bw', type=float, default=None,
+                         help='For add: bandwidth per IF in MHz.')
+    general.add_argument('--max_scans', type=int, default=0,
+                         help='Keep at most this many scans, 0 means no limit. Default=%(default)s.')
+    general.add_argument('--max_gb', type=float, default=0,
+                         help='Keep at most this many GB, 0 means no limit. Default=%(default)s.')
+    general.add_argument('-c', '--candidate', nargs=2, type=float, action='append',
+                         default=[], metavar=('MJD', 'DM'),
+                         help='For cut: MJD (at the top of the band) and DM of a candidate. '+
+                         'Can be given several times.')
+    general.add_argument('--candfile', type=str, default=None,
+                         help='For cut: text file with one "MJD DM" per line.')
+    general.add_argument('--pad', type=float, default=0.5,
+                         help='For cut: seconds added before and after the dispersed burst '+
+                         'in each IF. Default=%(default)s.')
+    general.add_argument('-o', '--outdir', type=str, default=os.getcwd(),
+                         help='For cut: output directory. Default is CWD=%(default)s.')
+    return parser.parse_args()
+
+
+@contextlib.contextmanager
+def locked(ringfile):
+    '''
+    Yields the index of the ring while holding its lock and writes it back
+    afterwards. Scans whose files went missing are dropped from the index.
+    '''
+    ringfile = os.path.abspath(ringfile)
+    os.makedirs(os.path.dirname(ringfile), exist_ok=True)
+    with open(f'{ringfile}.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        index = {'scans': {}}
+        if os.path.exists(ringfile):
+            with open(ringfile) as f:
+                index = json.load(f)
+        for scan, entry in list(index['scans'].items()):
+            if not all(os.path.exists(e['file']) for e in entry['files']):
+                del index['scans'][scan]
+        yield index
+        tmpfile = f'{ringfile}.{os.getpid()}.tmp'
+        with open(tmpfile, 'w') as f:
+            json.dump(index, f, indent=1)
+        os.replace(tmpfile, ringfile)
+
+
+def if_frequency(ifnum, freq_lsb, bw):
+    '''
+    Returns the central frequency of IF ifnum as run_process_vdif in
+    base2fil assigns them: odd IFs are LSB and even IFs USB, both starting at
+    the bottom and increasing by 2 x bw.
+    '''
+    if ifnum % 2:
+        return freq_lsb + (ifnum - 1) // 2 * 2 * bw
+    return freq_lsb + bw + (ifnum - 2) // 2 * 2 * bw
+
+
+def file_info(filename, freq, bw):
+    '''
+    Returns what is needed to locate times in the split VDIF file filename,
+    read from its first frame header. The frame rate follows from bw as
+    split files have no missing frames.
+    '''
+    import numpy as np
+    with open(filename, 'rb') as f:
+        words = np.frombuffer(f.read(16), dtype='<u4')
+    if len(words) < 4:
+        raise InputError(f'{filename} does not contain a VDIF frame.')
+    header_size = 16 if (words[0] >> 30) & 0x1 else 32
+    frame_size = int(words[2] & 0xFFFFFF) * 8
+    nchan = 2**int((words[2] >> 24) & 0x1F)
+    nbits = int((words[3] >> 26) & 0x1F) + 1
+    fps = 2 * bw * 1e6 * nchan * nbits / 8 / (frame_size - header_size)
+    start_mjd = vdif_epoch_mjd(int((words[1] >> 24) & 0x3F)) + \
+        (int(words[0] & 0x3FFFFFFF) + int(words[1] & 0xFFFFFF) / fps) / 86400.
+    return {'file': os.path.abspath(filename), 'freq': freq, 'bw': bw,
+            'start_mjd': start_mjd, 'fps': fps, 'frame_size': frame_size,
+            'nframes': os.path.getsize(filename) // frame_size}
+
+
+def evict(index, max_scans=0, max_gb=0, keep=None):
+    '''
+    Removes the least recently used scans (other than keep) from index and
+    disk until there are at most max_scans scans and max_gb GB (0 means no
+    limit). Returns the removed files.
+    '''
+    removed = []
+    lru = sorted((s for s in index['scans'] if not s == keep),
+                 key=lambda s: index['scans'][s]['last_used'])
+    nbytes = sum(entry['bytes'] for entry in index['scans'].values())
+    while lru and (((max_scans > 0) and (len(index['scans']) > max_scans)) or
+                   ((max_gb > 0) and (nbytes > max_gb * 1e9))):
+        entry = index['scans'].pop(lru.pop(0))
+        nbytes -= entry['bytes']
+        for e in entry['files']:
+            if os.path.exists(e['file']):
+                os.remove(e['file'])
+            removed.append(e['file'])
+    return removed
+
+
+def add(ringfile, files, freq_lsb, bw, max_scans=0, max_gb=0):
+    '''
+    Retains the per-IF files of one scan and evicts old scans beyond the
+    limits. The scan just added is never evicted. Returns the evicted files.
+    '''
+    entries = []
+    scans = set()
+    for filename in files:
+        match = IF_PATTERN.match(os.path.basename(filename))
+        if match is None:
+            raise InputError(f'{filename} is not named <scan>_IF<n>.vdif.')
+        scans.add(match.group(1))
+        entries.append(file_info(filename, if_frequency(int(match.group(2)), freq_lsb, bw), bw))
+    if not len(scans) == 1:
+        raise InputError(f'Files of one scan at a time please, got {sorted(scans)}.')
+    scan = scans.pop()
+    with locked(ringfile) as index:
+        now = time.time()
+        index['scans'][scan] = {'files': entries, 'added': now, 'last_used': now,
+                                'bytes': sum(os.path.getsize(e['file']) for e in entries)}
+        return evict(index, max_scans, max_gb, keep=scan)
+
+
+def windows(entry, mjd, dm, pad=0.5, fref=None):
+    '''
+    Returns (file, first_frame, nframes) of each IF of the retained scan
+    entry that covers the candidate at mjd and dm. mjd refers to fref, by
+    default the top of the highest IF as in the searches. Each IF gets the
+    time the burst takes to cross its band plus pad seconds on either side.
+    '''
+    if fref is None:
+        fref = max(e['freq'] + e['bw'] / 2 for e in entry['files'])
+    cuts = []
+    for e in entry['files']:
+        flo, fhi = e['freq'] - e['bw'] / 2, e['freq'] + e['bw'] / 2
+        t_start = (mjd - e['start_mjd']) * 86400. - pad + \
+            DISPERSION_CONSTANT * dm * (fhi**-2 - fref**-2)
+        t_stop = (mjd - e['start_mjd']) * 86400. + pad + \
+            DISPERSION_CONSTANT * dm * (flo**-2 - fref**-2)
+        first = max(0, int(t_start * e['fps']))
+        last = min(e['nframes'], int(t_stop * e['fps']) + 1)
+        if last > first:
+            cuts.append((e['file'], first, last - first))
+    return cuts
+
+
+def cut(ringfile, mjd, dm, outdir, pad=0.5):
+    '''
+    Cuts the candidate at mjd and dm from the retained files into outdir.
+    Returns the files written, an empty list if no retained scan covers it.
+    '''
+    os.makedirs(outdir, exist_ok=True)
+    written = []
+    # the lock keeps the files from being evicted while they are read
+    with locked(ringfile) as index:
+        for scan, entry in index['scans'].items():
+            cuts = windows(entry, mjd, dm, pad)
+            for filename, first, nframes in cuts:
+                frame_size = [e['frame_size'] for e in entry['files'] if e['file'] == filename][0]
+                outfile = f'{outdir}/{os.path.basename(filename)}_{mjd:.8f}_dm{dm:.2f}'
+                readahead.copy_range(filename, outfile, first * frame_size, nframes * frame_size)
+                print(f'Cut {nframes} frames of {filename} as of frame {first} to {outfile}')
+                written.append(outfile)
+            if cuts:
+                entry['last_used'] = time.time()
+    return written
+
+
+def read_candidates(candfile):
+    '''
+    Returns the (MJD, DM) of each line of candfile, skipping comments.
+    '''
+    candidates = []
+    with open(candfile) as f:
+        for line in f:
+            if line.strip() and not line.startswith('#'):
+                mjd, dm = line.split()[:2]
+                candidates.append((float(mjd), float(dm)))
+    return candidates
+
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+    pass
+
+
+class InputError(Error):
+    """Exception raised for errors in the input.
+
+    Attributes:
+        message -- explanation of the error
+    """
+
+    def __init__(self, message):
+        self.message = message
+
+
+if __name__ == "__main__":
+    args = options()
+    if args.action == 'add':
+        if (args.freq_lsb is None) or (args.bw is None):
+            raise InputError('add needs --freq_lsb and --bw.')
+        for f in add(args.ring, args.files, args.freq_lsb, args.bw, args.max_scans, args.max_gb):
+            print(f'Evicted {f}')
+    elif args.action == 'cut':
+        candidates = [tuple(c) for c in args.candidate]
+        if args.candfile is not None:
+            candidates += read_candidates(args.candfile)
+        missing = [(mjd, dm) for mjd, dm in candidates
+                   if not cut(args.ring, mjd, dm, args.outdir, args.pad)]
+        for mjd, dm in missing:
+            print(f'MJD {mjd} (DM {dm}) is not in the ring.')
+    else:
+        with locked(args.ring) as index:
+            for scan, entry in sorted(index['scans'].items(), key=lambda s: s[1]['last_used']):
+                print(f'{scan}: {len(entry["files"])} IFs, {entry["bytes"]/1e9:.2f} GB, '+
+                      f'last used {time.ctime(entry["last_used"])}')
@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+'''
+Scans all frame headers of a VDIF or Mark5B recording in one vectorized pass
+and produces a compact gap map: the contiguous segments of valid data and the
+dead spans in between (invalid frames, missing or duplicate frames, time
+discontinuities and thread dropouts). Only the headers are parsed; the file
+is read sequentially in large reads (readahead.py), which over vbs_fs is much
+faster than touching each header on its own. The gap map is stored as json
+and can be used to skip dead spans when splitting or extracting data.
+'''
+import argparse
+import json
+import math
+import os
+import sys
+import numpy as np
+import readahead
+import vdif_decode
+from vlbi_time import vdif_epoch_mjd
+
+GAPMAP_SUFFIX = '.gapmap.json'
+BLOCKSIZE = 2**20  # number of frames whose headers are parsed at once
+
+
+def options():
+    parser = argparse.ArgumentParser(
+        description='Scans the frame headers of a VDIF or Mark5B recording and '+
+        'prints or stores the map of valid segments and gaps.')
+    general = parser.add_argument_group('General info about the data.')
+    general.add_argument('filename', type=str,
+                         help='VDIF or Mark5B recording.')
+    general.add_argument('-m', '--mode', type=str, default=None,
+                         help='Mode as used in base2fil. Required for Mark5B, and for VDIF '+
+                         'recordings shorter than a second.')
+    general.add_argument('--cachedir', type=str, default=None,
+                         help='If set will store the gap map in (and re-use it from) this directory.')
+    general.add_argument('--trim', nargs=2, type=float, default=None, metavar=('SKIP', 'LENGTH'),
+                         help='If set will only print the skip and length in seconds (as used '+
+                         'by spif2file) trimmed to valid data. Exits with 1 if there is none.')
+    return parser.parse_args()
+
+
+def _parse(frames, fmt):
+    if fmt == 'mark5b':
+        header = vdif_decode.parse_mark5b_headers(frames)
+        header['thread_id'] = np.zeros(len(frames), dtype=np.uint32)
+        header['seconds'] = header['mjd_day'].astype(np.int64) * 86400 + header['seconds']
+        return header
+    return vdif_decode.parse_vdif_headers(frames)
+
+
+def _get_fps(header, fmt, mode):
+    '''
+    Returns the number of frames per second of each thread. Frame numbers
+    count per thread, so the data rate of the mode is shared by all threads
+    present in header.
+    '''
+    valid = ~header['invalid']
+    if mode is not None:
+        _, payload, datarate, _, _ = vdif_decode.parse_mode(mode)
+        nthreads = max(len(np.unique(header['thread_id'][valid])), 1)
+        return int(datarate * 1e6 / 8 / payload / nthreads)
+    if fmt == 'vdif' and len(np.unique(header['seconds'][valid])) > 1:
+        return int(header['frame_nr'][valid].max()) + 1
+    raise InputError('Cannot determine the number of frames per second, please supply the mode.')
+
+
+def _add_gap(gaps, kind, first_frame, nframes, t_start, t_stop):
+    '''
+    Appends a gap to gaps or extends the previous one if it is of the same
+    kind and directly adjacent.
+    '''
+    if gaps and (gaps[-1][0] == kind) and (gaps[-1][1] + gaps[-1][2] == first_frame) \
+       and (kind in ['invalid', 'duplicate']):
+        gaps[-1][2] += int(nframes)
+        gaps[-1][4] = float(t_stop)
+    else:
+        gaps.append([kind, int(first_frame), int(nframes), float(t_start), float(t_stop)])
+
+
+def scan_file(filename, mode=None, blocksize=BLOCKSIZE):
+    '''
+    Reads all frame headers of filename and returns the gap map as a
+    dictionary. Times are given in seconds relative to the first full second
+    in the file, i.e. in the same convention as the skips used by spif2file.
+    segments is a list of [first_frame, nframes, t_start, t_stop] of contiguous
+    valid data; gaps is a list of [kind, first_frame, nframes, t_start, t_stop].
+    For missing frames first_frame is the frame following the gap and nframes=0,
+    for thread dropouts it is the first frame of that time and nframes the
+    number of frames missing.
+    '''
+    frame_size = vdif_decode.get_frame_size(filename)
+    fmt = 'mark5b' if frame_size == vdif_decode.MARK5B_HEADER_SIZE + vdif_decode.MARK5B_PAYLOAD_SIZE else 'vdif'
+    file_size = os.path.getsize(filename)
+    nframes = file_size // frame_size
+    # the file is read sequentially in large reads, only the headers are kept
+    blocks = readahead.iter_frames(filename, frame_size, blocksize, ncols=16)
+    b, raw = next(blocks, (0, np.zeros((0, 16), dtype=np.uint8)))
+    first = _parse(raw, fmt)
+    valid = ~first['invalid']
+    if not valid.any():
+        raise InputError(f'No valid frames at the start of {filename}.')
+    fps = _get_fps(first, fmt, mode)
+    nthreads = len(np.unique(first['thread_id'][valid]))
+    i0 = np.flatnonzero(valid)[0]
+    sec0 = int(first['seconds'][i0])
+    # time origin is the first full second, as in spif2file
+    origin = sec0 * fps + (fps if first['frame_nr'][i0] > 0 else 0)
+    start_mjd = None
+    start_mjd_mod1000 = None
+    if fmt == 'vdif':
+        start_mjd = vdif_epoch_mjd(int(first['ref_epoch'][i0])) + (origin / fps) / 86400.
+    else:
+        # Mark5B headers carry the MJD modulo 1000 only, see recording_start_mjd
+        start_mjd_mod1000 = (origin / fps) / 86400.
+
+    segments = []
+    gaps = []
+    prev_t = None       # time index of the previous valid frame
+    prev_thread = None
+    prev_index = -1     # frame index of the previous valid frame
+    prev_good = False
+    seg_start = None
+    last_good_t = None  # time index of the last good frame, which ends a segment
+    pending_t = None    # time index, thread count and first frame carried over for dropout detection
+    pending_count = 0
+    pending_first = 0
+    while raw is not None:
+        header = _parse(raw, fmt)
+        n = len(header['invalid'])
+        t = (header['seconds'].astype(np.int64) * fps + header['frame_nr']) - origin
+        thread = header['thread_id'].astype(np.int64)
+        invalid = header['invalid']
+        good = ~invalid
+        idx_valid = np.flatnonzero(good)
+        # difference in time to the previous valid frame, across blocks
+        tv = t[idx_valid]
+        prev = np.concatenate([[prev_t if prev_t is not None else tv[0] - 1 if len(tv) else 0], tv[:-1]])
+        prev_th = np.concatenate([[prev_thread if prev_thread is not None else -1], thread[idx_valid][:-1]])
+        d = tv - prev
+        duplicate = (d == 0) & (thread[idx_valid] == prev_th)
+        breaks = ~duplicate & ((d < 0) | (d > 1))
+        prev_idx = np.concatenate([[prev_index - b], idx_valid[:-1]])
+        for k in np.flatnonzero(breaks):
+            i = idx_valid[k]
+            if d[k] < 0:
+                _add_gap(gaps, 'discontinuity', b + i, 0, prev[k] / fps, tv[k] / fps)
+            elif (d[k] - 1) * nthreads > i - prev_idx[k] - 1:
+                # more time passed than there are (invalid) frames in between
+                _add_gap(gaps, 'missing', b + i, 0, (prev[k] + 1) / fps, tv[k] / fps)
+        for k in np.flatnonzero(duplicate):
+            i = idx_valid[k]
+            _add_gap(gaps, 'duplicate', b + i, 1, tv[k] / fps, (tv[k] + 1) / fps)
+        for i in np.flatnonzero(invalid):
+            _add_gap(gaps, 'invalid', b + i, 1, t[i] / fps, (t[i] + 1) / fps)
+        good[idx_valid[duplicate]] = False
+        brk = np.zeros(n, dtype=bool)
+        brk[idx_valid[breaks]] = True
+
+        # thread dropouts: fewer frames than threads for a given time
+        if nthreads > 1 and len(tv):
+            times, index, counts = np.unique(tv[~duplicate], return_index=True, return_counts=True)
+            firsts = b + idx_valid[~duplicate][index]
+            if pending_t is not None and len(times) and times[0] == pending_t:
+                counts[0] += pending_count
+                firsts[0] = pending_first
+            elif pending_t is not None and pending_count < nthreads:
+                _add_gap(gaps, 'thread_dropout', pending_first, nthreads - pending_count,
+                         pending_t / fps, (pending_t + 1) / fps)
+            pending_t, pending_count, pending_first = times[-1], counts[-1], firsts[-1]
+            for k in np.flatnonzero(counts[:-1] < nthreads):
+                _add_gap(gaps, 'thread_dropout', firsts[k], nthreads - counts[k],
+                         times[k] / fps, (times[k] + 1) / fps)
+
+        # run-length encode the good frames into segments
+        prev_good_arr = np.concatenate([[prev_good], good[:-1]])
+        starts = np.flatnonzero(good & (~prev_good_arr | brk))
+        stops = np.flatnonzero(np.concatenate([good[:-1] & (~good[1:] | brk[1:]), [False]]))
+        # events are sorted such that a segment ending at frame i comes
+        # after one starting at frame i (2i for starts, 2i+1 for stops)
+        for key in np.sort(np.concatenate([2 * starts, 2 * stops + 1])):
+            i = key // 2
+            if key % 2 == 0:  # a segment starts at frame i
+                if seg_start is not None:
+                    # the segment ended with the last frame of the previous block
+                    segments.append(seg_start + [b + i, last_good_t])
+                seg_start = [b + i, t[i]]
+            else:  # a segment ends with frame i
+                segments.append(seg_start + [b + i + 1, t[i]])
+                seg_start = None
+        if good.any():
+            last_good_t = t[np.flatnonzero(good)[-1]]
+        if len(idx_valid):
+            prev_t = tv[-1]
+            prev_thread = thread[idx_valid][-1]
+            prev_index = b + idx_valid[-1]
+        prev_good = good[-1]
+        b, raw = next(blocks, (None, None))
+    if seg_start is not None:
+        segments.append(seg_start + [nframes, last_good_t])
+
+    gaps.sort(key=lambda g: g[1])
+    gapmap = {'file': os.path.abspath(filename), 'format': fmt, 'frame_size': frame_size,
+              'fps': fps, 'nthreads': nthreads, 'nframes': int(nframes),
+              'trailing_bytes': int(file_size - nframes * frame_size),
+              'start_mjd': start_mjd, 'start_mjd_mod1000': start_mjd_mod1000,
+              'segments': [], 'gaps': gaps}
+    # convert segments to [first_frame, nframes, t_start, t_stop], where
+    # t_stop is the end of the last frame present, whatever threads dropped out
+    for first_frame, t_first, stop_frame, t_last in segments:
+        gapmap['segments'].append([int(first_frame), int(stop_frame - first_frame),
+                                   float(t_first / fps), float((t_last + 1) / fps)])
+    return gapmap
+
+
+def gapmap_file(filename, cachedir):
+    return f'{cachedir}/{os.path.basename(filename)}{GAPMAP_SUFFIX}'
+
+
+def load_or_scan(filename, cachedir=None, mode=None):
+    '''
+    Returns the gap map of filename, reading it from cachedir if it is
+    there and up to date, otherwise scanning the file (and storing the
+    result in cachedir if set).
+    '''
+    if cachedir is not None:
+        cached = gapmap_file(filename, cachedir)
+        if os.path.exists(cached) and os.path.getmtime(cached) >= os.path.getmtime(filename):
+            return load_gapmap(cached)
+    gapmap = scan_file(filename, mode=mode)
+    if cachedir is not None:
+        os.makedirs(cachedir, exist_ok=True)
+        save_gapmap(gapmap, gapmap_file(filename, cachedir))
+    return gapmap
+
+
+def save_gapmap(gapmap, outfile):
+    tmpfile = f'{outfile}.{os.getpid()}.tmp'
+    with open(tmpfile, 'w') as f:
+        json.dump(gapmap, f)
+    os.replace(tmpfile, outfile)
+    return outfile
+
+
+def load_gapmap(infile):
+    with open(infile, 'r') as f:
+        return json.load(f)
+
+
+def trim(gapmap, skip, length):
+    '''
+    Trims the window of length seconds after skip seconds (the convention
+    used by spif2file) such that it starts and ends on valid data. Returns the
+    new integer skip and length, or None if there is no valid data in the
+    window at all.
+    '''
+    stop = skip + length
+    overlap = [(max(s[2], skip), min(s[3], stop)) for s in gapmap['segments']
+               if (s[3] > skip) and (s[2] < stop)]
+    if not overlap:
+        return None
+    new_skip = max(skip, int(math.ceil(overlap[0][0])))
+    new_stop = min(stop, int(math.floor(overlap[-1][1])))
+    if new_stop <= new_skip:
+        return None
+    return new_skip, new_stop - new_skip
+
+
+def recording_start_mjd(gapmap, near_mjd=None):
+    '''
+    Returns the MJD of the time origin of gapmap. For Mark5B the MJD modulo
+    1000 of the headers is completed with near_mjd, e.g. the scheduled
+    start of a scan. Returns None if the MJD is not known.
+    '''
+    if gapmap.get('start_mjd') is not None:
+        return gapmap['start_mjd']
+    mod = gapmap.get('start_mjd_mod1000')
+    if (mod is None) or (near_mjd is None):
+        return None
+    return mod + 1000 * round((near_mjd - mod) / 1000.)
+
+
+def _frame_at(gapmap, segment, k):
+    '''
+    Returns the index of the first frame of segment at time index k (in
+    frames since the time origin), i.e. the frame following all frames of
+    earlier times, which accounts for threads that dropped out before.
+    '''
+    fps, nthreads = gapmap['fps'], gapmap['nthreads']
+    first_frame, nframes, t_start, _ = segment
+    k_start = int(round(t_start * fps))
+    dropped = sum(g[2] for g in gapmap['gaps'] if (g[0] == 'thread_dropout') and
+                  (first_frame <= g[1] < first_frame + nframes) and (int(round(g[3] * fps)) < k))
+    frame = first_frame + (k - k_start) * nthreads - dropped
+    return min(max(frame, first_frame), first_frame + nframes)
+
+
+def frame_range(gapmap, t_start, t_stop):
+    '''
+    Returns the whole frames of valid data between t_start and t_stop
+    seconds (gap map convention) as (first_frame, stop_frame, t_first,
+    t_last): the data are bytes first_frame * frame_size up to (excluding)
+    stop_frame * frame_size and span t_first to t_last seconds, from the first
+    frame present to the end of the last one. Gaps inside the range are
+    included, as by trim. Returns None if there is no valid data in between.
+    '''
+    fps = gapmap['fps']
+    # time indices of the first frame starting at or after t_start and of the
+    # frame following the last one that ends by t_stop; the rounding absorbs float noise
+    k0 = math.ceil(round(t_start * fps, 3))
+    k1 = math.floor(round(t_stop * fps, 3))
+    spans = [(s, int(round(s[2] * fps)), int(round(s[3] * fps))) for s in gapmap['segments']]
+    # only segments with whole frames inside the range count
+    overlap = [(s, a, e) for s, a, e in spans if max(a, k0) < min(e, k1)]
+    if not overlap:
+        return None
+    first_seg, a0, _ = overlap[0]
+    last_seg, _, e1 = overlap[-1]
+    k0, k1 = max(k0, a0), min(k1, e1)
+    first_frame = _frame_at(gapmap, first_seg, k0)
+    stop_frame = _frame_at(gapmap, last_seg, k1)
+    if stop_frame <= first_frame:
+        return None
+    return first_frame, stop_frame, k0 / fps, k1 / fps
+
+
+def dead_spans(gapmap, t_start, t_stop):
+    '''
+    Returns all gaps of gapmap that overlap with the time range t_start to t_stop.
+    '''
+    return [g for g in gapmap['gaps'] if (g[4] > t_start) and (g[3] < t_stop)]
+
+
+def time_to_frame(gapmap, t):
+    '''
+    Returns the index of the first frame at or after time t (seconds in the
+    gap map convention), taking missing frames into account. Returns None if
+    t is beyond the end of the data.
+    '''
+    fps = gapmap['fps']
+    for segment in gapmap['segments']:
+        if t < segment[3]:
+            k = max(int(round(t * fps)), int(round(segment[2] * fps)))
+            return _frame_at(gapmap, segment, k)
+    return None
+
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+    pass
+
+
+class InputError(Error):
+    """Exception raised for errors in the input.
+
+    Attributes:
+        message -- explanation of the error
+    """
+
+    def __init__(self, message):
+        self.message = message
+
+
+if __name__ == "__main__":
+    args = options()
+    gapmap = load_or_scan(args.filename, cachedir=args.cachedir, mode=args.mode)
+    if args.trim is not None:
+        trimmed = trim(gapmap, *args.trim)
+        if trimmed is None:
+            print(f'No valid data in {args.filename} between {args.trim[0]}s and '+
+                  f'{sum(args.trim)}s.', file=sys.stderr)
+            sys.exit(1)
+        print(f'{trimmed[0]} {trimmed[1]}')
+        sys.exit(0)
+    print(f'{args.filename}: {gapmap["nframes"]} frames of {gapmap["frame_size"]} bytes, '+
+          f'{gapmap["fps"]} frames/s, {gapmap["nthreads"]} thread(s).')
+    for first_frame, nframes, t_start, t_stop in gapmap['segments']:
+        print(f'  valid  {t_start:10.4f}s - {t_stop:10.4f}s  frames {first_frame}-{first_frame+nframes-1}')
+    for kind, first_frame, nframes, t_start, t_stop in gapmap['gaps']:
+        print(f'  {kind:14s} {t_start:10.4f}s - {t_stop:10.4f}s  at frame {first_frame} ({nframes} frames)')
@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+'''
+Relays the per-IF VDIF streams jive5ab splits a scan into straight to the
+digifils that channelise them, such that nothing is written to scratch.
+jive5ab writes each IF into a fifo in --indir; the data are passed on through
+a bounded in-memory buffer to the fifo of the same name that digifil reads
+from. The buffer takes up the jitter between jive5ab and the digifils. If a
+digifil stops reading early (e.g. at the end of -T), its stream is drained
+and discarded instead of blocking jive5ab and with it all other IFs.
+
+At the end the time each relay waited for jive5ab and for digifil is printed,
+which tells whether splitting or channelisation limits the throughput.
+
+digifil reads its input through DSPSR, which may seek in and stat the file.
+--probe checks once per digifil build that it channelises a fifo exactly as it
+does a file; base2fil splits to scratch as before if it does not.
+'''
+import argparse
+import errno
+import fcntl
+import json
+import os
+import queue
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import cpu_placement
+
+CHUNK_SIZE = 4 * 2**20
+PROBE_RESULTS = os.path.expanduser('~/.vdif_stream/probe.json')
+
+
+def options():
+    parser = argparse.ArgumentParser(
+        description='Relays VDIF data from the fifos jive5ab writes to the fifos digifil reads '+
+        'from through bounded memory buffers.')
+    general = parser.add_argument_group('General info about the data.')
+    general.add_argument('outputs', type=str, nargs='*',
+                         help='The fifos digifil reads from, one per IF.')
+    general.add_argument('--indir', type=str, default=None,
+                         help='Directory with the fifos jive5ab writes to. They have the same '+
+                         'names as the outputs. Required unless --probe is set.')
+    general.add_argument('--buffer_mb', type=float, default=256,
+                         help='Size of the buffer of each IF in MB. Default=%(default)s.')
+    general.add_argument('--open_timeout', type=float, default=60,
+                         help='Seconds after the first data arrived that a digifil has to open '+
+                         'its fifo, after that its stream is discarded. Default=%(default)s.')
+    general.add_argument('--cleanup', action='store_true',
+                         help='If set will remove all fifos once done.')
+    general.add_argument('--probe', action='store_true',
+                         help='If set will only check whether digifil reads from fifos as it does '+
+                         'from files and exit with 1 if not. The result is kept per digifil build.')
+    general.add_argument('--workdir', type=str, default=None,
+                         help='Directory for the files of --probe. Default is a temporary directory.')
+    args = parser.parse_args()
+    if not args.probe and (not args.outputs or args.indir is None):
+        parser.error('outputs and --indir are required unless --probe is set.')
+    return args
+
+
+class Relay(threading.Thread):
+    '''
+    Copies src to dst through a queue that holds at most buffer_size bytes.
+    The reading side runs in its own thread, the writing side in this one.
+    '''
+
+    def __init__(self, src, dst, buffer_size=256*2**20, open_timeout=60):
+        super().__init__(daemon=True)
+        self.src = src
+        self.dst = dst
+        self.open_timeout = open_timeout
+        self.first_data = None  # when data arrived first, from then on digifil has open_timeout
+        self.queue = queue.Queue(maxsize=max(int(buffer_size // CHUNK_SIZE), 1))
+        self.nbytes = 0
+        self.ndiscarded = 0
+        self.wait_src = 0.0  # seconds the writer waited for data, i.e. jive5ab is slow
+        self.wait_dst = 0.0  # seconds the reader waited for space, i.e. digifil is slow
+        self.error = None
+        self.opened = threading.Event()
+        self.reader = threading.Thread(target=self._read, daemon=True)
+
+    def _read(self):
+        moved = False
+        try:
+            with open(self.src, 'rb', buffering=0) as f:
+                while True:
+                    chunk = f.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    if self.first_data is None:
+                        self.first_data = time.time()
+                    if not moved and self.opened.is_set():
+                        # digifil runs now, keep off the CPUs it is bound to
+                        cpu_placement.avoid_pinned()
+                        moved = True
+                    t0 = time.time()
+                    self.queue.put(chunk)
+                    self.wait_dst += time.time() - t0
+        except OSError as e:
+            self.error = e
+        finally:
+            if self.first_data is None:
+                self.first_data = time.time()
+            self.queue.put(None)
+
+    def _open_dst(self):
+        '''
+        Opens dst for writing. Unlike a plain open this does not wait forever
+        for a digifil that never opens its end of the fifo, e.g. because it
+        failed on startup. Returns None if none did within open_timeout
+        seconds of the first data.
+        '''
+        while True:
+            try:
+                fd = os.open(self.dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NONBLOCK, 0o644)
+                break
+            except OSError as e:
+                # ENXIO: nobody reads from the fifo yet
+                if not e.errno == errno.ENXIO:
+                    raise
+            if (self.first_data is not None) and (time.time() - self.first_data > self.open_timeout):
+                return None
+            time.sleep(0.1)
+        # once digifil is there writes block again
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+        return os.fdopen(fd, 'wb', buffering=0)
+
+    def run(self):
+        self.reader.start()
+        out = self._open_dst()
+        if out is None:
+            # discard the stream such that jive5ab does not stall
+            self.error = f'nothing opened {self.dst} within {self.open_timeout:.0f}s'
+        cpu_placement.avoid_pinned()
+        self.opened.set()
+        while True:
+            t0 = time.time()
+            chunk = self.queue.get()
+            self.wait_src += time.time() - t0
+            if chunk is None:
+                break
+            if out is None:
+                self.ndiscarded += len(chunk)
+                continue
+            try:
+                out.write(chunk)
+                self.nbytes += len(chunk)
+            except BrokenPipeError:
+                # digifil is done with this IF, keep draining such that jive5ab does not stall
+                out = None
+                self.ndiscarded += len(chunk)
+        if out is not None:
+            out.close()
+        self.reader.join()
+
+
+def relay(outputs, indir, buffer_size=256*2**20, open_timeout=60):
+    '''
+    Relays <indir>/<basename(output)> to output for all outputs in parallel.
+    Returns the list of finished Relay threads.
+    '''
+    relays = [Relay(f'{indir}/{os.path.basename(output)}', output, buffer_size, open_timeout)
+              for output in outputs]
+    for r in relays:
+        r.start()
+    for r in relays:
+        r.join()
+    return relays
+
+
+def report(relays, runtime):
+    '''
+    Prints the throughput of each relay and where it spent its time waiting.
+    '''
+    for r in relays:
+        print(f'{os.path.basename(r.dst)}: {r.nbytes/1e9:.2f} GB in {runtime:.0f}s '+
+              f'({r.nbytes/1e6/max(runtime, 1e-3):.1f} MB/s), {r.ndiscarded/1e6:.1f} MB discarded, '+
+              f'waited {r.wait_src:.0f}s for jive5ab and {r.wait_dst:.0f}s for digifil')
+        if r.error is not None:
+            print(f'  relaying {r.src} failed: {r.error}')
+    wait_src = sum(r.wait_src for r in relays)
+    wait_dst = sum(r.wait_dst for r in relays)
+    bottleneck = 'jive5ab' if wait_src > wait_dst else 'digifil'
+    print(f'Throughput was limited by {bottleneck}.')
+
+
+def probe_vdif(filename, nsec=2, bw=4.0, payload=8000):
+    '''
+    Writes nsec seconds of random single-thread, 2-channel, 2-bit VDIF of
+    bandwidth bw MHz per channel to filename.
+    '''
+    import numpy as np
+    fps = int(2 * bw * 1e6 * 2 * 2 / 8 / payload)
+    nframes = nsec * fps
+    words = np.zeros((nframes, 8), dtype='<u4')
+    frame_nr = np.arange(nframes)
+    words[:, 0] = 600000000 + frame_nr // fps
+    words[:, 1] = (frame_nr % fps) | (40 << 24)
+    words[:, 2] = ((payload + 32) // 8) | (1 << 24)
+    words[:, 3] = (1 << 26) | 0x4566
+    frames = np.random.default_rng(0).integers(0, 256, (nframes, payload + 32), dtype=np.uint8)
+    frames[:, :32] = words.view(np.uint8).reshape(nframes, 32)
+    frames.tofile(filename)
+
+
+def _process_vdif():
+    for name in ['process_vdif', 'process_vdif.py']:
+        if shutil.which(name):
+            return [shutil.which(name)]
+    return [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'process_vdif.py')]
+
+
+def _filterbank_data(filename):
+    import filterbank
+    try:
+        _, header_size = filterbank.read_header(filename)
+    except Exception:
+        return None
+    with open(filename, 'rb') as f:
+        f.seek(header_size)
+        return f.read()
+
+
+def probe(workdir=None, bw=4.0, timeout=120):
+    '''
+    Channelises the same synthetic VDIF with process_vdif once from a file
+    and once from a fifo and returns whether both filterbanks hold the same
+    data. The result is kept per digifil build in PROBE_RESULTS.
+    '''
+    digifil = shutil.which('digifil')
+    if digifil is None:
+        return False
+    stamp = f'{os.path.realpath(digifil)}:{os.stat(digifil).st_mtime_ns}'
+    try:
+        with open(PROBE_RESULTS) as f:
+            results = json.load(f)
+    except (OSError, ValueError):
+        results = {}
+    if stamp in results:
+        return results[stamp]
+    outputs = {}
+    with tempfile.TemporaryDirectory(dir=workdir) as tmpdir:
+        vdif = f'{tmpdir}/probe.vdif'
+        probe_vdif(vdif, bw=bw)
+        for kind in ['file', 'fifo']:
+            os.makedirs(f'{tmpdir}/{kind}')
+            infile = f'{tmpdir}/{kind}/probe.vdif'
+            if kind == 'file':
+                os.symlink(vdif, infile)
+            else:
+                os.mkfifo(infile)
+            cmd = _process_vdif() + ['PROBE', infile, '-f', '1600', '-b', str(bw), '-u',
+                                     '--ra', '00:00:00', '--dec', '00:00:00', '--nchan', '16',
+                                     '--start', '0', '--nsec', '1', '--fil_out_dir', f'{tmpdir}/{kind}']
+            proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            if kind == 'fifo':
+                feeder = Relay(vdif, infile, open_timeout=30)
+                feeder.start()
+            try:
+                proc.wait(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+            if kind == 'fifo':
+                feeder.join()
+            outputs[kind] = _filterbank_data(f'{tmpdir}/{kind}/probe.vdif_pol2.fil')
+    works = (outputs['file'] is not None) and (len(outputs['file']) > 0) and \
+            (outputs['file'] == outputs['fifo'])
+    results[stamp] = works
+    try:
+        os.makedirs(os.path.dirname(PROBE_RESULTS), exist_ok=True)
+        tmpfile = f'{PROBE_RESULTS}.{os.getpid()}.tmp'
+        with open(tmpfile, 'w') as f:
+            json.dump(results, f, indent=1)
+        os.replace(tmpfile, PROBE_RESULTS)
+    except OSError:
+        pass
+    return works
+
+
+if __name__ == "__main__":
+    args = options()
+    if args.probe:
+        if probe(args.workdir):
+            print('digifil reads from fifos as it does from files.')
+            sys.exit(0)
+        print('digifil does not read from fifos as it does from files.')
+        sys.exit(1)
+    t0 = time.time()
+    try:
+        relays = relay(args.outputs, args.indir, args.buffer_mb * 2**20, args.open_timeout)
+    finally:
+        if args.cleanup:
+            for output in args.outputs:
+                for fifo in [output, f'{args.indir}/{os.path.basename(output)}']:
+                    if os.path.exists(fifo):
+                        os.remove(fifo)
+    report(relays, time.time() - t0)
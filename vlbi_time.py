@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+'''
+Conversions between the time formats used throughout: VEX and yday strings
+(2021y123d04h05m06s or 2021:123:04:05:06.5), MJDs (UTC) and VDIF reference
+epochs. Unlike astropy this needs nothing beyond the standard library and
+imports in no time, which matters for the command line tools that are started
+for every scan. Scalars are converted in plain python; lists and arrays are
+converted in one vectorized pass with numpy and returned as numpy arrays.
+
+As in astropy, the MJD fraction of a day that ends in a leap second is
+counted in units of 86401 seconds. VDIF epochs start on Jan 1 and Jul 1, i.e.
+right after the only seconds on which leap seconds are ever inserted, such
+that the seconds within an epoch are not affected.
+
+  vlbi_time.py 2021y123d04h05m06s 59337.5   # convert either way
+  vlbi_time.py --verify 100000              # compare against astropy
+'''
+import argparse
+import re
+
+MJD_UNIX_EPOCH = 40587  # MJD of 1970-01-01
+# first days after a leap second was inserted
+LEAP_SECOND_DATES = [(1972, 7, 1), (1973, 1, 1), (1974, 1, 1), (1975, 1, 1), (1976, 1, 1),
+                     (1977, 1, 1), (1978, 1, 1), (1979, 1, 1), (1980, 1, 1), (1981, 7, 1),
+                     (1982, 7, 1), (1983, 7, 1), (1985, 7, 1), (1988, 1, 1), (1990, 1, 1),
+                     (1991, 1, 1), (1992, 7, 1), (1993, 7, 1), (1994, 7, 1), (1996, 1, 1),
+                     (1997, 7, 1), (1999, 1, 1), (2006, 1, 1), (2009, 1, 1), (2012, 7, 1),
+                     (2015, 7, 1), (2017, 1, 1)]
+YDAY_PATTERN = re.compile(r'^\s*(\d+)[y:](\d+)(?:[d:](\d+)(?:[h:](\d+)(?:[m:]([\d.]+)s?)?)?)?\s*$')
+
+
+def options():
+    parser = argparse.ArgumentParser(
+        description='Converts between yday/VEX time strings and MJDs.')
+    general = parser.add_argument_group('General info about the data.')
+    general.add_argument('times', type=str, nargs='*',
+                         help='yday or VEX strings are converted to MJD, numbers to yday.')
+    general.add_argument('--precision', type=int, default=3,
+                         help='Decimals of the seconds in yday strings. Default=%(default)s.')
+    general.add_argument('--verify', type=int, default=0,
+                         help='If set will compare this many random times against astropy.')
+    return parser.parse_args()
+
+
+def days_from_civil(year, month, day):
+    '''
+    Returns the MJD at the start of the given date. Works on integers and
+    integer arrays alike.
+    '''
+    year = year - (month <= 2)
+    era = year // 400
+    yoe = year - era * 400
+    doy = (153 * ((month + 9) % 12) + 2) // 5 + day - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468 + MJD_UNIX_EPOCH
+
+
+def civil_from_days(mjd_day):
+    '''
+    Returns year, month and day of the integer MJD mjd_day (or array thereof).
+    '''
+    z = mjd_day - MJD_UNIX_EPOCH + 719468
+    era = z // 146097
+    doe = z - era * 146097
+    yoe = (doe - doe // 1460 + doe // 36524 - doe // 146096) // 365
+    doy = doe - (365 * yoe + yoe // 4 - yoe // 100)
+    mp = (5 * doy + 2) // 153
+    day = doy - (153 * mp + 2) // 5 + 1
+    month = mp + 3 - 12 * (mp >= 10)
+    return yoe + era * 400 + (month <= 2), month, day
+
+
+LEAP_SECOND_DAYS = [days_from_civil(*date) - 1 for date in LEAP_SECOND_DATES]
+
+
+def _day_length(mjd_day):
+    if isinstance(mjd_day, int):
+        return 86401 if mjd_day in LEAP_SECOND_DAYS else 86400
+    import numpy as np
+    return np.where(np.isin(mjd_day, LEAP_SECOND_DAYS), 86401, 86400)
+
+
+def _is_scalar(value):
+    return isinstance(value, (str, int, float)) or getattr(value, 'ndim', 1) == 0
+
+
+def _parse_yday(yday):
+    match = YDAY_PATTERN.match(yday)
+    if match is None:
+        raise InputError(f'{yday} is not a yday or VEX time string.')
+    year, doy, hour, minute, sec = match.groups()
+    return (int(year), int(doy), int(hour or 0), int(minute or 0), float(sec or 0))
+
+
+def yday2mjd(yday):
+    '''
+    Returns the MJD of a yday or VEX time string, or an array of MJDs for a
+    sequence thereof. Missing trailing fields count as zero.
+    '''
+    if isinstance(yday, str):
+        year, doy, hour, minute, sec = _parse_yday(yday)
+        day = days_from_civil(year, 1, 1) + doy - 1
+        return day + (hour * 3600 + minute * 60 + sec) / _day_length(day)
+    import numpy as np
+    fields = np.array([_parse_yday(str(y)) for y in yday], dtype=np.float64).reshape(-1, 5)
+    year, doy, hour, minute, sec = fields.T
+    day = days_from_civil(year.astype(np.int64), 1, 1) + doy.astype(np.int64) - 1
+    return day + (hour * 3600 + minute * 60 + sec) / _day_length(day)
+
+
+def mjd2yday(mjd, precision=3):
+    '''
+    Returns the yday string (YYYY:DDD:HH:MM:SS.sss) of mjd, or a list of
+    strings for a sequence of MJDs. Seconds are rounded to precision decimals.
+    '''
+    if _is_scalar(mjd):
+        return _mjd2yday(int(mjd // 1), float(mjd) % 1, precision)
+    import numpy as np
+    mjd = np.asarray(mjd, dtype=np.float64)
+    return [_mjd2yday(int(d), float(f), precision) for d, f in zip(mjd // 1, mjd % 1)]
+
+
+def _mjd2yday(day, frac, precision):
+    length = _day_length(day)
+    # counted in units of 10**-precision seconds such that rounding carries over correctly
+    unit = 10**precision
+    ticks = int(round(frac * length * unit))
+    if ticks >= length * unit:
+        day, ticks = day + 1, ticks - length * unit
+    year, _, _ = civil_from_days(day)
+    doy = day - days_from_civil(year, 1, 1) + 1
+    secs, ticks = divmod(ticks, unit)
+    hour, secs = min(secs // 3600, 23), secs - min(secs // 3600, 23) * 3600
+    minute, secs = min(secs // 60, 59), secs - min(secs // 60, 59) * 60
+    fraction = f'.{ticks:0{precision}d}' if precision > 0 else ''
+    return f'{year:04d}:{doy:03d}:{hour:02d}:{minute:02d}:{secs:02d}{fraction}'
+
+
+def vdif_epoch_mjd(ref_epoch):
+    '''
+    Returns the MJD of a VDIF reference epoch (half years since 2000). Takes
+    integers or integer arrays.
+    '''
+    return days_from_civil(2000 + ref_epoch // 2, 1 + 6 * (ref_epoch % 2), 1)
+
+
+def vdif2mjd(ref_epoch, seconds, frame=0, frames_per_second=1):
+    '''
+    Returns the MJD of the start of a VDIF frame given the fields of its
+    header. All arguments can be arrays.
+    '''
+    return vdif_epoch_mjd(ref_epoch) + (seconds + frame / frames_per_second) / 86400.
+
+
+def mjd2vdif(mjd):
+    '''
+    Returns the VDIF reference epoch and the seconds since then of mjd.
+    '''
+    if _is_scalar(mjd):
+        year, month, _ = civil_from_days(int(mjd // 1))
+    else:
+        import numpy as np
+        mjd = np.asarray(mjd, dtype=np.float64)
+        year, month, _ = civil_from_days((mjd // 1).astype(np.int64))
+    ref_epoch = (year - 2000) * 2 + (month >= 7)
+    return ref_epoch, (mjd - vdif_epoch_mjd(ref_epoch)) * 86400.
+
+
+def verify(n=100000, seed=1):
+    '''
+    Compares n random conversions with astropy. Returns the number of yday
+    strings that differ and the largest deviations in seconds of yday to MJD
+    and of the VDIF round trip.
+    '''
+    import numpy as np
+    from astropy.time import Time
+    rng = np.random.default_rng(seed)
+    mjds = rng.uniform(41317, 62000, n)  # 1972 to 2028
+    # make sure to hit leap second days and day boundaries
+    mjds[:len(LEAP_SECOND_DAYS)] = np.array(LEAP_SECOND_DAYS) + 0.999
+    mjds[-100:] = np.round(mjds[-100:])
+    ref_ydays = Time(mjds, format='mjd', scale='utc', precision=3).yday
+    nmismatch = sum(not a == b for a, b in zip(mjd2yday(mjds), ref_ydays))
+    dt_mjd = np.abs(yday2mjd(ref_ydays) - Time(list(ref_ydays), format='yday', scale='utc').mjd)
+    dt_vdif = np.abs(vdif2mjd(*mjd2vdif(mjds)) - mjds)
+    print(f'{n} random times: {nmismatch} yday strings differ from astropy, '+
+          f'yday to MJD deviates by up to {dt_mjd.max()*86400*1e6:.3f} us, '+
+          f'VDIF round trip by up to {dt_vdif.max()*86400*1e6:.3f} us.')
+    return nmismatch, dt_mjd.max() * 86400, dt_vdif.max() * 86400
+
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+    pass
+
+
+class InputError(Error):
+    """Exception raised for errors in the input.
+
+    Attributes:
+        message -- explanation of the error
+    """
+
+    def __init__(self, message):
+        self.message = message
+
+
+if __name__ == "__main__":
+    args = options()
+    for t in args.times:
+        try:
+            print(f'{t} = {mjd2yday(float(t), args.precision)}')
+        except ValueError:
+            print(f'{t} = {yday2mjd(t):.12f}')
+    if args.verify > 0:
+        verify(args.verify)